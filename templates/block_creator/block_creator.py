@@ -3,16 +3,343 @@
 used to deploy blockcreator container from autostartable flist.
 """
 
+import hashlib
+import io
+import bisect
+import functools
 import os
 import time
+from contextlib import contextmanager
 from random import shuffle
 import gevent
+from gevent.event import AsyncResult
 from jumpscale import j
 from zerorobot.service_collection import ServiceNotFoundError
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.decorator import retry
 from zerorobot.template.state import StateCheckError
 import netaddr
+import requests
+
+# bounds (in seconds) of the backoff used while waiting for tfchaind to come up
+_READINESS_MIN_DELAY = 1
+_READINESS_MAX_DELAY = 30
+
+# number of free ports asked to the node when leasing a port
+_PORT_CANDIDATES = 10
+# service data fields holding leased host ports
+_PORT_FIELDS = ('hostRpcPort', 'standbyRpcPort')
+
+# upper bounds in seconds of the buckets of the phase duration histogram,
+# durations above the last bound are counted in an extra bucket
+_TIMING_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+
+def _timed(phase):
+    """Record the duration of the decorated action in the phaseTimings histogram."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self._span(phase):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# consensus snapshots are written to a temporary file first so an interrupted
+# snapshot never shows up as a valid one
+_SNAPSHOT_SCRIPT = """set -e
+cd {data}
+tar -czf {backups}/{name}.partial consensus
+cd {backups}
+mv {name}.partial {name}
+sha256sum {name} > {name}.sha256
+ls -1t consensus-*.tar.gz | tail -n +{first_removed} | while read old; do rm -f "$old" "$old.sha256"; done
+"""
+
+_RESTORE_SCRIPT = """set -e
+cd {directory}
+sha256sum -c {name}.sha256
+rm -rf {data}/consensus
+tar -xzf {name} -C {data}
+"""
+
+# prepares the data volume of a blue/green slot: the consensus is seeded from the
+# latest snapshot, if any, so the new daemon only has to sync the blocks created since
+_BLUE_GREEN_PREPARE_SCRIPT = """set -e
+rm -rf {new}
+mkdir -p {new}
+cd {backups}
+snapshot=$(ls -1t consensus-*.tar.gz 2> /dev/null | head -n 1)
+if [ -n "$snapshot" ] && sha256sum -c "$snapshot.sha256"; then
+    tar -xzf "$snapshot" -C {new}
+fi
+"""
+
+# the wallet is copied once both daemons are stopped, the running daemon keeps
+# writing to its wallet so a copy taken earlier could be torn
+# tfchaind only answers api calls made with this user agent
+_API_HEADERS = {'User-Agent': 'Rivine-Agent'}
+
+# backups chunk a read-only btrfs snapshot of the service filesystem, it is taken
+# atomically while the daemon keeps running so the databases in it are crash-consistent
+_BACKUP_SNAPSHOT_DIR = '.backup-snapshot'
+_BACKUP_SNAPSHOT_SCRIPT = """set -e
+if [ -d {snapshot} ]; then ionice -c3 nice -n 19 btrfs subvolume delete {snapshot}; fi
+ionice -c3 nice -n 19 btrfs subvolume snapshot -r {filesystem} {snapshot}
+"""
+_BACKUP_SNAPSHOT_DELETE_SCRIPT = """set -e
+ionice -c3 nice -n 19 btrfs subvolume delete {snapshot}
+"""
+
+# a restored backup is written next to the data volume and only swapped in once complete
+_RESTORE_BACKUP_SWAP_SCRIPT = """set -e
+rm -rf {data}
+mv {restored} {data}
+"""
+
+PEER_DISCOVERY_TEMPLATE_NAME = 'peer_discovery'
+
+
+class _ChunkWriter:
+    """Splits a stream written to it in chunks and hands them to a callback."""
+
+    def __init__(self, chunk_size, on_chunk):
+        self._chunk_size = chunk_size
+        self._on_chunk = on_chunk
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= self._chunk_size:
+            self._on_chunk(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+
+    def flush(self):
+        if self._buffer:
+            self._on_chunk(bytes(self._buffer))
+            self._buffer = bytearray()
+
+
+class _ChunkReader:
+    """Reads the concatenated chunks of a file, fetching a chunk only when it is needed."""
+
+    def __init__(self, digests, fetch):
+        self._digests = list(digests)
+        self._fetch = fetch
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while self._digests and (size < 0 or len(self._buffer) < size):
+            self._buffer.extend(self._fetch(self._digests.pop(0)))
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class _ChunkStore:
+    """Deduplicated backups of a directory on the node filesystem.
+
+    Files are split in chunks addressed by their sha256 and stored once under
+    <path>/chunks, every backup writes a manifest under <path>/manifests listing
+    the chunks of every file.
+    """
+
+    def __init__(self, node_fs, path, chunk_size, rate_limit):
+        self._node_fs = node_fs
+        self._chunks_dir = os.path.join(path, 'chunks')
+        self._manifests_dir = os.path.join(path, 'manifests')
+        self._chunk_size = chunk_size
+        self._rate_limit = rate_limit
+        self._dirs = set()
+
+    def _mkdir(self, path):
+        if path not in self._dirs:
+            self._node_fs.mkdir(path)
+            self._dirs.add(path)
+
+    def _walk(self, path):
+        for entry in self._node_fs.list(path):
+            entry_path = os.path.join(path, entry['name'])
+            if entry['is_dir']:
+                yield from self._walk(entry_path)
+            else:
+                yield entry_path
+
+    def manifests(self):
+        """Names of the stored manifests, oldest first."""
+        self._mkdir(self._manifests_dir)
+        return sorted(entry['name'] for entry in self._node_fs.list(self._manifests_dir))
+
+    def load_manifest(self, name):
+        buffer = io.BytesIO()
+        self._node_fs.download(os.path.join(self._manifests_dir, name), buffer)
+        return j.data.serializer.json.loads(buffer.getvalue().decode())
+
+    def _referenced_chunks(self, names):
+        chunks = set()
+        for name in names:
+            for entry in self.load_manifest(name)['files']:
+                chunks.update(entry['chunks'])
+        return chunks
+
+    def backup(self, source):
+        """Store the chunks of all files under source that aren't stored yet.
+
+        Returns:
+            dict -- manifest of the backup
+        """
+        manifests = self.manifests()
+        known = self._referenced_chunks(manifests[-1:])
+        stats = {'chunks': 0, 'stored': 0, 'bytes': 0, 'storedBytes': 0}
+        started = time.time()
+
+        def store(chunk):
+            digest = hashlib.sha256(chunk).hexdigest()
+            stats['chunks'] += 1
+            stats['bytes'] += len(chunk)
+            chunks.append(digest)
+            if digest not in known:
+                directory = os.path.join(self._chunks_dir, digest[:2])
+                path = os.path.join(directory, digest)
+                self._mkdir(directory)
+                if not self._node_fs.exists(path):
+                    self._node_fs.upload(path, io.BytesIO(chunk))
+                    stats['stored'] += 1
+                    stats['storedBytes'] += len(chunk)
+                known.add(digest)
+            if self._rate_limit:
+                # stay under the rate limit so the backup doesn't starve the daemon
+                delay = stats['bytes'] / self._rate_limit - (time.time() - started)
+                if delay > 0:
+                    gevent.sleep(delay)
+
+        files = []
+        for path in self._walk(source):
+            chunks = []
+            writer = _ChunkWriter(self._chunk_size, store)
+            self._node_fs.download(path, writer)
+            writer.flush()
+            files.append({
+                'path': os.path.relpath(path, source),
+                'chunks': chunks,
+            })
+
+        manifest = {
+            'created': int(started),
+            'chunkSize': self._chunk_size,
+            'files': files,
+            'stats': stats,
+        }
+        name = '%d.json' % manifest['created']
+        self._node_fs.upload(os.path.join(self._manifests_dir, name),
+                             io.BytesIO(j.data.serializer.json.dumps(manifest).encode()))
+        manifest['name'] = name
+        return manifest
+
+    def _load_chunk(self, digest):
+        buffer = io.BytesIO()
+        self._node_fs.download(os.path.join(self._chunks_dir, digest[:2], digest), buffer)
+        chunk = buffer.getvalue()
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise RuntimeError("chunk %s is corrupt" % digest)
+        return chunk
+
+    def restore(self, name, target):
+        """Write the files of the backup name under target.
+
+        Every chunk is verified against its sha256 before it is written.
+        """
+        self._mkdir(target)
+        for entry in self.load_manifest(name)['files']:
+            path = os.path.join(target, entry['path'])
+            self._mkdir(os.path.dirname(path))
+            self._node_fs.upload(path, _ChunkReader(entry['chunks'], self._load_chunk))
+
+    def prune(self, keep):
+        """Remove all but the last keep manifests and the chunks only they referenced."""
+        manifests = self.manifests()
+        if len(manifests) <= keep:
+            return
+        for name in manifests[:-keep]:
+            self._node_fs.remove(os.path.join(self._manifests_dir, name))
+
+        referenced = self._referenced_chunks(manifests[-keep:])
+        self._mkdir(self._chunks_dir)
+        for directory in self._node_fs.list(self._chunks_dir):
+            directory = os.path.join(self._chunks_dir, directory['name'])
+            for chunk in self._node_fs.list(directory):
+                if chunk['name'] not in referenced:
+                    self._node_fs.remove(os.path.join(directory, chunk['name']))
+
+
+class _ResultCache:
+    """Keeps results of daemon calls for a limited time.
+
+    Callers asking for a key that is already being fetched wait for that
+    fetch instead of issuing their own call to the daemon.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._inflight = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, ttl, fetch):
+        """Return the cached result for key or fetch it.
+
+        Arguments:
+            key {str} -- cache key
+            ttl {int} -- seconds a fetched result stays valid, 0 disables caching
+            fetch {callable} -- call producing the result
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            self.hits += 1
+            return entry[1]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return inflight.get()
+
+        self.misses += 1
+        generation = self._generation
+        inflight = AsyncResult()
+        self._inflight[key] = inflight
+        try:
+            result = fetch()
+        except Exception as e:
+            inflight.set_exception(e)
+            raise
+        finally:
+            if self._inflight.get(key) is inflight:
+                del self._inflight[key]
+
+        # don't store results fetched before an invalidation
+        if ttl > 0 and generation == self._generation:
+            self._entries[key] = (time.time() + ttl, result)
+        inflight.set(result)
+        return result
+
+    def invalidate(self):
+        """Drop all cached results."""
+        self._entries.clear()
+        self._inflight.clear()
+        self._generation += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'entries': len(self._entries),
+        }
 
 
 class BlockCreator(TemplateBase):
@@ -31,7 +358,13 @@ class BlockCreator(TemplateBase):
         # bind uninstall action to the delete method
         self.add_delete_callback(self.uninstall)
         self._node_sal = j.clients.zos.get('local')
+        self._container = None
+        self._container_stats = {'lookups': 0, 'hits': 0, 'invalidations': 0}
         self.__client_sal = None
+        self._cache = _ResultCache()
+
+        if self.data['backupInterval']:
+            self.recurring_action(self._scheduled_backup, self.data['backupInterval'])
 
         # wallet_passphrase = self.data.get('walletPassphrase')
         # if not wallet_passphrase:
@@ -39,11 +372,49 @@ class BlockCreator(TemplateBase):
 
     @property
     def _container_sal(self):
-        return self._node_sal.containers.get(self._container_name)
+        if self._container is None:
+            self._container_stats['lookups'] += 1
+            self._container = self._node_sal.containers.get(self._container_name)
+        else:
+            self._container_stats['hits'] += 1
+        return self._container
+
+    def _invalidate_container(self):
+        """Drop the cached container handle, the next access looks it up again."""
+        if self._container is not None:
+            self._container_stats['invalidations'] += 1
+        self._container = None
+
+    def _container_call(self, call):
+        """Call call with the cached container handle.
+
+        If the call fails the handle is looked up again and the call is retried once.
+        """
+        try:
+            return call(self._container_sal)
+        except Exception:
+            self._invalidate_container()
+            return call(self._container_sal)
+
+    def container_cache_stats(self):
+        """Return counters of the cached container handle.
+
+        lookups are node round-trips, hits are the lookups the cache saved.
+        """
+        return dict(self._container_stats)
 
     @property
     def _container_name(self):
-        return "container-%s" % self.guid
+        return self._slot_container_name(self.data['activeSlot'])
+
+    def _slot_container_name(self, slot):
+        """Name of the container of a deployment slot.
+
+        The blue slot keeps the name used before blue/green upgrades existed.
+        """
+        if slot == 'blue':
+            return "container-%s" % self.guid
+        return "container-%s-%s" % (self.guid, slot)
 
     def get_rpc_addr(self):
         """Get RPC address of the tfchaind server."""
@@ -55,7 +426,7 @@ class BlockCreator(TemplateBase):
         Returns:
             str -- IP for the tfchaind
         """
-        ip = self._container_sal.default_ip("nat0")
+        ip = self._container_call(lambda container: container.default_ip("nat0"))
         return "http://{}:{}".format(str(ip.ip), self.data['apiPort'])
 
     @property
@@ -91,23 +462,81 @@ class BlockCreator(TemplateBase):
             self.__client_sal = j.sal_zos.tfchain.client(**kwargs)
         return self.__client_sal
 
-    def _get_container(self):
-        """Create container object and prepare the filesystem.
+    def _prepare_volumes(self, slot=None):
+        """Create the data and backup volumes on the node.
+
+        slot: deployment slot of the data volume, defaults to the active slot
 
         Returns:
-            Container -- container the service is operating on.
+            tuple -- node paths of the data volume and the backup volume
         """
-        self.state.check("actions", "install", "ok")
+        slot = slot or self.data['activeSlot']
         sp = self._node_sal.storagepools.get('zos-cache')
         fs = sp.get(self.guid)
 
         # prepare persistent volume to mount into the container
         node_fs = self._node_sal.client.filesystem
-        vol = os.path.join(fs.path, 'wallet')
+        vol = os.path.join(fs.path, 'wallet' if slot == 'blue' else 'wallet-%s' % slot)
         node_fs.mkdir(vol)
 
         vol_backup = os.path.join(fs.path, 'backups')
         node_fs.mkdir(vol_backup)
+        return vol, vol_backup
+
+    def _node_bash(self, script):
+        """Run a bash script on the node.
+
+        Returns:
+            str -- stdout of the script
+        """
+        result = self._node_sal.client.bash(script).get()
+        if result.state != 'SUCCESS':
+            raise RuntimeError("node command failed: %s" % result.stderr)
+        return result.stdout
+
+    def _lease_port(self, field):
+        """Lease a host port and keep it in the service data under field.
+
+        An existing lease is reused, so restarts don't need a node round-trip.
+        Candidates come from a single freeports call, ports leased by other
+        services of this robot are skipped. There is no yield between reading
+        the other leases and storing ours, so services starting at the same time
+        never lease the same port.
+
+        Returns:
+            int -- the leased port
+        """
+        if self.data[field]:
+            return self.data[field]
+
+        candidates = self._node_sal.freeports(nrports=_PORT_CANDIDATES)
+        leased = set()
+        for service in self.api.services.find():
+            for service_field in _PORT_FIELDS:
+                if service is self and service_field == field:
+                    continue
+                port = service.data.get(service_field)
+                if port:
+                    leased.add(port)
+
+        for port in candidates:
+            if port not in leased:
+                self.data[field] = port
+                return port
+        raise RuntimeError("can't reserve port.")
+
+    def _get_container(self, slot=None):
+        """Create container object and prepare the filesystem.
+
+        slot: deployment slot of the container, defaults to the active slot
+
+        Returns:
+            Container -- container the service is operating on.
+        """
+        self.state.check("actions", "install", "ok")
+        slot = slot or self.data['activeSlot']
+        with self._span('volumes'):
+            vol, vol_backup = self._prepare_volumes(slot)
 
         mounts = { 
             vol : self._DATA_DIR,
@@ -117,27 +546,66 @@ class BlockCreator(TemplateBase):
         container_data = {
             'flist': self.data['tfchainFlist'],
             'mounts': mounts,
-            'name': self._container_name,
+            'name': self._slot_container_name(slot),
         }
-        freeport = self._node_sal.freeports()
-        if not freeport:
-            raise RuntimeError("can't reserve port.")
-
-        hostRpcPort = self._node_sal.freeports()[0]
+        active = slot == self.data['activeSlot']
+        hostRpcPort = self._lease_port('hostRpcPort' if active else 'standbyRpcPort')
         container_data['ports'] = {
             str(hostRpcPort): self.data['rpcPort'],
         }
         container_data['env'] = self._container_autostart_env
-        return self._node_sal.containers.create(**container_data)
+        with self._span('container'):
+            return self._node_sal.containers.create(**container_data)
+
+    @contextmanager
+    def _span(self, phase):
+        """Record the duration of the enclosed block in the phaseTimings histogram."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._record_timing(phase, time.time() - started)
 
+    def _record_timing(self, phase, duration):
+        for timing in self.data['phaseTimings']:
+            if timing['name'] == phase:
+                break
+        else:
+            timing = {
+                'name': phase,
+                'count': 0,
+                'total': 0.0,
+                'max': 0.0,
+                'buckets': [0] * (len(_TIMING_BUCKETS) + 1),
+            }
+            self.data['phaseTimings'].append(timing)
+
+        timing['count'] += 1
+        timing['total'] += duration
+        timing['max'] = max(timing['max'], duration)
+        timing['buckets'][bisect.bisect_left(_TIMING_BUCKETS, duration)] += 1
+
+    def phase_timings(self):
+        """Return the duration histogram of the install/start/stop/upgrade phases.
+
+        Returns:
+            dict -- upper bounds of the buckets in seconds and the histogram per phase
+        """
+        return {
+            'buckets': list(_TIMING_BUCKETS),
+            'phases': self.data['phaseTimings'],
+        }
+
+    @_timed('install')
     def install(self):
         """Prepare the persistent volume of the wallet."""
         self.logger.info('installing tfchaind %s', self.name)
-        sp = self._node_sal.storagepools.get('zos-cache')
-        try:
-            fs = sp.get(self.guid)
-        except ValueError:
-            fs = sp.create(self.guid)
+        with self._span('storagepool'):
+            sp = self._node_sal.storagepools.get('zos-cache')
+            try:
+                fs = sp.get(self.guid)
+            except ValueError:
+                fs = sp.create(self.guid)
 
         self.state.set('actions', 'install', 'ok')
 
@@ -148,6 +616,7 @@ class BlockCreator(TemplateBase):
         except Exception as e:
             self.logger.warning(
                 "removing container on the uninstall {}".format(e))
+        self._invalidate_container()
         try:
             # cleanup filesystem used by this robot
             sp = self._node_sal.storagepools.get('zos-cache')
@@ -157,12 +626,41 @@ class BlockCreator(TemplateBase):
             # filesystem doesn't exist, nothing else to do
             pass
 
+        # release the leased ports
+        self.data['hostRpcPort'] = 0
+        self.data['standbyRpcPort'] = 0
         self.state.delete('actions', 'install')
 
+    def _prefetch_flist(self, flist):
+        """Make the node download flist while the running container keeps serving.
+
+        A short lived container is created from the flist, which fails if the flist
+        doesn't exist and leaves the flist in the node cache for the real container.
+        """
+        name = "%s-prefetch" % self._container_name
+        # a prefetch container left behind by a failed upgrade would collide with ours
+        self._stop_container(name)
+        self.logger.info('prefetching flist %s', flist)
+        try:
+            # this boots the flist, so its autostart daemon runs briefly without env or mounts
+            self._node_sal.containers.create(name=name, flist=flist)
+        finally:
+            self._stop_container(name)
+
+    def _stop_container(self, name):
+        try:
+            self._node_sal.containers.get(name).stop()
+        except LookupError:
+            # the container doesn't exist
+            pass
+
+    @_timed('upgrade')
     def upgrade(self, tfchainFlist=None):
         """Upgrade the container with an updated flist.
 
-        this is done by stopping the container and respawn again with the updated flist
+        With the recreate upgradeStrategy this is done by stopping the container and respawn
+        again with the updated flist. With the bluegreen upgradeStrategy the updated flist is
+        started next to the running daemon and the service only switches over once it caught up.
 
         tfchainFlist: If provided, the current used flist will be replaced with the specified one
         """
@@ -170,13 +668,165 @@ class BlockCreator(TemplateBase):
         if tfchainFlist:
             self.data['tfchainFlist'] = tfchainFlist
 
+        self._cache.invalidate()
+        if self.data['upgradeStrategy'] == 'bluegreen' and self._is_running():
+            self._blue_green_upgrade()
+            return
+
+        # download the new flist before the outage starts
+        with self._span('prefetch'):
+            self._prefetch_flist(self.data['tfchainFlist'])
         self.stop()
         # restart daemon in new container
         self.start()
 
-    @retry((RuntimeError), tries=5, delay=2, backoff=2)
+    def _blue_green_upgrade(self):
+        """Start the new flist in the inactive slot and switch over once it
+        reached the block height of the running daemon.
+
+        The wallet of the new daemon is recovered from walletSeed while the old one
+        keeps creating blocks, it is only unlocked once the old container stopped and
+        the host rpc port moved to the new container. If the switch fails the old
+        slot is started again.
+        """
+        old_slot = self.data['activeSlot']
+        new_slot = 'green' if old_slot == 'blue' else 'blue'
+        old_container = self._container_sal
+        old_vol, vol_backup = self._prepare_volumes(old_slot)
+        new_vol, _ = self._prepare_volumes(new_slot)
+
+        self.logger.info('starting %s slot of %s', new_slot, self.name)
+        self._node_bash(_BLUE_GREEN_PREPARE_SCRIPT.format(old=old_vol, new=new_vol, backups=vol_backup))
+        container = self._get_container(new_slot)
+        self.data['readinessPhases'] = []
+        try:
+            ip = container.default_ip("nat0")
+            api_addr = "http://{}:{}".format(str(ip.ip), self.data['apiPort'])
+            client = j.sal_zos.tfchain.client(
+                name=self.name,
+                container=container,
+                api_addr=api_addr,
+                wallet_passphrase=self.data['walletPassphrase'],
+            )
+            self._wait_ready('api', client.consensus_stat, time.time() + self.data['readinessTimeout'])
+
+            # let the new daemon sync from the running one
+            old_ip = old_container.default_ip("nat0")
+            client.add_peer(str(old_ip.ip), self.data['rpcPort'])
+
+            def caught_up():
+                height = client.consensus_stat()['height']
+                target = self._client_sal.consensus_stat()['height']
+                if height < target:
+                    raise RuntimeError("at height %s of %s" % (height, target))
+            self._wait_ready('sync', caught_up, time.time() + self.data['syncTimeout'])
+
+            # a locked wallet doesn't create blocks, both daemons can hold it
+            self._wallet_api(api_addr, '/wallet/init/seed', {
+                'passphrase': self.data['walletPassphrase'],
+                'seed': self.data['walletSeed'],
+            })
+        except Exception:
+            container.stop()
+            self._node_bash("rm -rf {}".format(new_vol))
+            self.data['standbyRpcPort'] = 0
+            raise
+
+        # the outage only lasts from stopping the old container to unlocking the new wallet
+        self.logger.info('switching %s over to the %s slot', self.name, new_slot)
+        old_name = self._container_name
+        ports = self._node_sal.client.container
+        old_container.stop()
+        try:
+            ports.add_portforward(container.id, self.data['hostRpcPort'], self.data['rpcPort'])
+            ports.remove_portforward(container.id, self.data['standbyRpcPort'], self.data['rpcPort'])
+            self._wallet_api(api_addr, '/wallet/unlock', {'passphrase': self.data['walletPassphrase']})
+        except Exception:
+            self.logger.error('switching %s to the %s slot failed, starting the %s slot again',
+                              self.name, new_slot, old_slot)
+            container.stop()
+            self._node_bash("rm -rf {}".format(new_vol))
+            self.data['standbyRpcPort'] = 0
+            self._invalidate_container()
+            self.__client_sal = None
+            self.state.delete('wallet', 'init')
+            self._container = self._get_container(old_slot)
+            self._wallet_init()
+            raise
+
+        self._invalidate_container()
+        self.data['activeSlot'] = new_slot
+        self.data['standbyRpcPort'] = 0
+        self.__client_sal = None
+        self._cache.invalidate()
+        self._container = container
+
+        # free the consensus copy of the old slot
+        self._node_bash("rm -rf {}".format(old_vol))
+        self._notify_container_renamed(old_name, self._container_name)
+
+    def _wallet_api(self, api_addr, path, data):
+        """Post a wallet call to the daemon api at api_addr, the tfchain client
+        has no call to recover a wallet from its seed."""
+        resp = requests.post(api_addr + path, data=data, headers=_API_HEADERS,
+                             timeout=self.data['readinessTimeout'])
+        if resp.status_code >= 400:
+            raise RuntimeError("wallet call %s failed: %s" % (path, resp.text))
+
+    def _notify_container_renamed(self, old_name, new_name):
+        """Point the peer_discovery services of this robot using the container
+        old_name to new_name.
+
+        The action is only scheduled, waiting for it could block on their running actions.
+        """
+        for service in self.api.services.find():
+            if service.template_uid.name == PEER_DISCOVERY_TEMPLATE_NAME and service.data.get('container') == old_name:
+                self.logger.info('pointing %s to container %s', service.name, new_name)
+                service.schedule_action('set_container', args={'container': new_name})
+
+    def _wait_ready(self, phase, probe, deadline):
+        """Call probe until it stops raising RuntimeError.
+
+        Retries use an exponential backoff bounded by _READINESS_MAX_DELAY,
+        the time spent is recorded under phase in readinessPhases.
+
+        Arguments:
+            phase {str} -- name of the readiness phase
+            probe {callable} -- call that succeeds once the phase is done
+            deadline {float} -- timestamp after which we give up
+
+        Returns:
+            the result of probe
+        """
+        started = time.time()
+        delay = _READINESS_MIN_DELAY
+        while True:
+            try:
+                result = probe()
+            except RuntimeError as e:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError("tfchaind %s not ready before the deadline: %s" % (phase, e))
+                self.logger.info("tfchaind %s not ready yet: %s", phase, str(e))
+                gevent.sleep(min(delay, remaining))
+                delay = min(delay * 2, _READINESS_MAX_DELAY)
+            else:
+                break
+
+        duration = time.time() - started
+        self.data['readinessPhases'].append({
+            'name': phase,
+            'duration': duration,
+        })
+        self._record_timing(phase, duration)
+        return result
+
     def _wallet_init(self):
-        """Initialize the wallet with a new seed and password."""
+        """Initialize the wallet with a new seed and password.
+
+        Waits for the daemon API to be reachable before initializing the wallet,
+        both phases share the readinessTimeout deadline.
+        """
         try:
             self.state.check('wallet', 'init', 'ok')
             return
@@ -185,29 +835,173 @@ class BlockCreator(TemplateBase):
 
         self.logger.info('initializing wallet %s', self.name)
         self.logger.info("wallet endpoint: %s", self._client_sal._curl.addr)
-        while True:
-            try:
-                self._client_sal.wallet_init()
-            except RuntimeError as e:
-                self.logger.info("wallet not initialized yet: %s", str(e))
-                gevent.sleep(1)
-            else:
-                break
+        deadline = time.time() + self.data['readinessTimeout']
+        self._wait_ready('api', self._client_sal.consensus_stat, deadline)
+        self._wait_ready('wallet', self._client_sal.wallet_init, deadline)
         self.data['walletSeed'] = self._client_sal.recovery_seed
         self.state.set('wallet', 'init', 'ok')
 
+    def _is_running(self):
+        try:
+            self.state.check('status', 'running', 'ok')
+            return True
+        except StateCheckError:
+            return False
+
+    def snapshot(self):
+        """Write a compressed and checksummed snapshot of the consensus database
+        to the backups volume.
+
+        The daemon is stopped while the snapshot is taken so the database is consistent
+        and started again afterwards. Only the last snapshotsKeep snapshots are kept.
+
+        Returns:
+            str -- name of the snapshot
+        """
+        self.state.check('actions', 'install', 'ok')
+        running = self._is_running()
+        if running:
+            self.stop()
+
+        try:
+            vol, vol_backup = self._prepare_volumes()
+            name = 'consensus-%d.tar.gz' % int(time.time())
+            self.logger.info('writing consensus snapshot %s of %s', name, self.name)
+            self._node_bash(_SNAPSHOT_SCRIPT.format(
+                data=vol, backups=vol_backup, name=name, first_removed=max(self.data['snapshotsKeep'], 1) + 1))
+        finally:
+            if running:
+                self.start()
+
+        self.data['lastSnapshot'] = name
+        return name
+
+    def restore(self, snapshot=None):
+        """Seed the data volume with a consensus snapshot.
+
+        The checksum of the snapshot is verified before the current consensus
+        database is replaced. Can only be done while the daemon is stopped.
+
+        snapshot: name of a snapshot in the backups volume or absolute path of a snapshot
+            on the node, defaults to the latest snapshot in the backups volume
+
+        Returns:
+            str -- path of the restored snapshot
+        """
+        self.state.check('actions', 'install', 'ok')
+        if self._is_running():
+            raise RuntimeError("can't restore a snapshot while tfchaind is running")
+
+        vol, vol_backup = self._prepare_volumes()
+        if not snapshot:
+            snapshot = self._node_bash(
+                "ls -1t {}/consensus-*.tar.gz 2> /dev/null | head -n 1".format(vol_backup)).strip()
+            if not snapshot:
+                raise RuntimeError("no snapshot found in %s" % vol_backup)
+        path = os.path.join(vol_backup, snapshot)
+
+        self.logger.info('restoring consensus snapshot %s for %s', path, self.name)
+        self._node_bash(_RESTORE_SCRIPT.format(
+            data=vol, directory=os.path.dirname(path), name=os.path.basename(path)))
+        return path
+
+    def backup(self):
+        """Store an incremental backup of the data volume in the backups volume.
+
+        The backup is read from a btrfs snapshot of the service filesystem, so the daemon
+        keeps running. Only chunks that aren't stored yet are written, only the last
+        backupsKeep backups are kept.
+
+        Returns:
+            dict -- name and statistics of the backup
+        """
+        self.state.check('actions', 'install', 'ok')
+        vol, vol_backup = self._prepare_volumes()
+        filesystem = os.path.dirname(vol_backup)
+        snapshot = os.path.join(filesystem, _BACKUP_SNAPSHOT_DIR)
+        self._node_bash(_BACKUP_SNAPSHOT_SCRIPT.format(filesystem=filesystem, snapshot=snapshot))
+        try:
+            store = _ChunkStore(self._node_sal.client.filesystem, vol_backup,
+                                self.data['backupChunkSize'], self.data['backupRateLimit'])
+            manifest = store.backup(os.path.join(snapshot, os.path.relpath(vol, filesystem)))
+            store.prune(max(self.data['backupsKeep'], 1))
+        finally:
+            self._node_bash(_BACKUP_SNAPSHOT_DELETE_SCRIPT.format(snapshot=snapshot))
+        self.logger.info('backup %s of %s stored %d of %d chunks', manifest['name'], self.name,
+                         manifest['stats']['stored'], manifest['stats']['chunks'])
+        return {'name': manifest['name'], 'stats': manifest['stats']}
+
+    def restore_backup(self, name=None):
+        """Rebuild the data volume from a backup.
+
+        The files are written next to the data volume, which is only replaced once
+        every chunk is verified and written. Can only be done while the daemon is stopped.
+
+        name: name of the backup, defaults to the latest backup
+
+        Returns:
+            str -- name of the restored backup
+        """
+        self.state.check('actions', 'install', 'ok')
+        if self._is_running():
+            raise RuntimeError("can't restore a backup while tfchaind is running")
+
+        vol, vol_backup = self._prepare_volumes()
+        store = _ChunkStore(self._node_sal.client.filesystem, vol_backup,
+                            self.data['backupChunkSize'], self.data['backupRateLimit'])
+        if not name:
+            manifests = store.manifests()
+            if not manifests:
+                raise RuntimeError("no backup found in %s" % vol_backup)
+            name = manifests[-1]
+
+        self.logger.info('restoring backup %s for %s', name, self.name)
+        restored = '%s-restore' % vol
+        self._node_bash("rm -rf %s" % restored)
+        try:
+            store.restore(name, restored)
+        except Exception:
+            self._node_bash("rm -rf %s" % restored)
+            raise
+        self._node_bash(_RESTORE_BACKUP_SWAP_SCRIPT.format(data=vol, restored=restored))
+        return name
+
+    def _scheduled_backup(self):
+        try:
+            self.state.check('actions', 'install', 'ok')
+        except StateCheckError:
+            return
+        self.backup()
+
+    @_timed('start')
     def start(self):
-        """Start container and initialize unencrypted wallet."""
+        """Start container and initialize unencrypted wallet.
+
+        If bootstrapSnapshot is set and the data volume has no consensus database yet,
+        the snapshot is restored before the daemon starts.
+        """
         self.state.check('actions', 'install', 'ok')
-        container = self._get_container()
+        if self.data['bootstrapSnapshot']:
+            vol, _ = self._prepare_volumes()
+            if not self._node_sal.client.filesystem.exists(os.path.join(vol, 'consensus')):
+                self.restore(self.data['bootstrapSnapshot'])
+        started = time.time()
+        self._container = self._get_container()
+        self.data['readinessPhases'] = [{
+            'name': 'container',
+            'duration': time.time() - started,
+        }]
         self.state.set('status', 'running', 'ok')
         self._wallet_init()
         self.state.set('actions', 'start', 'ok')
 
+    @_timed('stop')
     def stop(self):
         """Stop tfchain daemon container."""
         self.logger.info('Stopping tfchain daemon %s', self.name)
-        self._container_sal.stop()
+        self._container_call(lambda container: container.stop())
+        self._invalidate_container()
+        self._cache.invalidate()
         self.state.delete('status', 'running')
         self.state.delete('actions', 'start')
         self.state.delete('wallet', 'init')
@@ -226,14 +1020,14 @@ class BlockCreator(TemplateBase):
         """Return the amount of token in the wallet."""
         self.state.check('wallet', 'init', 'ok')
         self.state.check('status', 'running', 'ok')
-        return self._client_sal.wallet_amount()
+        return self._cache.get('wallet_amount', self.data['walletAmountCacheTTL'], self._client_sal.wallet_amount)
 
     @retry((RuntimeError), tries=3, delay=2, backoff=2)
     def consensus_stat(self):
         """Return information about the state of consensus."""
         self.state.check('wallet', 'init', 'ok')
         self.state.check('status', 'running', 'ok')
-        return self._client_sal.consensus_stat()
+        return self._cache.get('consensus_stat', self.data['consensusStatCacheTTL'], self._client_sal.consensus_stat)
 
     @retry((RuntimeError), tries=3, delay=2, backoff=2)
     def report(self):
@@ -249,6 +1043,9 @@ class BlockCreator(TemplateBase):
         """
         self.state.check('wallet', 'init', 'ok')
         self.state.check('status', 'running', 'ok')
+        return self._cache.get('report', self.data['reportCacheTTL'], self._report)
+
+    def _report(self):
         report = self._client_sal.get_report()
 
         report["network"] = self.data["network"]
@@ -259,3 +1056,7 @@ class BlockCreator(TemplateBase):
             report["connected_peers"] = int(peers)
 
         return report
+
+    def cache_stats(self):
+        """Return hit/miss counters of the report/consensus_stat/wallet_amount cache."""
+        return self._cache.stats()
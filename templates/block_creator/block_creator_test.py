@@ -10,9 +10,58 @@ from JumpscaleZrobot.test.utils import ZrobotBaseTest
 from zerorobot.template.state import StateCheckError
 from zerorobot import service_collection as scol
 import gevent
+from gevent.event import Event
+from jumpscale import j
 from block_creator import BlockCreator
 
 
+class FakeNodeFilesystem:
+    """In memory stand-in for the node filesystem client."""
+
+    def __init__(self, files):
+        self.files = dict(files)
+        self.scripts = []
+
+    def mkdir(self, path):
+        pass
+
+    def exists(self, path):
+        return path in self.files
+
+    def list(self, path):
+        prefix = path.rstrip('/') + '/'
+        entries = {}
+        for file in self.files:
+            if file.startswith(prefix):
+                name, _, rest = file[len(prefix):].partition('/')
+                entries[name] = bool(rest)
+        return [{'name': name, 'is_dir': is_dir} for name, is_dir in entries.items()]
+
+    def download(self, path, writer):
+        writer.write(self.files[path])
+
+    def upload(self, path, reader):
+        self.files[path] = reader.read()
+
+    def remove(self, path):
+        del self.files[path]
+
+    def bash(self, script):
+        """Stand-in for _node_bash, takes and deletes the btrfs snapshots of the backup scripts."""
+        self.scripts.append(script)
+        for line in script.splitlines():
+            words = line.split()
+            if 'snapshot' in words and '-r' in words:
+                source, target = words[-2:]
+                for file in [f for f in self.files if f.startswith(source + '/') and not f.startswith(target + '/')]:
+                    self.files[target + file[len(source):]] = self.files[file]
+            elif 'delete' in words:
+                target = words[words.index('delete') + 1].rstrip(';')
+                for file in [f for f in self.files if f.startswith(target + '/')]:
+                    del self.files[file]
+        return ''
+
+
 def mockdecorator(func):
     def wrapper(*args, **kwargs):
         return func(*args, **kwargs)
@@ -37,7 +86,25 @@ class TestBlockCreatorTemplate(ZrobotBaseTest):
             'walletPassphrase': '',
             'walletAddr': '',
             'network': 'devnet',
-            'tfchainFlist': 'https://hub.grid.tf/tf-autobuilder/threefoldfoundation-tfchain-tfchain-autostart-master_faucetexplorerautobuild.flist'
+            'readinessTimeout': 600,
+            'readinessPhases': [],
+            'reportCacheTTL': 10,
+            'consensusStatCacheTTL': 10,
+            'walletAmountCacheTTL': 10,
+            'bootstrapSnapshot': '',
+            'snapshotsKeep': 3,
+            'lastSnapshot': '',
+            'backupInterval': 0,
+            'backupChunkSize': 4,
+            'backupRateLimit': 0,
+            'backupsKeep': 2,
+            'upgradeStrategy': 'recreate',
+            'syncTimeout': 3600,
+            'activeSlot': 'blue',
+            'hostRpcPort': 0,
+            'standbyRpcPort': 0,
+            'tfchainFlist': 'https://hub.grid.tf/tf-autobuilder/threefoldfoundation-tfchain-tfchain-autostart-master_faucetexplorerautobuild.flist',
+            'phaseTimings': [],
         }
 
     def setUp(self):
@@ -132,7 +199,13 @@ class TestBlockCreatorTemplate(ZrobotBaseTest):
 
         bc._node_sal.client.filesystem = MagicMock()
         bc.state.set("actions", "install", "ok")
+        bc._node_sal.freeports = MagicMock(return_value=[2000, 2001])
+        bc.api = MagicMock()
+        bc.api.services.find.return_value = [bc]
         bc._get_container()
+        bc._node_sal.freeports.assert_called_once()
+        assert bc._node_sal.containers.create.call_args[1]['ports']['2000'] == 23112
+        assert bc.data['hostRpcPort'] == 2000
 
         bc._node_sal.client.filesystem.mkdir.assert_has_calls([mock.call('mypath/wallet'),
                                                                mock.call('mypath/backups')])
@@ -206,22 +279,185 @@ class TestBlockCreatorTemplate(ZrobotBaseTest):
         bc = BlockCreator('bc', data=self.valid_data)
         bc.stop = MagicMock()
         bc.start = MagicMock()
+
+        def prefetch(**kwargs):
+            # the old container must keep running while the flist is fetched
+            assert not bc.stop.called
+            return MagicMock()
+        bc._node_sal.containers.create = MagicMock(side_effect=prefetch)
+        bc._node_sal.containers.get = MagicMock()
         bc.upgrade("myflist")
+        bc._node_sal.containers.create.assert_called_once_with(
+            name="container-{}-prefetch".format(bc.guid), flist="myflist")
+        # a leftover prefetch container is stopped before, ours after
+        bc._node_sal.containers.get.assert_called_with("container-{}-prefetch".format(bc.guid))
+        assert bc._node_sal.containers.get.return_value.stop.call_count == 2
         bc.stop.assert_called_once()
         bc.start.assert_called_once()
         assert bc.data['tfchainFlist'] == 'myflist'
 
+    def test_upgrade_prefetch_failed(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.stop = MagicMock()
+        bc._node_sal.containers.create = MagicMock(side_effect=RuntimeError("flist not found"))
+        bc._node_sal.containers.get = MagicMock()
+        with pytest.raises(RuntimeError):
+            bc.upgrade("myflist")
+        # the prefetch container is cleaned up and the running daemon untouched
+        assert bc._node_sal.containers.get.return_value.stop.call_count == 2
+        assert not bc.stop.called
+
+    def _bluegreen_block_creator(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['upgradeStrategy'] = 'bluegreen'
+        bc.data['walletSeed'] = 'myseed'
+        bc.data['hostRpcPort'] = 2000
+        bc.data['standbyRpcPort'] = 3000
+        bc.state.set('status', 'running', 'ok')
+        bc.state.set('wallet', 'init', 'ok')
+        bc.stop = MagicMock()
+        bc.start = MagicMock()
+        bc._prepare_volumes = MagicMock(side_effect=lambda slot: ('mypath/' + slot, 'mypath/backups'))
+        bc._node_bash = MagicMock()
+        bc._node_sal = MagicMock()
+        bc._container = MagicMock()
+        bc._wallet_init = MagicMock()
+        old_client = MagicMock()
+        old_client.consensus_stat.return_value = {'height': 10}
+        bc._BlockCreator__client_sal = old_client
+        new_client = j.sal_zos.tfchain.client.return_value
+        new_client.consensus_stat = MagicMock(side_effect=[{}, {'height': 5}, {'height': 10}])
+        return bc
+
+    @patch('requests.post')
+    def test_upgrade_bluegreen(self, post):
+        post.return_value.status_code = 200
+        bc = self._bluegreen_block_creator()
+        old_container = bc._container
+        new_container = MagicMock()
+        new_container.default_ip.return_value.ip = '10.0.0.2'
+        bc._get_container = MagicMock(return_value=new_container)
+        discovery = MagicMock()
+        discovery.template_uid.name = 'peer_discovery'
+        discovery.data = {'container': "container-{}".format(bc.guid)}
+        other = MagicMock()
+        other.template_uid.name = 'peer_discovery'
+        other.data = {'container': 'other'}
+        bc.api = MagicMock()
+        bc.api.services.find.return_value = [bc, discovery, other]
+
+        bc.upgrade("myflist")
+
+        assert not bc.stop.called
+        assert not bc.start.called
+        assert not bc._wallet_init.called
+        bc._get_container.assert_called_once_with('green')
+        # the wallet is recovered locked while the old daemon runs and unlocked after it stopped
+        api_addr = "http://10.0.0.2:{}".format(bc.data['apiPort'])
+        assert [c[0] for c in post.call_args_list] == [
+            (api_addr + '/wallet/init/seed',), (api_addr + '/wallet/unlock',)]
+        assert post.call_args_list[0][1]['data']['seed'] == 'myseed'
+        old_container.stop.assert_called_once()
+        assert not new_container.stop.called
+        ports = bc._node_sal.client.container
+        ports.add_portforward.assert_called_once_with(new_container.id, 2000, bc.data['rpcPort'])
+        ports.remove_portforward.assert_called_once_with(new_container.id, 3000, bc.data['rpcPort'])
+        scripts = [c[0][0] for c in bc._node_bash.call_args_list]
+        assert scripts[-1] == 'rm -rf mypath/blue'
+        assert bc.data['activeSlot'] == 'green'
+        assert bc.data['hostRpcPort'] == 2000
+        assert bc.data['standbyRpcPort'] == 0
+        assert bc._container_sal is new_container
+        assert bc._container_name == "container-{}-green".format(bc.guid)
+        bc.state.check('wallet', 'init', 'ok')
+        assert [p['name'] for p in bc.data['readinessPhases']] == ['api', 'sync']
+        discovery.schedule_action.assert_called_once_with(
+            'set_container', args={'container': "container-{}-green".format(bc.guid)})
+        assert not other.schedule_action.called
+
+    @patch('requests.post')
+    def test_upgrade_bluegreen_switch_failed(self, post):
+        post.side_effect = [MagicMock(status_code=200), MagicMock(status_code=500, text='locked')]
+        bc = self._bluegreen_block_creator()
+        old_container = bc._container
+        new_container = MagicMock()
+        restarted = MagicMock()
+        bc._get_container = MagicMock(side_effect=[new_container, restarted])
+        bc.api = MagicMock()
+        bc.api.services.find.return_value = [bc]
+
+        with pytest.raises(RuntimeError):
+            bc.upgrade("myflist")
+
+        old_container.stop.assert_called_once()
+        new_container.stop.assert_called_once()
+        assert bc._get_container.call_args_list == [call('green'), call('blue')]
+        bc._wallet_init.assert_called_once()
+        scripts = [c[0][0] for c in bc._node_bash.call_args_list]
+        assert scripts[-1] == 'rm -rf mypath/green'
+        assert 'rm -rf mypath/blue' not in scripts
+        assert bc.data['activeSlot'] == 'blue'
+        assert bc.data['hostRpcPort'] == 2000
+        assert bc.data['standbyRpcPort'] == 0
+        assert bc._container_sal is restarted
+
+    def test_upgrade_bluegreen_sync_timeout(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['upgradeStrategy'] = 'bluegreen'
+        bc.data['syncTimeout'] = 0
+        bc.state.set('status', 'running', 'ok')
+        bc._prepare_volumes = MagicMock(side_effect=lambda slot: ('mypath/' + slot, 'mypath/backups'))
+        bc._node_bash = MagicMock()
+        container = MagicMock()
+        bc._get_container = MagicMock(return_value=container)
+        old_client = MagicMock()
+        old_client.consensus_stat.return_value = {'height': 10}
+        bc._BlockCreator__client_sal = old_client
+        j.sal_zos.tfchain.client.return_value.consensus_stat = MagicMock(return_value={'height': 5})
+
+        with pytest.raises(RuntimeError):
+            bc.upgrade("myflist")
+        container.stop.assert_called_once()
+        bc._node_bash.assert_called_with('rm -rf mypath/green')
+        assert bc.data['activeSlot'] == 'blue'
+
     def test_wallet_init_unregistered_wallet_endpoint(self):
         bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['readinessPhases'] = []
         bc.stop = MagicMock()
         side_effects = [RuntimeError(), True]
         bc._client_sal.wallet_init = MagicMock(side_effect=side_effects)
         bc._client_sal.recovery_seed = "dmdm"
         bc._wallet_init()
-        bc._client_sal.wallet_init.call_count == 2
+        assert bc._client_sal.wallet_init.call_count == 2
+
+    def test_wallet_init_waits_for_api(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['readinessPhases'] = []
+        bc._client_sal.consensus_stat = MagicMock(
+            side_effect=[RuntimeError(), RuntimeError(), {}])
+        bc._client_sal.wallet_init = MagicMock()
+        bc._client_sal.recovery_seed = "dmdm"
+        bc._wallet_init()
+        assert bc._client_sal.consensus_stat.call_count == 3
+        gevent.sleep.assert_has_calls([call(1), call(2)])
+        assert [p['name'] for p in bc.data['readinessPhases']] == ['api', 'wallet']
+
+    def test_wallet_init_deadline(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['readinessTimeout'] = 0
+        bc.data['readinessPhases'] = []
+        bc._client_sal.consensus_stat = MagicMock(side_effect=RuntimeError())
+        bc._client_sal.wallet_init = MagicMock()
+        with pytest.raises(RuntimeError):
+            bc._wallet_init()
+        assert not bc._client_sal.wallet_init.called
+        with pytest.raises(StateCheckError):
+            bc.state.check("wallet", "init", "ok")
 
     def test_wallet_init_first_time(self):
         bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['readinessPhases'] = []
         bc.stop = MagicMock()
         bc._client_sal.wallet_init = MagicMock()
         bc._client_sal.recovery_seed = "dmdm"
@@ -310,3 +546,322 @@ class TestBlockCreatorTemplate(ZrobotBaseTest):
 
         with pytest.raises(StateCheckError):
             bc.report()
+
+    def test_report_cached(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set("wallet", "init", "ok")
+        bc.state.set("status", "running", "ok")
+        bc._client_sal.get_report = MagicMock(return_value={})
+
+        assert bc.report() == bc.report()
+        bc._client_sal.get_report.assert_called_once()
+        assert bc.cache_stats()['hits'] == 1
+        assert bc.cache_stats()['misses'] == 1
+
+    def test_report_cache_disabled(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['reportCacheTTL'] = 0
+        bc.state.set("wallet", "init", "ok")
+        bc.state.set("status", "running", "ok")
+        bc._client_sal.get_report = MagicMock(return_value={})
+
+        bc.report()
+        bc.report()
+        assert bc._client_sal.get_report.call_count == 2
+
+    def test_report_concurrent_callers_coalesced(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set("wallet", "init", "ok")
+        bc.state.set("status", "running", "ok")
+        release = Event()
+
+        def get_report():
+            release.wait()
+            return {}
+        bc._client_sal.get_report = MagicMock(side_effect=get_report)
+
+        callers = [gevent.spawn(bc.report) for _ in range(5)]
+        gevent.idle()
+        release.set()
+        gevent.joinall(callers)
+
+        bc._client_sal.get_report.assert_called_once()
+        assert bc.cache_stats()['coalesced'] == 4
+
+    def test_stop_invalidates_cache(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set("wallet", "init", "ok")
+        bc.state.set("status", "running", "ok")
+        bc._client_sal.consensus_stat = MagicMock(return_value='something')
+        bc.consensus_stat()
+
+        bc.stop()
+        bc.state.set("wallet", "init", "ok")
+        bc.state.set("status", "running", "ok")
+        bc.consensus_stat()
+        assert bc._client_sal.consensus_stat.call_count == 2
+
+    def test_snapshot_running(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc.state.set('status', 'running', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('mypath/wallet', 'mypath/backups'))
+        bc._node_bash = MagicMock()
+        bc.stop = MagicMock()
+        bc.start = MagicMock()
+
+        name = bc.snapshot()
+
+        bc.stop.assert_called_once()
+        bc.start.assert_called_once()
+        script = bc._node_bash.call_args[0][0]
+        assert 'tar -czf mypath/backups/{}.partial consensus'.format(name) in script
+        assert 'sha256sum {}'.format(name) in script
+        assert bc.data['lastSnapshot'] == name
+
+    def test_snapshot_failure_restarts_daemon(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc.state.set('status', 'running', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('mypath/wallet', 'mypath/backups'))
+        bc._node_bash = MagicMock(side_effect=RuntimeError())
+        bc.stop = MagicMock()
+        bc.start = MagicMock()
+
+        with pytest.raises(RuntimeError):
+            bc.snapshot()
+        bc.start.assert_called_once()
+
+    def test_restore_latest(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/mypath/wallet', '/mypath/backups'))
+        bc._node_bash = MagicMock(side_effect=['/mypath/backups/consensus-1.tar.gz\n', ''])
+
+        assert bc.restore() == '/mypath/backups/consensus-1.tar.gz'
+        script = bc._node_bash.call_args[0][0]
+        assert 'sha256sum -c consensus-1.tar.gz.sha256' in script
+        assert 'tar -xzf consensus-1.tar.gz -C /mypath/wallet' in script
+
+    def test_restore_running(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc.state.set('status', 'running', 'ok')
+        with pytest.raises(RuntimeError):
+            bc.restore('consensus-1.tar.gz')
+
+    def test_start_bootstrap_snapshot(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['bootstrapSnapshot'] = '/mnt/snapshots/consensus-1.tar.gz'
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('mypath/wallet', 'mypath/backups'))
+        bc._node_sal.client.filesystem.exists = MagicMock(return_value=False)
+        bc._get_container = MagicMock()
+        bc._wallet_init = MagicMock()
+        bc.restore = MagicMock()
+
+        bc.start()
+        bc.restore.assert_called_once_with('/mnt/snapshots/consensus-1.tar.gz')
+
+    def test_backup_stores_changed_chunks_only(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({
+            '/fs/wallet/consensus/consensus.db': b'aaaabbbbcccc',
+            '/fs/wallet/gateway/nodes.json': b'dddd',
+        })
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+
+        first = bc.backup()
+        assert first['stats']['stored'] == 4
+
+        node_fs.files['/fs/wallet/consensus/consensus.db'] = b'aaaaxxxxcccc'
+        with patch('time.time', MagicMock(return_value=2e9)):
+            second = bc.backup()
+        assert second['stats']['chunks'] == 4
+        assert second['stats']['stored'] == 1
+
+    def test_backup_reads_snapshot(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc.state.set('status', 'running', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({'/fs/wallet/consensus/consensus.db': b'aaaa'})
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+        bc.stop = MagicMock()
+        bc.start = MagicMock()
+
+        download = node_fs.download = MagicMock(side_effect=node_fs.download)
+        bc.backup()
+
+        # the running daemon isn't interrupted, the snapshot is read instead of the live volume
+        assert not bc.stop.called
+        assert not bc.start.called
+        download.assert_any_call('/fs/.backup-snapshot/wallet/consensus/consensus.db', mock.ANY)
+        assert 'ionice -c3 nice -n 19 btrfs subvolume snapshot -r /fs /fs/.backup-snapshot' in node_fs.scripts[0]
+        assert 'btrfs subvolume delete /fs/.backup-snapshot' in node_fs.scripts[-1]
+        assert not [f for f in node_fs.files if f.startswith('/fs/.backup-snapshot/')]
+
+    def test_backup_failed_deletes_snapshot(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({'/fs/wallet/consensus/consensus.db': b'aaaa'})
+        node_fs.upload = MagicMock(side_effect=RuntimeError())
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+
+        with pytest.raises(RuntimeError):
+            bc.backup()
+        assert 'btrfs subvolume delete /fs/.backup-snapshot' in node_fs.scripts[-1]
+
+    def test_backup_prunes_old_backups(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['backupsKeep'] = 1
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({'/fs/wallet/consensus/consensus.db': b'aaaa'})
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+
+        bc.backup()
+        node_fs.files['/fs/wallet/consensus/consensus.db'] = b'bbbb'
+        with patch('time.time', MagicMock(return_value=2e9)):
+            bc.backup()
+
+        manifests = [f for f in node_fs.files if f.startswith('/fs/backups/manifests/')]
+        chunks = [f for f in node_fs.files if f.startswith('/fs/backups/chunks/')]
+        assert manifests == ['/fs/backups/manifests/2000000000.json']
+        assert len(chunks) == 1
+
+    def test_backup_not_installed(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        with pytest.raises(StateCheckError):
+            bc.backup()
+
+    def test_restore_backup_latest(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({
+            '/fs/wallet/consensus/consensus.db': b'aaaa',
+            '/fs/wallet/wallet/wallet.db': b'',
+        })
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+        bc.backup()
+        node_fs.files['/fs/wallet/consensus/consensus.db'] = b'aaaabbbbcc'
+        with patch('time.time', MagicMock(return_value=2e9)):
+            bc.backup()
+        node_fs.files['/fs/wallet/consensus/consensus.db'] = b'torn'
+
+        assert bc.restore_backup() == '2000000000.json'
+        assert node_fs.files['/fs/wallet-restore/consensus/consensus.db'] == b'aaaabbbbcc'
+        assert node_fs.files['/fs/wallet-restore/wallet/wallet.db'] == b''
+        assert 'mv /fs/wallet-restore /fs/wallet' in node_fs.scripts[-1]
+
+    def test_restore_backup_corrupt_chunk(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({'/fs/wallet/consensus/consensus.db': b'aaaa'})
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+        name = bc.backup()['name']
+        chunk = next(f for f in node_fs.files if f.startswith('/fs/backups/chunks/'))
+        node_fs.files[chunk] = b'bbbb'
+
+        with pytest.raises(RuntimeError):
+            bc.restore_backup(name)
+        # the data volume is left alone
+        assert node_fs.scripts[-1] == 'rm -rf /fs/wallet-restore'
+
+    def test_restore_backup_running(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc.state.set('status', 'running', 'ok')
+        with pytest.raises(RuntimeError):
+            bc.restore_backup()
+
+    def test_lease_port_skips_leased_ports(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        other = MagicMock()
+        other.data = {'hostRpcPort': 2000}
+        bc.api = MagicMock()
+        bc.api.services.find.return_value = [other, bc]
+        bc._node_sal.freeports = MagicMock(return_value=[2000, 2001])
+
+        assert bc._lease_port('hostRpcPort') == 2001
+        assert bc.data['hostRpcPort'] == 2001
+
+    def test_lease_port_reused(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['hostRpcPort'] = 2005
+        bc._node_sal.freeports = MagicMock()
+
+        assert bc._lease_port('hostRpcPort') == 2005
+        assert not bc._node_sal.freeports.called
+
+    def test_lease_port_none_free(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.api = MagicMock()
+        bc.api.services.find.return_value = [bc]
+        bc._node_sal.freeports = MagicMock(return_value=[])
+
+        with pytest.raises(RuntimeError):
+            bc._lease_port('hostRpcPort')
+
+    def test_container_handle_cached(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc._node_sal.containers.get = MagicMock()
+
+        assert bc._container_sal is bc._container_sal
+        bc._node_sal.containers.get.assert_called_once_with(bc._container_name)
+        assert bc.container_cache_stats() == {'lookups': 1, 'hits': 1, 'invalidations': 0}
+
+    def test_stop_invalidates_container_handle(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc._node_sal.containers.get = MagicMock()
+        bc.stop()
+        bc._container_sal
+        assert bc._node_sal.containers.get.call_count == 2
+        assert bc.container_cache_stats()['invalidations'] == 1
+
+    def test_container_call_revalidates_handle(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        stale = MagicMock()
+        stale.default_ip = MagicMock(side_effect=RuntimeError())
+        fresh = MagicMock()
+        bc._node_sal.containers.get = MagicMock(side_effect=[stale, fresh])
+
+        bc.get_api_addr()
+        assert fresh.default_ip.called
+        assert bc._container_sal is fresh
+
+    def test_phase_timings(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['phaseTimings'] = []
+        with bc._span('container'):
+            pass
+        with patch('time.time', MagicMock(side_effect=[0, 20])):
+            with bc._span('container'):
+                pass
+
+        timings = bc.phase_timings()
+        assert timings['buckets'][-1] == 900
+        [timing] = timings['phases']
+        assert timing['name'] == 'container'
+        assert timing['count'] == 2
+        assert timing['max'] == 20
+        assert timing['buckets'][0] == 1
+        assert timing['buckets'][5] == 1
+
+    def test_stop_timed(self):
+        bc = BlockCreator('bc', data=self.valid_data)
+        bc.data['phaseTimings'] = []
+        bc.api = MagicMock()
+        bc.stop()
+        assert [timing['name'] for timing in bc.phase_timings()['phases']] == ['stop']
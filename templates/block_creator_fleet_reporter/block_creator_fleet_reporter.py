@@ -0,0 +1,84 @@
+import time
+
+import gevent
+from gevent.pool import Pool
+
+from zerorobot.service_collection import ServiceNotFoundError
+from zerorobot.template.base import TemplateBase
+
+BLOCK_CREATOR_TEMPLATE_UID = 'github.com/threefoldfoundation/tfchain-templates/block_creator/0.0.2'
+
+
+class BlockCreatorFleetReporter(TemplateBase):
+    version = '0.0.2'
+    template_name = 'block_creator_fleet_reporter'
+
+    def validate(self):
+        for prop in ('poolSize', 'reportTimeout'):
+            if not self.data[prop]:
+                raise ValueError("%s must be greater than 0" % prop)
+
+    def _block_creator_names(self):
+        if self.data['blockCreators']:
+            return list(self.data['blockCreators'])
+        return [service.name for service in self.api.services.find(template_uid=BLOCK_CREATOR_TEMPLATE_UID)]
+
+    def _report_one(self, name):
+        """Gather the report of a single block creator.
+
+        Returns:
+            tuple -- (name, report, error), error is None when the report was gathered
+        """
+        timeout = self.data['reportTimeout']
+        try:
+            with gevent.Timeout(timeout):
+                block_creator = self.api.services.get(template_uid=BLOCK_CREATOR_TEMPLATE_UID, name=name)
+                task = block_creator.schedule_action('report')
+                task.wait()
+        except gevent.Timeout:
+            return name, None, "report timed out after %ss" % timeout
+        except ServiceNotFoundError:
+            return name, None, "service not found"
+        except Exception as e:
+            return name, None, str(e)
+
+        if task.state != 'ok':
+            return name, None, "report task ended in state %s" % task.state
+        return name, task.result, None
+
+    def report(self, blockCreators=None):
+        """Gather the reports of many block creators concurrently.
+
+        blockCreators: names of the block creators to report on, defaults to the
+        blockCreators of the schema or to all block creators of this robot.
+
+        Returns:
+            dict -- reports per block creator, failed block creators with the reason
+            and a summary of the run
+        """
+        names = blockCreators or self._block_creator_names()
+        self.logger.info("gathering reports of %d block creators", len(names))
+
+        started = time.time()
+        pool = Pool(self.data['poolSize'])
+        results = pool.map(self._report_one, names)
+
+        reports = {}
+        failed = {}
+        for name, report, error in results:
+            if error is None:
+                reports[name] = report
+            else:
+                self.logger.warning("report of block creator %s failed: %s", name, error)
+                failed[name] = error
+
+        return {
+            'reports': reports,
+            'failed': failed,
+            'summary': {
+                'total': len(names),
+                'ok': len(reports),
+                'failed': len(failed),
+                'duration': time.time() - started,
+            },
+        }
@@ -0,0 +1,92 @@
+import os
+import pytest
+from unittest.mock import MagicMock, patch
+from JumpscaleZrobot.test.utils import ZrobotBaseTest
+from zerorobot.service_collection import ServiceNotFoundError
+import gevent
+from block_creator_fleet_reporter import BlockCreatorFleetReporter
+
+BLOCK_CREATOR_TEMPLATE_UID = 'github.com/threefoldfoundation/tfchain-templates/block_creator/0.0.2'
+
+
+def block_creator_mock(state='ok', result=None, wait=None):
+    task = MagicMock()
+    task.state = state
+    task.result = result
+    if wait:
+        task.wait = MagicMock(side_effect=wait)
+    service = MagicMock()
+    service.schedule_action = MagicMock(return_value=task)
+    return service
+
+
+class TestBlockCreatorFleetReporterTemplate(ZrobotBaseTest):
+    @classmethod
+    def setUpClass(cls):
+        super().preTest(os.path.dirname(__file__), BlockCreatorFleetReporter)
+        cls.valid_data = {
+            'blockCreators': [],
+            'poolSize': 20,
+            'reportTimeout': 60,
+        }
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_create_valid_data(self):
+        fleet = BlockCreatorFleetReporter(name='fleet', data=self.valid_data)
+        fleet.validate()
+        assert fleet.data == self.valid_data
+
+    def test_create_invalid_data(self):
+        data = self.valid_data.copy()
+        data['poolSize'] = 0
+        fleet = BlockCreatorFleetReporter(name='fleet', data=data)
+        with pytest.raises(ValueError):
+            fleet.validate()
+
+    def test_report_all_block_creators(self):
+        fleet = BlockCreatorFleetReporter('fleet', data=self.valid_data)
+        services = {
+            'bc1': block_creator_mock(result={'block_height': 1}),
+            'bc2': block_creator_mock(result={'block_height': 2}),
+        }
+        fleet.api = MagicMock()
+        fleet.api.services.find.return_value = [MagicMock(), MagicMock()]
+        fleet.api.services.find.return_value[0].name = 'bc1'
+        fleet.api.services.find.return_value[1].name = 'bc2'
+        fleet.api.services.get = MagicMock(side_effect=lambda template_uid, name: services[name])
+
+        result = fleet.report()
+
+        fleet.api.services.find.assert_called_once_with(template_uid=BLOCK_CREATOR_TEMPLATE_UID)
+        assert result['reports'] == {'bc1': {'block_height': 1}, 'bc2': {'block_height': 2}}
+        assert result['failed'] == {}
+        assert result['summary']['ok'] == 2
+
+    def test_report_partial_failures(self):
+        fleet = BlockCreatorFleetReporter('fleet', data=self.valid_data)
+        fleet.data['reportTimeout'] = 0.01
+        services = {
+            'ok': block_creator_mock(result={}),
+            'error': block_creator_mock(state='error'),
+            'slow': block_creator_mock(wait=lambda: gevent.sleep(1)),
+        }
+
+        def get(template_uid, name):
+            if name not in services:
+                raise ServiceNotFoundError()
+            return services[name]
+        fleet.api = MagicMock()
+        fleet.api.services.get = MagicMock(side_effect=get)
+
+        result = fleet.report(blockCreators=['ok', 'error', 'slow', 'missing'])
+
+        assert list(result['reports']) == ['ok']
+        assert set(result['failed']) == {'error', 'slow', 'missing'}
+        assert result['summary'] == {
+            'total': 4,
+            'ok': 1,
+            'failed': 3,
+            'duration': result['summary']['duration'],
+        }
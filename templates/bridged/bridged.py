@@ -1,13 +1,25 @@
+import hashlib
+import io
+import bisect
+import functools
 import os
 import time
+from contextlib import contextmanager
 from random import shuffle
 
+import gevent
+
 from jumpscale import j
 from zerorobot.service_collection import ServiceNotFoundError
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.decorator import retry
 from zerorobot.template.state import StateCheckError
 
+# number of free ports asked to the node when leasing a port
+_PORT_CANDIDATES = 10
+# service data fields holding leased host ports
+_PORT_FIELDS = ('hostRpcPort', 'standbyRpcPort')
+
 ALT_STARTUP_TEMPLATE = """
 
 [startup.bridged]
@@ -21,6 +33,214 @@ args = ["--rpc-addr={BRIDGED_RPC_ADDR}",
 """
 
 
+# upper bounds in seconds of the buckets of the phase duration histogram,
+# durations above the last bound are counted in an extra bucket
+_TIMING_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+
+def _timed(phase):
+    """Record the duration of the decorated action in the phaseTimings histogram."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self._span(phase):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# backups chunk a read-only btrfs snapshot of the service filesystem, it is taken
+# atomically while the daemon keeps running so the databases in it are crash-consistent
+_BACKUP_SNAPSHOT_DIR = '.backup-snapshot'
+_BACKUP_SNAPSHOT_SCRIPT = """set -e
+if [ -d {snapshot} ]; then ionice -c3 nice -n 19 btrfs subvolume delete {snapshot}; fi
+ionice -c3 nice -n 19 btrfs subvolume snapshot -r {filesystem} {snapshot}
+"""
+_BACKUP_SNAPSHOT_DELETE_SCRIPT = """set -e
+ionice -c3 nice -n 19 btrfs subvolume delete {snapshot}
+"""
+
+# a restored backup is written next to the data volume and only swapped in once complete
+_RESTORE_BACKUP_SWAP_SCRIPT = """set -e
+rm -rf {data}
+mv {restored} {data}
+"""
+
+
+class _ChunkWriter:
+    """Splits a stream written to it in chunks and hands them to a callback."""
+
+    def __init__(self, chunk_size, on_chunk):
+        self._chunk_size = chunk_size
+        self._on_chunk = on_chunk
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= self._chunk_size:
+            self._on_chunk(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+
+    def flush(self):
+        if self._buffer:
+            self._on_chunk(bytes(self._buffer))
+            self._buffer = bytearray()
+
+
+class _ChunkReader:
+    """Reads the concatenated chunks of a file, fetching a chunk only when it is needed."""
+
+    def __init__(self, digests, fetch):
+        self._digests = list(digests)
+        self._fetch = fetch
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while self._digests and (size < 0 or len(self._buffer) < size):
+            self._buffer.extend(self._fetch(self._digests.pop(0)))
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class _ChunkStore:
+    """Deduplicated backups of a directory on the node filesystem.
+
+    Files are split in chunks addressed by their sha256 and stored once under
+    <path>/chunks, every backup writes a manifest under <path>/manifests listing
+    the chunks of every file.
+    """
+
+    def __init__(self, node_fs, path, chunk_size, rate_limit):
+        self._node_fs = node_fs
+        self._chunks_dir = os.path.join(path, 'chunks')
+        self._manifests_dir = os.path.join(path, 'manifests')
+        self._chunk_size = chunk_size
+        self._rate_limit = rate_limit
+        self._dirs = set()
+
+    def _mkdir(self, path):
+        if path not in self._dirs:
+            self._node_fs.mkdir(path)
+            self._dirs.add(path)
+
+    def _walk(self, path):
+        for entry in self._node_fs.list(path):
+            entry_path = os.path.join(path, entry['name'])
+            if entry['is_dir']:
+                yield from self._walk(entry_path)
+            else:
+                yield entry_path
+
+    def manifests(self):
+        """Names of the stored manifests, oldest first."""
+        self._mkdir(self._manifests_dir)
+        return sorted(entry['name'] for entry in self._node_fs.list(self._manifests_dir))
+
+    def load_manifest(self, name):
+        buffer = io.BytesIO()
+        self._node_fs.download(os.path.join(self._manifests_dir, name), buffer)
+        return j.data.serializer.json.loads(buffer.getvalue().decode())
+
+    def _referenced_chunks(self, names):
+        chunks = set()
+        for name in names:
+            for entry in self.load_manifest(name)['files']:
+                chunks.update(entry['chunks'])
+        return chunks
+
+    def backup(self, source):
+        """Store the chunks of all files under source that aren't stored yet.
+
+        Returns:
+            dict -- manifest of the backup
+        """
+        manifests = self.manifests()
+        known = self._referenced_chunks(manifests[-1:])
+        stats = {'chunks': 0, 'stored': 0, 'bytes': 0, 'storedBytes': 0}
+        started = time.time()
+
+        def store(chunk):
+            digest = hashlib.sha256(chunk).hexdigest()
+            stats['chunks'] += 1
+            stats['bytes'] += len(chunk)
+            chunks.append(digest)
+            if digest not in known:
+                directory = os.path.join(self._chunks_dir, digest[:2])
+                path = os.path.join(directory, digest)
+                self._mkdir(directory)
+                if not self._node_fs.exists(path):
+                    self._node_fs.upload(path, io.BytesIO(chunk))
+                    stats['stored'] += 1
+                    stats['storedBytes'] += len(chunk)
+                known.add(digest)
+            if self._rate_limit:
+                # stay under the rate limit so the backup doesn't starve the daemon
+                delay = stats['bytes'] / self._rate_limit - (time.time() - started)
+                if delay > 0:
+                    gevent.sleep(delay)
+
+        files = []
+        for path in self._walk(source):
+            chunks = []
+            writer = _ChunkWriter(self._chunk_size, store)
+            self._node_fs.download(path, writer)
+            writer.flush()
+            files.append({
+                'path': os.path.relpath(path, source),
+                'chunks': chunks,
+            })
+
+        manifest = {
+            'created': int(started),
+            'chunkSize': self._chunk_size,
+            'files': files,
+            'stats': stats,
+        }
+        name = '%d.json' % manifest['created']
+        self._node_fs.upload(os.path.join(self._manifests_dir, name),
+                             io.BytesIO(j.data.serializer.json.dumps(manifest).encode()))
+        manifest['name'] = name
+        return manifest
+
+    def _load_chunk(self, digest):
+        buffer = io.BytesIO()
+        self._node_fs.download(os.path.join(self._chunks_dir, digest[:2], digest), buffer)
+        chunk = buffer.getvalue()
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise RuntimeError("chunk %s is corrupt" % digest)
+        return chunk
+
+    def restore(self, name, target):
+        """Write the files of the backup name under target.
+
+        Every chunk is verified against its sha256 before it is written.
+        """
+        self._mkdir(target)
+        for entry in self.load_manifest(name)['files']:
+            path = os.path.join(target, entry['path'])
+            self._mkdir(os.path.dirname(path))
+            self._node_fs.upload(path, _ChunkReader(entry['chunks'], self._load_chunk))
+
+    def prune(self, keep):
+        """Remove all but the last keep manifests and the chunks only they referenced."""
+        manifests = self.manifests()
+        if len(manifests) <= keep:
+            return
+        for name in manifests[:-keep]:
+            self._node_fs.remove(os.path.join(self._manifests_dir, name))
+
+        referenced = self._referenced_chunks(manifests[-keep:])
+        self._mkdir(self._chunks_dir)
+        for directory in self._node_fs.list(self._chunks_dir):
+            directory = os.path.join(self._chunks_dir, directory['name'])
+            for chunk in self._node_fs.list(directory):
+                if chunk['name'] not in referenced:
+                    self._node_fs.remove(os.path.join(directory, chunk['name']))
+
+
 class Bridged(TemplateBase):
     version = '0.0.2'
     template_name = 'bridged'
@@ -33,17 +253,51 @@ class Bridged(TemplateBase):
         # bind uninstall action to the delete method
         self.add_delete_callback(self.uninstall)
         self._node_sal = j.clients.zos.get('local')
+        self._container = None
+        self._container_stats = {'lookups': 0, 'hits': 0, 'invalidations': 0}
+
+        if self.data['backupInterval']:
+            self.recurring_action(self._scheduled_backup, self.data['backupInterval'])
 
     @property
     def _container_sal(self):
         """container sal object based on the container_name created by the
-        service.
+        service, cached until the container is stopped or a call on it fails.
 
         Returns:
             Container -- container the service operating on
         """
 
-        return self._node_sal.containers.get(self._container_name)
+        if self._container is None:
+            self._container_stats['lookups'] += 1
+            self._container = self._node_sal.containers.get(self._container_name)
+        else:
+            self._container_stats['hits'] += 1
+        return self._container
+
+    def _invalidate_container(self):
+        """Drop the cached container handle, the next access looks it up again."""
+        if self._container is not None:
+            self._container_stats['invalidations'] += 1
+        self._container = None
+
+    def _container_call(self, call):
+        """Call call with the cached container handle.
+
+        If the call fails the handle is looked up again and the call is retried once.
+        """
+        try:
+            return call(self._container_sal)
+        except Exception:
+            self._invalidate_container()
+            return call(self._container_sal)
+
+    def container_cache_stats(self):
+        """Return counters of the cached container handle.
+
+        lookups are node round-trips, hits are the lookups the cache saved.
+        """
+        return dict(self._container_stats)
 
     @property
     def _container_name(self):
@@ -67,14 +321,12 @@ class Bridged(TemplateBase):
             'BRIDGED_ETHBOOTNODES': self.data['ethbootnodes'],
         }
 
-    def _get_container(self):
-        """Create container object and prepare the filesystem.
+    def _prepare_volumes(self):
+        """Create the data and backup volumes on the node.
 
         Returns:
-            Container -- container the service is operating on.
+            tuple -- node paths of the data volume and the backup volume
         """
-        self.state.check("actions", "install", "ok")
-
         sp = self._node_sal.storagepools.get('zos-cache')
         fs = sp.get(self.guid)
 
@@ -85,6 +337,59 @@ class Bridged(TemplateBase):
 
         vol_backup = os.path.join(fs.path, 'backups')
         node_fs.mkdir(vol_backup)
+        return vol, vol_backup
+
+    def _node_bash(self, script):
+        """Run a bash script on the node.
+
+        Returns:
+            str -- stdout of the script
+        """
+        result = self._node_sal.client.bash(script).get()
+        if result.state != 'SUCCESS':
+            raise RuntimeError("node command failed: %s" % result.stderr)
+        return result.stdout
+
+    def _lease_port(self, field):
+        """Lease a host port and keep it in the service data under field.
+
+        An existing lease is reused, so restarts don't need a node round-trip.
+        Candidates come from a single freeports call, ports leased by other
+        services of this robot are skipped. There is no yield between reading
+        the other leases and storing ours, so services starting at the same time
+        never lease the same port.
+
+        Returns:
+            int -- the leased port
+        """
+        if self.data[field]:
+            return self.data[field]
+
+        candidates = self._node_sal.freeports(nrports=_PORT_CANDIDATES)
+        leased = set()
+        for service in self.api.services.find():
+            for service_field in _PORT_FIELDS:
+                if service is self and service_field == field:
+                    continue
+                port = service.data.get(service_field)
+                if port:
+                    leased.add(port)
+
+        for port in candidates:
+            if port not in leased:
+                self.data[field] = port
+                return port
+        raise RuntimeError("can't reserve port.")
+
+    def _get_container(self):
+        """Create container object and prepare the filesystem.
+
+        Returns:
+            Container -- container the service is operating on.
+        """
+        self.state.check("actions", "install", "ok")
+        with self._span('volumes'):
+            vol, vol_backup = self._prepare_volumes()
 
         mounts = [{
             'source': vol,
@@ -102,11 +407,7 @@ class Bridged(TemplateBase):
             'name': self._container_name,
         }
 
-        freeport = self._node_sal.freeports()
-        if not freeport:
-            raise RuntimeError("can't reserve port.")
-
-        hostRpcPort = self._node_sal.freeports()[0]
+        hostRpcPort = self._lease_port('hostRpcPort')
         container_data['ports'] = {
             str(hostRpcPort): self.data['rpcPort'],
             str(self.data['ethPort']): self.data['ethPort'],
@@ -117,16 +418,41 @@ class Bridged(TemplateBase):
             container_data['config'] = {'/.startup.toml': ALT_STARTUP_TEMPLATE}
 
         container_data['env'] = self._container_autostart_env
-        return self._node_sal.containers.create(**container_data)
+        with self._span('container'):
+            return self._node_sal.containers.create(**container_data)
 
+    @contextmanager
+    def _span(self, phase):
+        """Record the duration of the enclosed block in the phaseTimings histogram."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - started
+            timing = next((timing for timing in self.data['phaseTimings'] if timing['name'] == phase), None)
+            if timing is None:
+                timing = {'name': phase, 'count': 0, 'total': 0.0, 'max': 0.0,
+                          'buckets': [0] * (len(_TIMING_BUCKETS) + 1)}
+                self.data['phaseTimings'].append(timing)
+            timing['count'] += 1
+            timing['total'] += duration
+            timing['max'] = max(timing['max'], duration)
+            timing['buckets'][bisect.bisect_left(_TIMING_BUCKETS, duration)] += 1
+
+    def phase_timings(self):
+        """Return the bucket bounds in seconds and the phaseTimings histogram."""
+        return {'buckets': list(_TIMING_BUCKETS), 'phases': self.data['phaseTimings']}
+
+    @_timed('install')
     def install(self):
         """prepare presistent volume."""
         self.logger.info('installing bridged {}'.format(self.name))
-        sp = self._node_sal.storagepools.get('zos-cache')
-        try:
-            fs = sp.get(self.guid)
-        except ValueError:
-            fs = sp.create(self.guid)
+        with self._span('storagepool'):
+            sp = self._node_sal.storagepools.get('zos-cache')
+            try:
+                fs = sp.get(self.guid)
+            except ValueError:
+                fs = sp.create(self.guid)
 
         self.state.set('actions', 'install', 'ok')
 
@@ -137,6 +463,7 @@ class Bridged(TemplateBase):
         except Exception as e:
             self.logger.warning(
                 "removing container on the uninstall {}".format(e))
+        self._invalidate_container()
         try:
             # cleanup filesystem used by this robot
             sp = self._node_sal.storagepools.get('zos-cache')
@@ -146,8 +473,34 @@ class Bridged(TemplateBase):
             # filesystem doesn't exist, nothing else to do
             pass
 
+        # release the leased ports
+        self.data['hostRpcPort'] = 0
         self.state.delete('actions', 'install')
 
+    def _prefetch_flist(self, flist):
+        """Make the node download flist while the running container keeps serving.
+
+        A short lived container is created from the flist, which fails if the flist
+        doesn't exist and leaves the flist in the node cache for the real container.
+        """
+        name = "%s-prefetch" % self._container_name
+        # a prefetch container left behind by a failed upgrade would collide with ours
+        self._stop_container(name)
+        self.logger.info('prefetching flist %s', flist)
+        try:
+            # this boots the flist, so its autostart daemon runs briefly without env or mounts
+            self._node_sal.containers.create(name=name, flist=flist)
+        finally:
+            self._stop_container(name)
+
+    def _stop_container(self, name):
+        try:
+            self._node_sal.containers.get(name).stop()
+        except LookupError:
+            # the container doesn't exist
+            pass
+
+    @_timed('upgrade')
     def upgrade(self, bridgedFlist=None):
         """Upgrade the container with an updated bridged flist this is done by
         stopping the container and respawn again with the updated flist.
@@ -158,9 +511,13 @@ class Bridged(TemplateBase):
         if bridgedFlist:
             self.data['bridgedFlist'] = bridgedFlist
 
+        # download the new flist before the outage starts
+        with self._span('prefetch'):
+            self._prefetch_flist(self.data['bridgedFlist'])
         self.stop()
         self.start()
 
+    @_timed('start')
     def start(self):
         """
         Creating bridged container with the provided flist, and configure mounts for datadirs
@@ -170,13 +527,90 @@ class Bridged(TemplateBase):
         """
 
         self.state.check('actions', 'install', 'ok')
-        self._get_container()
+        self._container = self._get_container()
         self.state.set('status', 'running', 'ok')
         self.state.set('actions', 'start', 'ok')
 
+    @_timed('stop')
     def stop(self):
         """stop container."""
 
-        self._container_sal.stop()
+        self._container_call(lambda container: container.stop())
+        self._invalidate_container()
         self.state.delete('status', 'running')
         self.state.delete('actions', 'start')
+
+    def _is_running(self):
+        try:
+            self.state.check('status', 'running', 'ok')
+            return True
+        except StateCheckError:
+            return False
+
+    def backup(self):
+        """Store an incremental backup of the data volume in the backups volume.
+
+        The backup is read from a btrfs snapshot of the service filesystem, so the daemon
+        keeps running. Only chunks that aren't stored yet are written, only the last
+        backupsKeep backups are kept.
+
+        Returns:
+            dict -- name and statistics of the backup
+        """
+        self.state.check('actions', 'install', 'ok')
+        vol, vol_backup = self._prepare_volumes()
+        filesystem = os.path.dirname(vol_backup)
+        snapshot = os.path.join(filesystem, _BACKUP_SNAPSHOT_DIR)
+        self._node_bash(_BACKUP_SNAPSHOT_SCRIPT.format(filesystem=filesystem, snapshot=snapshot))
+        try:
+            store = _ChunkStore(self._node_sal.client.filesystem, vol_backup,
+                                self.data['backupChunkSize'], self.data['backupRateLimit'])
+            manifest = store.backup(os.path.join(snapshot, os.path.relpath(vol, filesystem)))
+            store.prune(max(self.data['backupsKeep'], 1))
+        finally:
+            self._node_bash(_BACKUP_SNAPSHOT_DELETE_SCRIPT.format(snapshot=snapshot))
+        self.logger.info('backup %s of %s stored %d of %d chunks', manifest['name'], self.name,
+                         manifest['stats']['stored'], manifest['stats']['chunks'])
+        return {'name': manifest['name'], 'stats': manifest['stats']}
+
+    def restore_backup(self, name=None):
+        """Rebuild the data volume from a backup.
+
+        The files are written next to the data volume, which is only replaced once
+        every chunk is verified and written. Can only be done while the daemon is stopped.
+
+        name: name of the backup, defaults to the latest backup
+
+        Returns:
+            str -- name of the restored backup
+        """
+        self.state.check('actions', 'install', 'ok')
+        if self._is_running():
+            raise RuntimeError("can't restore a backup while bridged is running")
+
+        vol, vol_backup = self._prepare_volumes()
+        store = _ChunkStore(self._node_sal.client.filesystem, vol_backup,
+                            self.data['backupChunkSize'], self.data['backupRateLimit'])
+        if not name:
+            manifests = store.manifests()
+            if not manifests:
+                raise RuntimeError("no backup found in %s" % vol_backup)
+            name = manifests[-1]
+
+        self.logger.info('restoring backup %s for %s', name, self.name)
+        restored = '%s-restore' % vol
+        self._node_bash("rm -rf %s" % restored)
+        try:
+            store.restore(name, restored)
+        except Exception:
+            self._node_bash("rm -rf %s" % restored)
+            raise
+        self._node_bash(_RESTORE_BACKUP_SWAP_SCRIPT.format(data=vol, restored=restored))
+        return name
+
+    def _scheduled_backup(self):
+        try:
+            self.state.check('actions', 'install', 'ok')
+        except StateCheckError:
+            return
+        self.backup()
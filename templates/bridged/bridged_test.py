@@ -13,6 +13,53 @@ import gevent
 from bridged import Bridged
 
 
+class FakeNodeFilesystem:
+    """In memory stand-in for the node filesystem client."""
+
+    def __init__(self, files):
+        self.files = dict(files)
+        self.scripts = []
+
+    def mkdir(self, path):
+        pass
+
+    def exists(self, path):
+        return path in self.files
+
+    def list(self, path):
+        prefix = path.rstrip('/') + '/'
+        entries = {}
+        for file in self.files:
+            if file.startswith(prefix):
+                name, _, rest = file[len(prefix):].partition('/')
+                entries[name] = bool(rest)
+        return [{'name': name, 'is_dir': is_dir} for name, is_dir in entries.items()]
+
+    def download(self, path, writer):
+        writer.write(self.files[path])
+
+    def upload(self, path, reader):
+        self.files[path] = reader.read()
+
+    def remove(self, path):
+        del self.files[path]
+
+    def bash(self, script):
+        """Stand-in for _node_bash, takes and deletes the btrfs snapshots of the backup scripts."""
+        self.scripts.append(script)
+        for line in script.splitlines():
+            words = line.split()
+            if 'snapshot' in words and '-r' in words:
+                source, target = words[-2:]
+                for file in [f for f in self.files if f.startswith(source + '/') and not f.startswith(target + '/')]:
+                    self.files[target + file[len(source):]] = self.files[file]
+            elif 'delete' in words:
+                target = words[words.index('delete') + 1].rstrip(';')
+                for file in [f for f in self.files if f.startswith(target + '/')]:
+                    del self.files[file]
+        return ''
+
+
 def mockdecorator(func):
     def wrapper(*args, **kwargs):
         return func(*args, **kwargs)
@@ -36,7 +83,13 @@ class TestBridgedTemplate(ZrobotBaseTest):
             'ethPort': 3003,
             'accountJson': '',
             'accountPassword': '',
-            'bridgedFlist': 'https://hub.grid.tf/tf-autobuilder/threefoldfoundation-tfchain-bridged-autostart-master_faucetexplorerautobuild.flist'
+            'backupInterval': 0,
+            'backupChunkSize': 4,
+            'backupRateLimit': 0,
+            'backupsKeep': 7,
+            'hostRpcPort': 0,
+            'bridgedFlist': 'https://hub.grid.tf/tf-autobuilder/threefoldfoundation-tfchain-bridged-autostart-master_faucetexplorerautobuild.flist',
+            'phaseTimings': [],
         }
 
     def setUp(self):
@@ -120,7 +173,13 @@ class TestBridgedTemplate(ZrobotBaseTest):
         bc._node_sal.storagepools.get = MagicMock(return_value=sp)
 
         bc._node_sal.client.filesystem = MagicMock()
+        bc._node_sal.freeports = MagicMock(return_value=[2000, 2001])
+        bc.api = MagicMock()
+        bc.api.services.find.return_value = [bc]
         bc._get_container()
+        bc._node_sal.freeports.assert_called_once()
+        assert bc._node_sal.containers.create.call_args[1]['ports']['2000'] == 23112
+        assert bc.data['hostRpcPort'] == 2000
 
         bc._node_sal.client.filesystem.mkdir.assert_has_calls([mock.call('mypath/wallet'),
                                                                mock.call('mypath/backups')])
@@ -132,6 +191,7 @@ class TestBridgedTemplate(ZrobotBaseTest):
 
         bc.start()
         bc._get_container.assert_called_once()
+        assert bc._container_sal == bc._get_container.return_value
         bc.state.check('status', 'running', 'ok')
         bc.state.check('actions', 'start', 'ok')
 
@@ -189,7 +249,172 @@ class TestBridgedTemplate(ZrobotBaseTest):
         bc = Bridged('bc', data=self.valid_data)
         bc.stop = MagicMock()
         bc.start = MagicMock()
+
+        def prefetch(**kwargs):
+            # the old container must keep running while the flist is fetched
+            assert not bc.stop.called
+            return MagicMock()
+        bc._node_sal.containers.create = MagicMock(side_effect=prefetch)
+        bc._node_sal.containers.get = MagicMock()
+        bc.data['phaseTimings'] = []
         bc.upgrade("myflist")
+        assert [timing['name'] for timing in bc.phase_timings()['phases']] == ['prefetch', 'upgrade']
+        bc._node_sal.containers.create.assert_called_once_with(
+            name="container-{}-prefetch".format(bc.guid), flist="myflist")
+        # a leftover prefetch container is stopped before, ours after
+        bc._node_sal.containers.get.assert_called_with("container-{}-prefetch".format(bc.guid))
+        assert bc._node_sal.containers.get.return_value.stop.call_count == 2
         bc.stop.assert_called_once()
         bc.start.assert_called_once()
         assert bc.data['bridgedFlist'] == 'myflist'
+
+    def test_backup_stores_changed_chunks_only(self):
+        bc = Bridged('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({
+            '/fs/wallet/consensus/consensus.db': b'aaaabbbbcccc',
+            '/fs/wallet/gateway/nodes.json': b'dddd',
+        })
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+
+        first = bc.backup()
+        assert first['stats']['stored'] == 4
+
+        node_fs.files['/fs/wallet/consensus/consensus.db'] = b'aaaaxxxxcccc'
+        with patch('time.time', MagicMock(return_value=2e9)):
+            second = bc.backup()
+        assert second['stats']['chunks'] == 4
+        assert second['stats']['stored'] == 1
+
+    def test_backup_reads_snapshot(self):
+        bc = Bridged('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc.state.set('status', 'running', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({'/fs/wallet/consensus/consensus.db': b'aaaa'})
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+        bc.stop = MagicMock()
+        bc.start = MagicMock()
+
+        download = node_fs.download = MagicMock(side_effect=node_fs.download)
+        bc.backup()
+
+        # the running daemon isn't interrupted, the snapshot is read instead of the live volume
+        assert not bc.stop.called
+        assert not bc.start.called
+        download.assert_any_call('/fs/.backup-snapshot/wallet/consensus/consensus.db', mock.ANY)
+        assert 'ionice -c3 nice -n 19 btrfs subvolume snapshot -r /fs /fs/.backup-snapshot' in node_fs.scripts[0]
+        assert 'btrfs subvolume delete /fs/.backup-snapshot' in node_fs.scripts[-1]
+        assert not [f for f in node_fs.files if f.startswith('/fs/.backup-snapshot/')]
+
+    def test_backup_failed_deletes_snapshot(self):
+        bc = Bridged('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({'/fs/wallet/consensus/consensus.db': b'aaaa'})
+        node_fs.upload = MagicMock(side_effect=RuntimeError())
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+
+        with pytest.raises(RuntimeError):
+            bc.backup()
+        assert 'btrfs subvolume delete /fs/.backup-snapshot' in node_fs.scripts[-1]
+
+    def test_backup_prunes_old_backups(self):
+        bc = Bridged('bc', data=self.valid_data)
+        bc.data['backupsKeep'] = 1
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({'/fs/wallet/consensus/consensus.db': b'aaaa'})
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+
+        bc.backup()
+        node_fs.files['/fs/wallet/consensus/consensus.db'] = b'bbbb'
+        with patch('time.time', MagicMock(return_value=2e9)):
+            bc.backup()
+
+        manifests = [f for f in node_fs.files if f.startswith('/fs/backups/manifests/')]
+        chunks = [f for f in node_fs.files if f.startswith('/fs/backups/chunks/')]
+        assert manifests == ['/fs/backups/manifests/2000000000.json']
+        assert len(chunks) == 1
+
+    def test_backup_not_installed(self):
+        bc = Bridged('bc', data=self.valid_data)
+        with pytest.raises(StateCheckError):
+            bc.backup()
+
+    def test_restore_backup_latest(self):
+        bc = Bridged('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({
+            '/fs/wallet/consensus/consensus.db': b'aaaa',
+            '/fs/wallet/wallet/wallet.db': b'',
+        })
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+        bc.backup()
+        node_fs.files['/fs/wallet/consensus/consensus.db'] = b'aaaabbbbcc'
+        with patch('time.time', MagicMock(return_value=2e9)):
+            bc.backup()
+        node_fs.files['/fs/wallet/consensus/consensus.db'] = b'torn'
+
+        assert bc.restore_backup() == '2000000000.json'
+        assert node_fs.files['/fs/wallet-restore/consensus/consensus.db'] == b'aaaabbbbcc'
+        assert node_fs.files['/fs/wallet-restore/wallet/wallet.db'] == b''
+        assert 'mv /fs/wallet-restore /fs/wallet' in node_fs.scripts[-1]
+
+    def test_restore_backup_corrupt_chunk(self):
+        bc = Bridged('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc._prepare_volumes = MagicMock(return_value=('/fs/wallet', '/fs/backups'))
+        node_fs = FakeNodeFilesystem({'/fs/wallet/consensus/consensus.db': b'aaaa'})
+        bc._node_sal.client.filesystem = node_fs
+        bc._node_bash = node_fs.bash
+        name = bc.backup()['name']
+        chunk = next(f for f in node_fs.files if f.startswith('/fs/backups/chunks/'))
+        node_fs.files[chunk] = b'bbbb'
+
+        with pytest.raises(RuntimeError):
+            bc.restore_backup(name)
+        # the data volume is left alone
+        assert node_fs.scripts[-1] == 'rm -rf /fs/wallet-restore'
+
+    def test_restore_backup_running(self):
+        bc = Bridged('bc', data=self.valid_data)
+        bc.state.set('actions', 'install', 'ok')
+        bc.state.set('status', 'running', 'ok')
+        with pytest.raises(RuntimeError):
+            bc.restore_backup()
+
+    def test_lease_port_skips_leased_ports(self):
+        bc = Bridged('bc', data=self.valid_data)
+        other = MagicMock()
+        other.data = {'hostRpcPort': 2000}
+        bc.api = MagicMock()
+        bc.api.services.find.return_value = [other, bc]
+        bc._node_sal.freeports = MagicMock(return_value=[2000, 2001])
+
+        assert bc._lease_port('hostRpcPort') == 2001
+        assert bc.data['hostRpcPort'] == 2001
+
+    def test_lease_port_reused(self):
+        bc = Bridged('bc', data=self.valid_data)
+        bc.data['hostRpcPort'] = 2005
+        bc._node_sal.freeports = MagicMock()
+
+        assert bc._lease_port('hostRpcPort') == 2005
+        assert not bc._node_sal.freeports.called
+
+    def test_lease_port_none_free(self):
+        bc = Bridged('bc', data=self.valid_data)
+        bc.api = MagicMock()
+        bc.api.services.find.return_value = [bc]
+        bc._node_sal.freeports = MagicMock(return_value=[])
+
+        with pytest.raises(RuntimeError):
+            bc._lease_port('hostRpcPort')
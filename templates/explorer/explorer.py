@@ -1,5 +1,8 @@
+import bisect
+import functools
 import os
 import time
+from contextlib import contextmanager
 import io
 from random import shuffle
 
@@ -12,6 +15,22 @@ from zerorobot.template.state import StateCheckError
 BLOCK_CREATOR_UID = 'github.com/threefoldfoundation/tfchain-templates/block_creator/0.0.2'
 
 
+# upper bounds in seconds of the buckets of the phase duration histogram,
+# durations above the last bound are counted in an extra bucket
+_TIMING_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+
+def _timed(phase):
+    """Record the duration of the decorated action in the phaseTimings histogram."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self._span(phase):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class Explorer(TemplateBase):
     version = '0.0.2'
     template_name = 'explorer'
@@ -23,6 +42,8 @@ class Explorer(TemplateBase):
         # bind uninstall action to the delete method
         self.add_delete_callback(self.uninstall)
         self._node_sal = j.clients.zos.get('local')
+        self._container = None
+        self._container_stats = {'lookups': 0, 'hits': 0, 'invalidations': 0}
         self.__client_sal = None
 
         # wallet_passphrase = self.data.get('walletPassphrase')
@@ -32,12 +53,41 @@ class Explorer(TemplateBase):
     @property
     def _container_sal(self):
         """container sal object based on the container_name created by the
-        service.
+        service, cached until the container is stopped or a call on it fails.
 
         Returns:
             Container -- container the service operating on
         """
-        return self._node_sal.containers.get(self._container_name)
+        if self._container is None:
+            self._container_stats['lookups'] += 1
+            self._container = self._node_sal.containers.get(self._container_name)
+        else:
+            self._container_stats['hits'] += 1
+        return self._container
+
+    def _invalidate_container(self):
+        """Drop the cached container handle, the next access looks it up again."""
+        if self._container is not None:
+            self._container_stats['invalidations'] += 1
+        self._container = None
+
+    def _container_call(self, call):
+        """Call call with the cached container handle.
+
+        If the call fails the handle is looked up again and the call is retried once.
+        """
+        try:
+            return call(self._container_sal)
+        except Exception:
+            self._invalidate_container()
+            return call(self._container_sal)
+
+    def container_cache_stats(self):
+        """Return counters of the cached container handle.
+
+        lookups are node round-trips, hits are the lookups the cache saved.
+        """
+        return dict(self._container_stats)
 
     @property
     def _container_name(self):
@@ -71,18 +121,20 @@ class Explorer(TemplateBase):
         """
         self.state.check("actions", "install", "ok")
 
-        sp = self._node_sal.storagepools.get('zos-cache')
-        try:
-            fs = sp.get(self.guid)
-        except ValueError:
-            fs = sp.create(self.guid)
+        with self._span('storagepool'):
+            sp = self._node_sal.storagepools.get('zos-cache')
+            try:
+                fs = sp.get(self.guid)
+            except ValueError:
+                fs = sp.create(self.guid)
 
         # prepare persistent volume to mount into the container
-        node_fs = self._node_sal.client.filesystem
-        vol = os.path.join(fs.path, 'wallet')
-        node_fs.mkdir(vol)
-        caddy = os.path.join(fs.path, 'caddy-certs')
-        node_fs.mkdir(caddy)
+        with self._span('volumes'):
+            node_fs = self._node_sal.client.filesystem
+            vol = os.path.join(fs.path, 'wallet')
+            node_fs.mkdir(vol)
+            caddy = os.path.join(fs.path, 'caddy-certs')
+            node_fs.mkdir(caddy)
 
         mounts = [
             {
@@ -110,7 +162,8 @@ class Explorer(TemplateBase):
         # remove write_caddyfile calls once this works
         container_data['config'] = {
             '/var/www/explorer/caddy/Caddyfile': self._get_caddyfile()}
-        self._container = self._node_sal.containers.create(**container_data)
+        with self._span('container'):
+            self._container = self._node_sal.containers.create(**container_data)
         return self._container
 
     @property
@@ -142,6 +195,29 @@ class Explorer(TemplateBase):
         except ServiceNotFoundError:
             raise
 
+    @contextmanager
+    def _span(self, phase):
+        """Record the duration of the enclosed block in the phaseTimings histogram."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - started
+            timing = next((timing for timing in self.data['phaseTimings'] if timing['name'] == phase), None)
+            if timing is None:
+                timing = {'name': phase, 'count': 0, 'total': 0.0, 'max': 0.0,
+                          'buckets': [0] * (len(_TIMING_BUCKETS) + 1)}
+                self.data['phaseTimings'].append(timing)
+            timing['count'] += 1
+            timing['total'] += duration
+            timing['max'] = max(timing['max'], duration)
+            timing['buckets'][bisect.bisect_left(_TIMING_BUCKETS, duration)] += 1
+
+    def phase_timings(self):
+        """Return the bucket bounds in seconds and the phaseTimings histogram."""
+        return {'buckets': list(_TIMING_BUCKETS), 'phases': self.data['phaseTimings']}
+
+    @_timed('install')
     def install(self):
         """prepare presistent volume."""
         self.logger.info('installing tftfaucet %s', self.name)
@@ -160,6 +236,7 @@ class Explorer(TemplateBase):
         except Exception as e:
             self.logger.warning(
                 "removing container on the uninstall {}".format(e))
+        self._invalidate_container()
         try:
             # cleanup filesystem used by this robot
             sp = self._node_sal.storagepools.get('zos-cache')
@@ -172,11 +249,13 @@ class Explorer(TemplateBase):
         self._block_creator.schedule_action('uninstall').wait()
         self.state.delete('actions', 'install')
 
+    @_timed('start')
     def start(self):
         """start both tfchain daemon and client."""
         self.state.check('actions', 'install', 'ok')
         self._block_creator.state.check('actions', 'install', 'ok')
-        self._block_creator.schedule_action('start').wait()
+        with self._span('block_creator'):
+            self._block_creator.schedule_action('start').wait()
 
         container = self._get_container()
 
@@ -186,16 +265,42 @@ class Explorer(TemplateBase):
         self.state.set('status', 'running', 'ok')
         self.state.set('actions', 'start', 'ok')
 
+    @_timed('stop')
     def stop(self):
         """stop tftaucet."""
         self.logger.info('Stopping faucet %s', self.name)
-        self._container_sal.stop()
+        self._container_call(lambda container: container.stop())
+        self._invalidate_container()
 
         self._block_creator.schedule_action('stop').wait()
 
         self.state.delete('status', 'running')
         self.state.delete('actions', 'start')
 
+    def _prefetch_flist(self, flist):
+        """Make the node download flist while the running container keeps serving.
+
+        A short lived container is created from the flist, which fails if the flist
+        doesn't exist and leaves the flist in the node cache for the real container.
+        """
+        name = "%s-prefetch" % self._container_name
+        # a prefetch container left behind by a failed upgrade would collide with ours
+        self._stop_container(name)
+        self.logger.info('prefetching flist %s', flist)
+        try:
+            # this boots the flist, so its autostart daemon runs briefly without env or mounts
+            self._node_sal.containers.create(name=name, flist=flist)
+        finally:
+            self._stop_container(name)
+
+    def _stop_container(self, name):
+        try:
+            self._node_sal.containers.get(name).stop()
+        except LookupError:
+            # the container doesn't exist
+            pass
+
+    @_timed('upgrade')
     def upgrade(self, explorerFlist=None):
         """upgrade the container with an updated flist this is done by stopping
         the container and respawn again with the updated flist.
@@ -206,6 +311,9 @@ class Explorer(TemplateBase):
         if explorerFlist:
             self.data['explorerFlist'] = explorerFlist
 
+        # download the new flist before the outage starts
+        with self._span('prefetch'):
+            self._prefetch_flist(self.data['explorerFlist'])
         self.stop()
         # restart daemon in new container
         self.start()
@@ -251,4 +359,4 @@ https://{url} {{
         # location for caddyfile
         config_location = '/var/www/explorer/caddy/Caddyfile'
         # Upload file
-        self._container_sal.upload_content(config_location, template_bytes)
+        self._container_call(lambda container: container.upload_content(config_location, template_bytes))
@@ -41,6 +41,7 @@ class TestFaucetTemplate(ZrobotBaseTest):
             'walletPassphrase': '',
             'walletAddr': '',
             'faucetPort': 8080,
+            'phaseTimings': [],
         }
 
     def setUp(self):
@@ -235,7 +236,21 @@ class TestFaucetTemplate(ZrobotBaseTest):
         bc = Faucet('f', data=self.valid_data)
         bc.stop = MagicMock()
         bc.start = MagicMock()
+
+        def prefetch(**kwargs):
+            # the old container must keep running while the flist is fetched
+            assert not bc.stop.called
+            return MagicMock()
+        bc._node_sal.containers.create = MagicMock(side_effect=prefetch)
+        bc._node_sal.containers.get = MagicMock()
+        bc.data['phaseTimings'] = []
         bc.upgrade("myflist")
+        assert [timing['name'] for timing in bc.phase_timings()['phases']] == ['prefetch', 'upgrade']
+        bc._node_sal.containers.create.assert_called_once_with(
+            name="container-{}-prefetch".format(bc.guid), flist="myflist")
+        # a leftover prefetch container is stopped before, ours after
+        bc._node_sal.containers.get.assert_called_with("container-{}-prefetch".format(bc.guid))
+        assert bc._node_sal.containers.get.return_value.stop.call_count == 2
         bc.stop.assert_called_once()
         bc.start.assert_called_once()
         assert bc.data['faucetFlist'] == 'myflist'
@@ -1,10 +1,17 @@
+import bisect
+import collections
+import functools
 import os
 import time
+from contextlib import contextmanager
 import io
 import requests
+from requests.adapters import HTTPAdapter
+import random
 from random import shuffle
 import uuid
 
+import gevent
 from jumpscale import j
 from zerorobot.service_collection import ServiceNotFoundError
 from zerorobot.template.base import TemplateBase
@@ -24,31 +31,163 @@ args = ["--{GETH_NETWORK}", "--verbosity={GETH_VERBOSITY}",
     "--rpcaddr=0.0.0.0", "--port={GETH_PORT}", "--nodekey"={GETH_NODEKEY}]
 """
 
+# upper bounds in seconds of the buckets of the phase duration histogram,
+# durations above the last bound are counted in an extra bucket
+_TIMING_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+# port of the geth json-rpc api and number of connections kept open to it
+_RPC_PORT = 8545
+_RPC_POOL_SIZE = 4
+
+# path of the prometheus exposition of the geth metrics on the pprof server
+_METRICS_PATH = "/debug/metrics/prometheus"
+
+# json-rpc methods sent in one batch by the health_snapshot action
+_HEALTH_METHODS = ("eth_syncing", "eth_blockNumber", "net_peerCount", "net_version")
+
+# number of sync samples kept to estimate the sync rate
+_SYNC_SAMPLES = 30
+
+# bounds of the automatically sized geth settings, see _tuning
+_AUTO_CACHE_MIN = 256  # MB
+_AUTO_CACHE_MAX = 8192  # MB
+_AUTO_PEERS_PER_CPU = 10
+_AUTO_PEERS_MIN = 25
+_AUTO_PEERS_MAX = 100
+_DEFAULT_TXPOOL_SLOTS = 4096
+
+# tar writes a checkpoint every _SNAPSHOT_CHECKPOINT records of 10KiB,
+# the progress of snapshots is logged every _SNAPSHOT_PROGRESS_INTERVAL seconds
+_SNAPSHOT_CHECKPOINT = 1000
+_SNAPSHOT_RECORD_SIZE = 10240
+_SNAPSHOT_PROGRESS_INTERVAL = 30
+
+# the node key is the identity of the node, it is never part of a snapshot
+_EXPORT_SNAPSHOT_SCRIPT = """set -e
+mkdir -p {directory}
+cd {directory}
+echo {total} > {name}.size
+tar -czf {name}.partial --exclude=geth/nodekey --checkpoint={checkpoint} \
+    --checkpoint-action=exec='echo $TAR_CHECKPOINT > {name}.progress' {sources}
+mv {name}.partial {name}
+sha256sum {name} > {name}.sha256
+rm -f {name}.progress
+stat -c %s {name}
+cut -d ' ' -f 1 {name}.sha256
+"""
+_IMPORT_SNAPSHOT_SCRIPT = """set -e
+cd {directory}
+sha256sum -c {name}.sha256
+rm -rf {data}/geth/chaindata {data}/ancient
+tar -xzf {name} -C {data} --checkpoint={checkpoint} \
+    --checkpoint-action=exec='echo $TAR_CHECKPOINT > {progress}'
+rm -f {progress}
+"""
+# moves the ancient chain data of an imported snapshot to where geth expects it
+_IMPORT_ANCIENT_SCRIPT = """set -e
+mkdir -p {ancient}
+for ancient in {candidates}; do
+    if [ -d $ancient ]; then
+        find {ancient} -mindepth 1 -delete
+        find $ancient -mindepth 1 -maxdepth 1 -exec mv -t {ancient} {{}} +
+        rm -rf $ancient
+    fi
+done
+"""
+
+
+def _timed(phase):
+    """Record the duration of the decorated action in the phaseTimings histogram."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self._span(phase):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class Geth(TemplateBase):
     version = '0.0.2'
     template_name = 'geth'
 
     _DATA_DIR = '/mnt/data'
+    _ANCIENT_DIR = '/mnt/ancient'
 
     def __init__(self, name=None, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
         # bind uninstall action to the delete method
         self.add_delete_callback(self.uninstall)
         self._node_sal = j.clients.zos.get('local')
+        self._container = None
+        self._container_stats = {'lookups': 0, 'hits': 0, 'invalidations': 0}
         self.__client_sal = None
+        self._rpc_session_ = None
+        self._container_ip_ = None
+        self._node_resources_ = None
+        # supervision of the geth process: consecutive restarts, time of the last
+        # restart and time of the pending restart
+        self._crash_streak = 0
+        self._last_restart = 0
+        self._next_restart = None
+        self._next_liveness_check = 0
+        # (timestamp, currentblock, highestblock) of the latest sync checks
+        self._sync_samples = collections.deque(maxlen=_SYNC_SAMPLES)
+        # spread the first sync checks of the services loaded together
+        self._sync_interval = self.data['syncCheckMinInterval']
+        self._next_sync_check = time.time() + random.uniform(0, self._sync_interval)
     
-        # Schedule a recurring action that checks if geth is synced and update state
-        self.recurring_action(self._check_sync, 60)
+        # Schedule a recurring action that checks if geth is synced and update state,
+        # it ticks as often as the shortest sync check interval so idle ticks stay rare
+        self.recurring_action(self._check_sync, max(self.data['syncCheckMinInterval'], 1))
 
     @property
     def _container_sal(self):
         """container sal object based on the container_name created by the
-        service.
+        service, cached until the container is stopped or a call on it fails.
 
         Returns:
             Container -- container the service operating on
         """
-        return self._node_sal.containers.get(self._container_name)
+        if self._container is None:
+            self._container_stats['lookups'] += 1
+            self._container = self._node_sal.containers.get(self._container_name)
+        else:
+            self._container_stats['hits'] += 1
+        return self._container
+
+    def _invalidate_container(self):
+        """Drop the cached container handle, the next access looks it up again."""
+        if self._container is not None:
+            self._container_stats['invalidations'] += 1
+        self._container = None
+        # the container ip might change with the container
+        self._container_ip_ = None
+
+    def _container_call(self, call):
+        """Call call with the cached container handle.
+
+        If the call fails the handle is looked up again and the call is retried once.
+        """
+        try:
+            return call(self._container_sal)
+        except Exception:
+            self._invalidate_container()
+            return call(self._container_sal)
+
+    @property
+    def _container_ip(self):
+        """ip of the container on the default nic, cached with the container handle."""
+        if self._container_ip_ is None:
+            self._container_ip_ = str(self._container_call(lambda container: container.default_ip().ip))
+        return self._container_ip_
+
+    def container_cache_stats(self):
+        """Return counters of the cached container handle.
+
+        lookups are node round-trips, hits are the lookups the cache saved.
+        """
+        return dict(self._container_stats)
 
     @property
     def _container_name(self):
@@ -83,19 +222,19 @@ class Geth(TemplateBase):
         """
         self.state.check("actions", "install", "ok")
 
-        sp = self._node_sal.storagepools.get('zos-cache')
+        with self._span('storagepool'):
+            filesystems = [(self._node_sal.storagepools.get(pool).get(self.guid), subvolume, mountpoint)
+                           for pool, subvolume, mountpoint in self._volumes()]
 
-        fs = sp.get(self.guid)
+        # prepare persistent volumes to mount into the container
+        mounts = {}
+        with self._span('volumes'):
+            node_fs = self._node_sal.client.filesystem
+            for fs, subvolume, mountpoint in filesystems:
+                vol = os.path.join(fs.path, subvolume)
+                node_fs.mkdir(vol)
+                mounts[vol] = mountpoint
 
-        # prepare persistent volume to mount into the container
-        node_fs = self._node_sal.client.filesystem
-        vol = os.path.join(fs.path, self.guid)
-        node_fs.mkdir(vol)
-
-        mounts = {
-            vol: self._DATA_DIR
-        }
-        
 
         container_data = {
             'flist': self.data['gethFlist'],
@@ -108,19 +247,64 @@ class Geth(TemplateBase):
         }
         container_data['env'] = self._container_autostart_env
 
-        self._container = self._node_sal.containers.create(**container_data)
+        with self._span('container'):
+            self._container = self._node_sal.containers.create(**container_data)
         return self._container
 
+    @contextmanager
+    def _span(self, phase):
+        """Record the duration of the enclosed block in the phaseTimings histogram."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - started
+            timing = next((timing for timing in self.data['phaseTimings'] if timing['name'] == phase), None)
+            if timing is None:
+                timing = {'name': phase, 'count': 0, 'total': 0.0, 'max': 0.0,
+                          'buckets': [0] * (len(_TIMING_BUCKETS) + 1)}
+                self.data['phaseTimings'].append(timing)
+            timing['count'] += 1
+            timing['total'] += duration
+            timing['max'] = max(timing['max'], duration)
+            timing['buckets'][bisect.bisect_left(_TIMING_BUCKETS, duration)] += 1
+
+    def phase_timings(self):
+        """Return the bucket bounds in seconds and the phaseTimings histogram."""
+        return {'buckets': list(_TIMING_BUCKETS), 'phases': self.data['phaseTimings']}
+
+    def _volumes(self):
+        """storage pool, subvolume and mountpoint of the persistent volumes of the container.
+
+        The hot chaindata lives in hotStoragePool, the ancient chain data in
+        ancientStoragePool if one is configured.
+        """
+        volumes = [(self.data['hotStoragePool'], self.guid, self._DATA_DIR)]
+        if self.data['ancientStoragePool']:
+            volumes.append((self.data['ancientStoragePool'], 'ancient', self._ANCIENT_DIR))
+        return volumes
+
+    def _storage_pools(self):
+        """names of the storage pools holding the volumes of the service."""
+        pools = []
+        for pool, _, _ in self._volumes():
+            if pool not in pools:
+                pools.append(pool)
+        return pools
+
+    @_timed('install')
     def install(self):
         """
         Creating geth container with the provided flist, and configure mounts for datadirs
             'flist': GETH_FLIST,
         """
-        sp = self._node_sal.storagepools.get('zos-cache')
-        try:
-            fs = sp.get(self.guid)
-        except ValueError:
-            fs = sp.create(self.guid)
+        with self._span('storagepool'):
+            for pool in self._storage_pools():
+                sp = self._node_sal.storagepools.get(pool)
+                try:
+                    sp.get(self.guid)
+                except ValueError:
+                    sp.create(self.guid)
     
         self.logger.info('installing geth %s', self.name)
 
@@ -134,17 +318,20 @@ class Geth(TemplateBase):
         except Exception as e:
             self.logger.warning(
                 "removing container on the uninstall {}".format(e))
-        try:
-            # cleanup filesystem used by this robot
-            sp = self._node_sal.storagepools.get('zos-cache')
-            fs = sp.get(self.guid)
-            fs.delete()
-        except ValueError:
-            # filesystem doesn't exist, nothing else to do
-            pass
+        self._invalidate_container()
+        for pool in self._storage_pools():
+            try:
+                # cleanup filesystem used by this robot
+                sp = self._node_sal.storagepools.get(pool)
+                fs = sp.get(self.guid)
+                fs.delete()
+            except ValueError:
+                # filesystem doesn't exist, nothing else to do
+                pass
 
         self.state.delete('actions', 'install')
 
+    @_timed('start')
     def start(self):
         """starts geth."""
         self.state.check('actions', 'install', 'ok')
@@ -154,14 +341,45 @@ class Geth(TemplateBase):
         self.state.set('status', 'started', 'ok')
         self.state.set('actions', 'start', 'ok')
 
+    @_timed('stop')
     def stop(self):
         """stop geth."""
         self.logger.info('Stopping geth %s', self.name)
-        self._container_sal.stop()
+        self._container_call(lambda container: container.stop())
+        self._invalidate_container()
+        if self._rpc_session_ is not None:
+            self._rpc_session_.close()
+            self._rpc_session_ = None
 
         self.state.delete('status', 'running')
         self.state.delete('actions', 'start')
+        # geth is stopped on purpose, don't restart it
+        self.state.delete('actions', 'run')
+
+    def _prefetch_flist(self, flist):
+        """Make the node download flist while the running container keeps serving.
 
+        A short lived container is created from the flist, which fails if the flist
+        doesn't exist and leaves the flist in the node cache for the real container.
+        """
+        name = "%s-prefetch" % self._container_name
+        # a prefetch container left behind by a failed upgrade would collide with ours
+        self._stop_container(name)
+        self.logger.info('prefetching flist %s', flist)
+        try:
+            # geth only starts from run(), the prefetch container stays idle until stopped
+            self._node_sal.containers.create(name=name, flist=flist)
+        finally:
+            self._stop_container(name)
+
+    def _stop_container(self, name):
+        try:
+            self._node_sal.containers.get(name).stop()
+        except LookupError:
+            # the container doesn't exist
+            pass
+
+    @_timed('upgrade')
     def upgrade(self, gethFlist=None):
         """upgrade the container with an updated flist this is done by stopping
         the container and respawn again with the updated flist.
@@ -172,72 +390,590 @@ class Geth(TemplateBase):
         if gethFlist:
             self.data['gethFlist'] = gethFlist
 
+        # download the new flist before the outage starts
+        with self._span('prefetch'):
+            self._prefetch_flist(self.data['gethFlist'])
         self.stop()
         # restart geth in new container
         self.start()
     
-    def run (self):
-        """runs geth."""
-        # Check if container is started
-        self.state.check('actions', 'start', 'ok')
-    
+    @property
+    def _node_resources(self):
+        """total memory in MB and number of cpus of the node, looked up once."""
+        if self._node_resources_ is None:
+            info = self._node_sal.client.info
+            self._node_resources_ = {
+                'memory': info.mem()['total'] // (1024 * 1024),
+                'cpus': len(info.cpu()),
+            }
+        return self._node_resources_
+
+    def _geth_services(self):
+        """number of geth services on the robot, this one included."""
+        services = [service for service in self.api.services.find()
+                    if service.template_uid.name == self.template_name]
+        return max(len(services), 1)
+
+    def _tuning(self):
+        """cache, maxpeers and txpool settings passed to geth.
+
+        Settings left to 0 in the schema are sized from the node resources, shared
+        evenly by the geth services of the robot: the cache gets a quarter of the
+        memory share, the peer count grows with the cpu share and the txpool grows
+        with the cache.
+        """
+        tuning = {
+            'cache': self.data['cache'],
+            'maxpeers': self.data['maxpeers'],
+            'txpoolSlots': self.data['txpoolSlots'],
+            'txpoolQueue': self.data['txpoolQueue'],
+        }
+        if not all(tuning.values()):
+            resources = self._node_resources
+            services = self._geth_services()
+            if not tuning['cache']:
+                cache = resources['memory'] // services // 4
+                tuning['cache'] = min(max(cache, _AUTO_CACHE_MIN), _AUTO_CACHE_MAX)
+            if not tuning['maxpeers']:
+                maxpeers = resources['cpus'] * _AUTO_PEERS_PER_CPU // services
+                tuning['maxpeers'] = min(max(maxpeers, _AUTO_PEERS_MIN), _AUTO_PEERS_MAX)
+            if not tuning['txpoolSlots']:
+                tuning['txpoolSlots'] = _DEFAULT_TXPOOL_SLOTS * min(max(tuning['cache'] // 1024, 1), 4)
+            if not tuning['txpoolQueue']:
+                tuning['txpoolQueue'] = tuning['txpoolSlots'] // 4
+        return tuning
+
+    def _geth_args(self):
+        """command line arguments of geth."""
         args = ["--rpc", "--{network}".format(**self.data), "--verbosity={verbosity}".format(**self.data),
         "--lightserv={lightserv}".format(**self.data), "--nat={nat}".format(**self.data), "--{v5disc}".format(**self.data), 
         "--syncmode={syncmode}".format(**self.data), "--datadir={datadir}".format(**self.data),
         "--rpcaddr=0.0.0.0", "--port={ethport}".format(**self.data), "--nodekey={nodekey}".format(**self.data)]
 
-        container = self._node_sal.containers.get(self._container_name)
+        tuning = self._tuning()
+        args.extend(["--cache={cache}".format(**tuning), "--maxpeers={maxpeers}".format(**tuning),
+        "--txpool.globalslots={txpoolSlots}".format(**tuning), "--txpool.globalqueue={txpoolQueue}".format(**tuning)])
+        if self.data['ancientStoragePool']:
+            args.append("--datadir.ancient={}".format(self._ANCIENT_DIR))
+        if self.data['metrics']:
+            args.extend(["--metrics", "--pprof", "--pprof.addr=0.0.0.0", "--pprof.port={metricsPort}".format(**self.data)])
+        if self.data['gcmode']:
+            args.append("--gcmode={gcmode}".format(**self.data))
+        return args
+
+    def _host_volumes(self):
+        """path on the node of the persistent volumes, by their mountpoint in the container."""
+        volumes = {}
+        for pool, subvolume, mountpoint in self._volumes():
+            fs = self._node_sal.storagepools.get(pool).get(self.guid)
+            volumes[mountpoint] = os.path.join(fs.path, subvolume)
+        return volumes
+
+    def _snapshot_directory(self):
+        if self.data['snapshotDirectory']:
+            return self.data['snapshotDirectory']
+        fs = self._node_sal.storagepools.get(self.data['hotStoragePool']).get(self.guid)
+        return os.path.join(fs.path, 'snapshots')
+
+    def _node_bash(self, script):
+        """Run a bash script on the node.
+
+        Returns:
+            str -- stdout of the script
+        """
+        result = self._node_sal.client.bash(script).get()
+        if result.state != 'SUCCESS':
+            raise RuntimeError("node command failed: %s" % result.stderr)
+        return result.stdout
+
+    def _node_bash_progress(self, script, progress, total, description):
+        """Run a tar script on the node and log its progress until it finishes.
+
+        progress: file the tar checkpoints are written to
+        total: number of bytes tar has to process
+
+        Returns:
+            str -- stdout of the script
+        """
+        job = self._node_sal.client.bash(script)
+        while job.running:
+            gevent.sleep(_SNAPSHOT_PROGRESS_INTERVAL)
+            checkpoint = self._node_bash("cat {} 2> /dev/null || true".format(progress)).strip()
+            if checkpoint:
+                done = int(checkpoint) * _SNAPSHOT_CHECKPOINT * _SNAPSHOT_RECORD_SIZE
+                self.logger.info('%s of %s: %d of %d MB (%d%%)', description, self.name, done // 1024 ** 2,
+                                 total // 1024 ** 2, min(100 * done // max(total, 1), 100))
+        result = job.get()
+        if result.state != 'SUCCESS':
+            raise RuntimeError("node command failed: %s" % result.stderr)
+        return result.stdout
+
+    def _state_ok(self, category, tag):
+        try:
+            self.state.check(category, tag, 'ok')
+            return True
+        except StateCheckError:
+            return False
+
+    def export_snapshot(self):
+        """Write a compressed and checksummed snapshot of the chain data to the snapshot directory.
+
+        The container is stopped while the snapshot is written so the chain data is
+        consistent, and started again afterwards. The node key isn't part of the snapshot.
+
+        Returns:
+            dict -- path, compressed size, sha256 checksum, uncompressed size and duration of the snapshot
+        """
+        self.state.check('actions', 'install', 'ok')
+        started = self._state_ok('actions', 'start')
+        running = self._state_ok('actions', 'run')
+        if started:
+            self.stop()
+
+        begin = time.time()
+        try:
+            volumes = self._host_volumes()
+            data = volumes[self._DATA_DIR]
+            paths = [os.path.join(data, 'geth')]
+            sources = ['-C', data, 'geth']
+            if self._ANCIENT_DIR in volumes:
+                ancient = volumes[self._ANCIENT_DIR]
+                paths.append(ancient)
+                sources.extend(['-C', os.path.dirname(ancient), os.path.basename(ancient)])
+
+            directory = self._snapshot_directory()
+            name = 'chaindata-%d.tar.gz' % int(begin)
+            self.logger.info('exporting chain data snapshot %s of %s', name, self.name)
+            total = int(self._node_bash("du -sbc {} | tail -n 1 | cut -f 1".format(' '.join(paths))).strip() or 0)
+            size, checksum = self._node_bash_progress(
+                _EXPORT_SNAPSHOT_SCRIPT.format(directory=directory, name=name, total=total,
+                                               sources=' '.join(sources), checkpoint=_SNAPSHOT_CHECKPOINT),
+                progress=os.path.join(directory, name + '.progress'), total=total,
+                description='exporting snapshot').split()
+        finally:
+            if started:
+                self.start()
+            if running:
+                self.run()
+
+        self.data['lastSnapshot'] = os.path.join(directory, name)
+        return {
+            'snapshot': self.data['lastSnapshot'],
+            'size': int(size),
+            'sha256': checksum,
+            'dataSize': total,
+            'duration': time.time() - begin,
+        }
+
+    def import_snapshot(self, snapshot=None):
+        """Seed the persistent volumes with a chain data snapshot.
+
+        The checksum of the snapshot is verified before the current chain data is
+        replaced. Can only be done while geth isn't running.
+
+        snapshot: absolute path of a snapshot on the node or name of a snapshot in the
+            snapshot directory, defaults to the latest snapshot in the snapshot directory
+
+        Returns:
+            dict -- path, uncompressed size and duration of the imported snapshot
+        """
+        self.state.check('actions', 'install', 'ok')
+        if self._state_ok('actions', 'run'):
+            raise RuntimeError("can't import a snapshot while geth is running")
+
+        begin = time.time()
+        directory = self._snapshot_directory()
+        if not snapshot:
+            snapshot = self._node_bash(
+                "ls -1t {}/chaindata-*.tar.gz 2> /dev/null | head -n 1".format(directory)).strip()
+            if not snapshot:
+                raise RuntimeError("no snapshot found in %s" % directory)
+        path = os.path.join(directory, snapshot)
+
+        volumes = self._host_volumes()
+        data = volumes[self._DATA_DIR]
+        total = int(self._node_bash("cat {}.size 2> /dev/null || echo 0".format(path)).strip())
+        self.logger.info('importing chain data snapshot %s for %s', path, self.name)
+        self._node_bash_progress(
+            _IMPORT_SNAPSHOT_SCRIPT.format(directory=os.path.dirname(path), name=os.path.basename(path), data=data,
+                                           checkpoint=_SNAPSHOT_CHECKPOINT, progress=os.path.join(data, 'snapshot.progress')),
+            progress=os.path.join(data, 'snapshot.progress'), total=total, description='importing snapshot')
+        # snapshots hold the ancient data in the ancient directory if they were taken with
+        # an ancient volume, in the chaindata otherwise
+        chaindata_ancient = os.path.join(data, 'geth', 'chaindata', 'ancient')
+        if self._ANCIENT_DIR in volumes:
+            # the ancient volume is mounted in the container, only its content is replaced
+            self._node_bash("find {} -mindepth 1 -delete".format(volumes[self._ANCIENT_DIR]))
+            self._node_bash(_IMPORT_ANCIENT_SCRIPT.format(
+                ancient=volumes[self._ANCIENT_DIR], candidates=' '.join([os.path.join(data, 'ancient'), chaindata_ancient])))
+        else:
+            self._node_bash(_IMPORT_ANCIENT_SCRIPT.format(
+                ancient=chaindata_ancient, candidates=os.path.join(data, 'ancient')))
+
+        return {
+            'snapshot': path,
+            'dataSize': total,
+            'duration': time.time() - begin,
+        }
+
+    def run (self):
+        """runs geth."""
+        # Check if container is started
+        self.state.check('actions', 'start', 'ok')
 
-        if not container.client.filesystem.exists("/mnt/data/bootnode.key"):
+        if self.data['bootstrapSnapshot']:
+            data = self._host_volumes()[self._DATA_DIR]
+            if not self._node_sal.client.filesystem.exists(os.path.join(data, 'geth', 'chaindata')):
+                # seed the empty volume instead of syncing from genesis
+                self.import_snapshot(self.data['bootstrapSnapshot'])
+
+        args = self._geth_args()
+
+        container = self._container_sal
+
+        if not container.client.filesystem.exists(self.data['nodekey']):
             """
                 Generate new bootnode key for this node if it does not exists
             """
-            container.client.system("/sandbox/bin/bootnode -genkey /mnt/data/bootnode.key")
+            container.client.system("/sandbox/bin/bootnode -genkey {}".format(self.data['nodekey']))
+            # the enode of the previous key is no longer valid
+            self.data['enodeId'] = ''
 
         start_cmd = "/sandbox/bin/geth {}".format(' '.join(map(str ,args)))
 
         # Start the geth node process with given args
-        container.client.system(start_cmd)
+        container.client.system(start_cmd, id=self._geth_job_id)
 
+        self._crash_streak = 0
+        self._next_restart = None
+        self.state.delete('status', 'crashloop')
         self.state.set('status', 'running', 'ok')
         self.state.set('actions', 'run', 'ok')
 
+        # compute the enode now, so asking for it later doesn't spawn bootnode
+        self._enode_id()
+
+    @property
+    def _geth_job_id(self):
+        return "geth.%s" % self.guid
+
+    def _geth_running(self):
+        def running(container):
+            try:
+                return len(container.client.job.list(self._geth_job_id)) > 0
+            except RuntimeError:
+                # the job doesn't exist anymore
+                return False
+        return self._container_call(running)
+
+    def _geth_supervised(self):
+        """True if geth was run and isn't left stopped after a crashloop."""
+        if not self._state_ok('actions', 'run'):
+            return False
+        try:
+            # geth is left stopped until run is called again
+            self.state.check('status', 'crashloop', 'error')
+            return False
+        except StateCheckError:
+            return True
+
+    def _supervise(self):
+        """Restart geth if its process exited since run.
+
+        Restarts are delayed by restartBackoff seconds, doubled for every consecutive
+        restart up to restartBackoffMax. After restartLimit consecutive restarts geth is
+        left stopped and the status is set to crashloop. Restarts count as consecutive
+        until geth stays up for restartBackoffMax seconds.
+
+        The process is looked up at most every livenessCheckInterval seconds.
+        """
+        if not self._geth_supervised():
+            return
+
+        now = time.time()
+        if self._next_restart is None:
+            if now < self._next_liveness_check:
+                return
+            self._next_liveness_check = now + self.data['livenessCheckInterval']
+            if self._geth_running():
+                if self._crash_streak and now - self._last_restart > self.data['restartBackoffMax']:
+                    self._crash_streak = 0
+                return
+
+            self.state.delete('status', 'running')
+            if self.data['restartLimit'] and self._crash_streak >= self.data['restartLimit']:
+                self.logger.error('geth %s keeps exiting, giving up after %d restarts', self.name, self._crash_streak)
+                self.state.set('status', 'crashloop', 'error')
+                return
+
+            delay = min(self.data['restartBackoff'] * 2 ** self._crash_streak, self.data['restartBackoffMax'])
+            self.logger.warning('geth %s exited, restarting in %d seconds', self.name, delay)
+            self._next_restart = now + delay
+        if now < self._next_restart:
+            return
+
+        start_cmd = "/sandbox/bin/geth {}".format(' '.join(map(str, self._geth_args())))
+        self._container_call(lambda container: container.client.system(start_cmd, id=self._geth_job_id))
+        self._crash_streak += 1
+        self._last_restart = now
+        self._next_restart = None
+        self.data['restartCount'] += 1
+        self.state.set('status', 'running', 'ok')
+
+    def _enode_id(self):
+        """node id of the enode address, derived from the node key once and stored in enodeId.
+
+        It is computed again if the node key was regenerated or the nodekey setting changed.
+        """
+        if not self.data['enodeId'] or self.data['enodeNodekey'] != self.data['nodekey']:
+            def node_id(container):
+                return container.client.system(
+                    "/sandbox/bin/bootnode -nodekey {} -writeaddress".format(self.data['nodekey'])).get().stdout
+
+            self.data['enodeId'] = self._container_call(node_id).strip("\n")
+            self.data['enodeNodekey'] = self.data['nodekey']
+        return self.data['enodeId']
+
     def get_enode_address(self):
         port=self.data['ethport']
-        container = self._node_sal.containers.get(self._container_name)
-        ip = str(container.default_ip().ip)
-    
-        enode_address = container.client.system("/sandbox/bin/bootnode -nodekey /mnt/data/bootnode.key -writeaddress").get().stdout
-    
-        enode="enode://{}@{}:{}".format(enode_address.strip("\n"), ip, port)
-        return enode
+        # the ip is cached with the container handle and looked up again if the container changes
+        return "enode://{}@{}:{}".format(self._enode_id(), self._container_ip, port)
 
     def get_args(self):
-        args = ["--rpc", "--{network}".format(**self.data), "--verbosity={verbosity}".format(**self.data),
-        "--lightserv={lightserv}".format(**self.data), "--nat={nat}".format(**self.data), "--{v5disc}".format(**self.data), 
-        "--syncmode={syncmode}".format(**self.data), "--datadir={datadir}".format(**self.data),
-        "--rpcaddr=0.0.0.0", "--port={ethport}".format(**self.data), "--nodekey={nodekey}".format(**self.data)]
-        
+        args = self._geth_args()
         start_cmd = "/sandbox/bin/geth {}".format(' '.join(map(str ,args)))
         return start_cmd
 
     def _check_sync(self):
         """
-        recurring function that updates service state with the ethereum syncing state every 60 seconds. ref init
+        recurring function that restarts geth if it exited and updates service state
+        with the ethereum syncing state. ref init
+
+        geth is only queried while it is supervised, once the interval computed by
+        _schedule_sync_check has passed. The interval backs off while geth can't be reached.
         """
-        result = self.get_syncing_status()
-        if result is None:
-            self.state.delete('ethereum','syncing')
-            self.state.delete('ethereum','synced')
+        self._supervise()
+        if not self._geth_supervised() or time.time() < self._next_sync_check:
             return
 
-        currentblock, highestblock = result
-        if currentblock >= highestblock:
-            self.state.set('ethereum','synced', 'ok')
+        previous = self._sync_samples[-1] if self._sync_samples else None
+        try:
+            snapshot = self.health_snapshot()
+        except Exception:
+            self._schedule_sync_check(stable=True)
+            raise
+        self._record_sync_sample(snapshot)
+
+        syncing = False
+        if not snapshot['syncing']:
             self.state.delete('ethereum','syncing')
-        else:
-            self.state.set('ethereum','syncing', 'ok')
             self.state.delete('ethereum','synced')
+        else:
+            currentblock, highestblock = snapshot['currentBlock'], snapshot['highestBlock']
+            if currentblock >= highestblock:
+                self.state.set('ethereum','synced', 'ok')
+                self.state.delete('ethereum','syncing')
+            else:
+                syncing = True
+                self.state.set('ethereum','syncing', 'ok')
+                self.state.delete('ethereum','synced')
+
+        # poll often while geth is catching up or just fell behind,
+        # back off while it is synced or not making progress
+        progressing = previous is None or snapshot['currentBlock'] != previous[1]
+        self._schedule_sync_check(stable=not (syncing and progressing))
+
+    def _schedule_sync_check(self, stable):
+        """Compute the time of the next sync check.
+
+        The interval doubles up to syncCheckMaxInterval while geth is stable and falls back
+        to syncCheckMinInterval otherwise. syncCheckJitter percent of random jitter is added so
+        the checks of many services don't fire together.
+        """
+        minimum = self.data['syncCheckMinInterval']
+        maximum = max(minimum, self.data['syncCheckMaxInterval'])
+        if stable:
+            self._sync_interval = min(max(self._sync_interval * 2, minimum), maximum)
+        else:
+            self._sync_interval = minimum
+
+        jitter = self._sync_interval * self.data['syncCheckJitter'] / 100
+        self._next_sync_check = time.time() + self._sync_interval + random.uniform(-jitter, jitter)
+
+    @property
+    def _rpc_session(self):
+        """requests session used for all json-rpc calls to geth.
+
+        The session keeps its connections to geth open between calls.
+        """
+        if self._rpc_session_ is None:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=_RPC_POOL_SIZE))
+            session.headers.update({"content-type": "application/json"})
+            self._rpc_session_ = session
+        return self._rpc_session_
+
+    def _rpc_post(self, payload):
+        """Post payload to the geth json-rpc api and return the decoded response.
+
+        Connect and read timeouts are taken from rpcConnectTimeout and rpcReadTimeout.
+        """
+        timeout = (self.data['rpcConnectTimeout'], self.data['rpcReadTimeout'])
+        try:
+            url = "http://{}:{}".format(self._container_ip, _RPC_PORT)
+            r = self._rpc_session.post(url=url, data=j.data.serializer.json.dumps(payload), timeout=timeout)
+        except requests.ConnectionError:
+            # look the container ip up again on the next call
+            self._container_ip_ = None
+            raise
+        return r.json()
+
+    def metrics(self):
+        """
+        scrapes the metrics of geth (chain, txpool, database, memory, ...) and adds
+        the state of the service: head block, peers, sync progress and restarts
+        Returns:
+            str -- metrics in the prometheus text exposition format
+        """
+        if not self.data['metrics']:
+            raise RuntimeError("metrics are disabled for geth %s" % self.name)
+
+        timeout = (self.data['rpcConnectTimeout'], self.data['rpcReadTimeout'])
+        try:
+            url = "http://{}:{}{}".format(self._container_ip, self.data['metricsPort'], _METRICS_PATH)
+            r = self._rpc_session.get(url, timeout=timeout)
+        except requests.ConnectionError:
+            # look the container ip up again on the next call
+            self._container_ip_ = None
+            raise
+        r.raise_for_status()
+
+        snapshot = self.health_snapshot()
+        progress = self.sync_progress()
+        gauges = [
+            ('head_block', 'number of the head block', snapshot['blockNumber']),
+            ('highest_block', 'highest block known to the node while syncing', snapshot['highestBlock'] or snapshot['blockNumber']),
+            ('peers', 'number of connected peers', snapshot['peers']),
+            ('syncing', '1 if the node is syncing', int(snapshot['syncing'])),
+            ('sync_blocks_per_second', 'sync rate over the last sync checks', progress['blocksPerSecond'] or 0),
+            ('restarts_total', 'number of times geth was restarted', self.data['restartCount']),
+        ]
+        lines = [r.text.rstrip("\n")]
+        for name, description, value in gauges:
+            lines.append("# HELP geth_service_{} {}".format(name, description))
+            lines.append("# TYPE geth_service_{} gauge".format(name))
+            lines.append("geth_service_{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def _rpc_call(self, method, params=None):
+        """Call method on the geth json-rpc api.
+
+        Returns:
+            the result of the call
+        """
+        request_id = str(uuid.uuid4())
+        payload = {"jsonrpc": "2.0", "method": method, "params": params or [], "id": request_id}
+        response = self._rpc_post(payload)
+        _check_rpc_response(response, request_id)
+        return response["result"]
+
+    def _record_sync_sample(self, snapshot):
+        highestblock = snapshot['highestBlock']
+        if highestblock is None:
+            highestblock = snapshot['currentBlock']
+        self._sync_samples.append((snapshot['timestamp'], snapshot['currentBlock'], highestblock))
+
+    def sync_progress(self):
+        """
+        estimates the sync rate from the samples of the latest sync checks
+        Returns:
+            dict -- with keys:
+                *currentBlock, highestBlock - latest sample, None if there is none yet
+                *blocksPerSecond - sync rate over the sampled window, None if there are less than 2 samples
+                *eta - estimated seconds until synced, None if geth isn't making progress
+                *window - seconds between the oldest and latest sample
+                *samples - number of samples
+        """
+        progress = {
+            'currentBlock': None,
+            'highestBlock': None,
+            'blocksPerSecond': None,
+            'eta': None,
+            'window': 0,
+            'samples': len(self._sync_samples),
+        }
+        if not self._sync_samples:
+            return progress
+
+        first_time, first_block, _ = self._sync_samples[0]
+        last_time, last_block, highestblock = self._sync_samples[-1]
+        progress['currentBlock'] = last_block
+        progress['highestBlock'] = highestblock
+        progress['window'] = last_time - first_time
+
+        if last_block >= highestblock:
+            progress['eta'] = 0
+        if last_time <= first_time:
+            return progress
+
+        rate = (last_block - first_block) / (last_time - first_time)
+        progress['blocksPerSecond'] = rate
+        if last_block < highestblock and rate > 0:
+            progress['eta'] = (highestblock - last_block) / rate
+        return progress
+
+    def _rpc_batch(self, methods):
+        """Call all methods on the geth json-rpc api in one batch request.
+
+        Returns:
+            list -- the results of the calls, in the order of methods
+        """
+        request_ids = [str(uuid.uuid4()) for _ in methods]
+        payload = [{"jsonrpc": "2.0", "method": method, "params": [], "id": request_id}
+                   for method, request_id in zip(methods, request_ids)]
+        responses = self._rpc_post(payload)
+        if not isinstance(responses, list):
+            raise InvalidResponseError(message="expected a batch response", response=responses)
+
+        # the responses of a batch can come in any order
+        by_id = {response.get("id"): response for response in responses}
+        results = []
+        for request_id in request_ids:
+            response = by_id.get(request_id)
+            if response is None:
+                raise InvalidResponseError(message="missing response id %s" % request_id, response=responses)
+            _check_rpc_response(response, request_id)
+            results.append(response["result"])
+        return results
+
+    def health_snapshot(self):
+        """
+        fetches the syncing state, head block, peer count and network id of the
+        ethereum node in one json-rpc batch request
+        Returns:
+            dict -- with keys:
+                *syncing - True if geth is syncing
+                *currentBlock, highestBlock - syncing progress, highestBlock is None if geth isn't syncing
+                *blockNumber - number of the head block
+                *peers - number of connected peers
+                *networkId - ethereum network id
+                *timestamp - time the snapshot was taken
+        """
+        syncing, block_number, peer_count, network_id = self._rpc_batch(_HEALTH_METHODS)
+        block_number = int(block_number, 16)
+        snapshot = {
+            'timestamp': time.time(),
+            'syncing': bool(syncing),
+            'currentBlock': block_number,
+            'highestBlock': None,
+            'blockNumber': block_number,
+            'peers': int(peer_count, 16),
+            'networkId': int(network_id),
+        }
+        if syncing:
+            snapshot['currentBlock'] = int(syncing.get("currentBlock", "0x0"), 16)
+            snapshot['highestBlock'] = int(syncing.get("highestBlock", "0x0"), 16)
+        return snapshot
 
     def get_syncing_status(self):
         """
@@ -246,24 +982,7 @@ class Geth(TemplateBase):
             *None - if geth is not syncing
             *[currentblock, highestblock] - if geth is syncing
         """
-        random_id = str(uuid.uuid4())
-        payload = {"jsonrpc":"2.0","method":"eth_syncing","params":[],"id":random_id}
-        headers = {"content-type": "application/json"}
-        container = self._node_sal.containers.get(self._container_name)
-        ip = str(container.default_ip().ip)
-        r = requests.post(url="http://{}:8545".format(ip), data=j.data.serializer.json.dumps(payload), headers=headers)
-        response = r.json()
-    
-        response_id = response["id"]
-        jsonrpc = response["jsonrpc"]
-
-        if response_id != random_id:
-            raise InvalidResponseError(message="wrong response id", response=response)
-        
-        if jsonrpc != "2.0":
-            raise InvalidResponseError(message="wrong json rpc version", response=response)
-
-        result = response["result"]
+        result = self._rpc_call("eth_syncing")
 
         if not result:
             return None
@@ -272,6 +991,19 @@ class Geth(TemplateBase):
         highestblock = int(result.get("highestBlock", "0x0"), 16)
         return currentblock, highestblock
 
+
+def _check_rpc_response(response, request_id):
+    """Raise InvalidResponseError if response isn't a valid answer to the request with request_id."""
+    if response.get("id") != request_id:
+        raise InvalidResponseError(message="wrong response id", response=response)
+
+    if response.get("jsonrpc") != "2.0":
+        raise InvalidResponseError(message="wrong json rpc version", response=response)
+
+    if "error" in response:
+        raise InvalidResponseError(message="json rpc error: %s" % response["error"].get("message"), response=response)
+
+
 class InvalidResponseError(Exception):
     """
     Invalid response error is returned when the jsonrpc response
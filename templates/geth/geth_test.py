@@ -0,0 +1,859 @@
+import os
+import pytest
+import subprocess
+import tempfile
+import shutil
+from unittest import mock, TestCase
+from unittest.mock import MagicMock, patch, call
+from JumpscaleZrobot.test.utils import ZrobotBaseTest, mock_decorator
+from zerorobot.template.state import StateCheckError
+import requests
+from jumpscale import j
+from geth import Geth, InvalidResponseError, _IMPORT_ANCIENT_SCRIPT
+
+
+patch("zerorobot.template.decorator.timeout",
+      MagicMock(return_value=mock_decorator)).start()
+patch("zerorobot.template.decorator.retry",
+      MagicMock(return_value=mock_decorator)).start()
+
+Geth.recurring_action = MagicMock()
+
+
+class TestGethTemplate(ZrobotBaseTest):
+    @classmethod
+    def setUpClass(cls):
+        super().preTest(os.path.dirname(__file__), Geth)
+        cls.valid_data = {
+            'network': 'testnet',
+            'lightserv': 90,
+            'verbosity': 4,
+            'v5disc': 'v5disc',
+            'syncmode': 'full',
+            'nat': 'none',
+            'datadir': '/mnt/data',
+            'ethport': 30303,
+            'nodekey': '/mnt/data/bootnode.key',
+            'gethFlist': 'https://hub.grid.tf/tf-official-apps/geth.flist',
+            'phaseTimings': [],
+            'rpcConnectTimeout': 5,
+            'rpcReadTimeout': 30,
+            'syncCheckMinInterval': 15,
+            'syncCheckMaxInterval': 600,
+            'syncCheckJitter': 10,
+            'enodeId': '',
+            'enodeNodekey': '',
+            'cache': 0,
+            'maxpeers': 0,
+            'txpoolSlots': 0,
+            'txpoolQueue': 0,
+            'gcmode': '',
+            'restartBackoff': 10,
+            'restartBackoffMax': 600,
+            'restartLimit': 10,
+            'restartCount': 0,
+            'hotStoragePool': 'zos-cache',
+            'ancientStoragePool': '',
+            'snapshotDirectory': '',
+            'bootstrapSnapshot': '',
+            'lastSnapshot': '',
+            'metrics': False,
+            'metricsPort': 6060,
+            'livenessCheckInterval': 60,
+        }
+
+    def setUp(self):
+        patch('jumpscale.j.clients.zos.get', MagicMock()).start()
+        patch("gevent.sleep", MagicMock()).start()
+        patch("time.sleep", MagicMock()).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _running_geth(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.state.set('actions', 'run', 'ok')
+        geth._container = MagicMock()
+        geth._geth_args = MagicMock(return_value=['--rpc'])
+        geth._geth_running = MagicMock(return_value=True)
+        return geth
+
+    def test_create_valid_data(self):
+        geth = Geth('geth', data=self.valid_data)
+        assert geth.data == self.valid_data
+
+    def _rpc_echo(self, geth, result):
+        """make the rpc session answer every call with result."""
+        session = MagicMock()
+
+        def post(url, data, timeout):
+            request = j.data.serializer.json.loads(data)
+            response = MagicMock()
+            response.json.return_value = {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+            return response
+        session.post = MagicMock(side_effect=post)
+        geth._rpc_session_ = session
+        return session
+
+    def _rpc_answer(self, geth, results):
+        """make the rpc session answer the calls of a batch with the results of their method."""
+        session = MagicMock()
+
+        def post(url, data, timeout):
+            response = MagicMock()
+            response.json.return_value = [
+                {'jsonrpc': '2.0', 'id': request['id'], 'result': results[request['method']]}
+                for request in j.data.serializer.json.loads(data)]
+            return response
+        session.post = MagicMock(side_effect=post)
+        geth._rpc_session_ = session
+        return session
+
+    def test_rpc_session_reused(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._container_ip_ = '10.0.0.2'
+        with patch('requests.Session') as session_cls, patch('geth.HTTPAdapter') as adapter:
+            session_cls.return_value.post.return_value.json.return_value = {}
+            geth._rpc_post({})
+            geth._rpc_post({})
+        session_cls.assert_called_once()
+        adapter.assert_called_once_with(pool_connections=1, pool_maxsize=4)
+        session_cls.return_value.mount.assert_called_once_with('http://', adapter.return_value)
+        assert session_cls.return_value.post.call_count == 2
+
+    def test_rpc_post_timeouts(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._container_ip_ = '10.0.0.2'
+        geth._rpc_session_ = MagicMock()
+
+        geth._rpc_post({'method': 'eth_syncing'})
+        geth._rpc_session_.post.assert_called_once_with(
+            url='http://10.0.0.2:8545', data=j.data.serializer.json.dumps({'method': 'eth_syncing'}), timeout=(5, 30))
+
+    def test_rpc_post_connection_error(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._container_ip_ = '10.0.0.2'
+        geth._rpc_session_ = MagicMock()
+        geth._rpc_session_.post.side_effect = requests.ConnectionError()
+
+        with pytest.raises(requests.ConnectionError):
+            geth._rpc_post({})
+        # the container might have a new ip, it is looked up again on the next call
+        assert geth._container_ip_ is None
+
+    def test_stop_closes_rpc_session(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._container = MagicMock()
+        session = MagicMock()
+        geth._rpc_session_ = session
+
+        geth.stop()
+        session.close.assert_called_once()
+        assert geth._rpc_session_ is None
+
+    def test_get_syncing_status(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._container_ip_ = '10.0.0.2'
+
+        self._rpc_echo(geth, {'currentBlock': '0x10', 'highestBlock': '0x20'})
+        assert geth.get_syncing_status() == (16, 32)
+
+        self._rpc_echo(geth, False)
+        assert geth.get_syncing_status() is None
+
+    def test_rpc_batch(self):
+        geth = Geth('geth', data=self.valid_data)
+
+        def post(payload):
+            # answer in reverse order, the results must still match the methods
+            return [{'jsonrpc': '2.0', 'id': request['id'], 'result': request['method']}
+                    for request in reversed(payload)]
+        geth._rpc_post = MagicMock(side_effect=post)
+
+        assert geth._rpc_batch(['eth_syncing', 'net_peerCount']) == ['eth_syncing', 'net_peerCount']
+        geth._rpc_post.assert_called_once()
+
+    def test_rpc_batch_invalid_response(self):
+        geth = Geth('geth', data=self.valid_data)
+
+        geth._rpc_post = MagicMock(return_value={'jsonrpc': '2.0', 'error': {'message': 'batch not supported'}})
+        with pytest.raises(InvalidResponseError):
+            geth._rpc_batch(['eth_syncing'])
+
+        geth._rpc_post = MagicMock(return_value=[{'jsonrpc': '2.0', 'id': 'other', 'result': False}])
+        with pytest.raises(InvalidResponseError):
+            geth._rpc_batch(['eth_syncing'])
+
+        def error(payload):
+            return [{'jsonrpc': '2.0', 'id': payload[0]['id'], 'error': {'message': 'method not found'}}]
+        geth._rpc_post = MagicMock(side_effect=error)
+        with pytest.raises(InvalidResponseError):
+            geth._rpc_batch(['eth_syncing'])
+
+    def test_health_snapshot(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._container_ip_ = '10.0.0.2'
+        session = self._rpc_answer(geth, {
+            'eth_syncing': {'currentBlock': '0x10', 'highestBlock': '0x20'},
+            'eth_blockNumber': '0x10',
+            'net_peerCount': '0x5',
+            'net_version': '3',
+        })
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            snapshot = geth.health_snapshot()
+        # all methods are sent in a single request
+        session.post.assert_called_once()
+        assert snapshot == {
+            'timestamp': 1000,
+            'syncing': True,
+            'currentBlock': 16,
+            'highestBlock': 32,
+            'blockNumber': 16,
+            'peers': 5,
+            'networkId': 3,
+        }
+
+    def test_health_snapshot_not_syncing(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._container_ip_ = '10.0.0.2'
+        self._rpc_answer(geth, {'eth_syncing': False, 'eth_blockNumber': '0x40',
+                                'net_peerCount': '0x0', 'net_version': '1'})
+
+        snapshot = geth.health_snapshot()
+        assert snapshot['syncing'] is False
+        assert snapshot['currentBlock'] == 64
+        assert snapshot['highestBlock'] is None
+
+    def test_check_sync(self):
+        geth = self._running_geth()
+        geth._container_ip_ = '10.0.0.2'
+        geth._next_sync_check = 0
+        results = {'eth_syncing': {'currentBlock': '0x10', 'highestBlock': '0x20'},
+                   'eth_blockNumber': '0x10', 'net_peerCount': '0x5', 'net_version': '3'}
+        self._rpc_answer(geth, results)
+
+        geth._check_sync()
+        geth.state.check('ethereum', 'syncing', 'ok')
+        with pytest.raises(StateCheckError):
+            geth.state.check('ethereum', 'synced', 'ok')
+
+        results['eth_syncing'] = {'currentBlock': '0x20', 'highestBlock': '0x20'}
+        geth._next_sync_check = 0
+        geth._check_sync()
+        geth.state.check('ethereum', 'synced', 'ok')
+        with pytest.raises(StateCheckError):
+            geth.state.check('ethereum', 'syncing', 'ok')
+
+        results['eth_syncing'] = False
+        geth._next_sync_check = 0
+        geth._check_sync()
+        for tag in ('syncing', 'synced'):
+            with pytest.raises(StateCheckError):
+                geth.state.check('ethereum', tag, 'ok')
+        assert len(geth._sync_samples) == 3
+
+    def test_sync_progress_no_samples(self):
+        geth = Geth('geth', data=self.valid_data)
+        progress = geth.sync_progress()
+        assert progress['currentBlock'] is None
+        assert progress['blocksPerSecond'] is None
+        assert progress['samples'] == 0
+
+    def test_sync_progress(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._sync_samples.extend([(100, 1000, 5000), (110, 1500, 5000), (120, 2000, 5000)])
+
+        progress = geth.sync_progress()
+        assert progress['currentBlock'] == 2000
+        assert progress['highestBlock'] == 5000
+        assert progress['blocksPerSecond'] == 50
+        assert progress['eta'] == 60
+        assert progress['window'] == 20
+        assert progress['samples'] == 3
+
+    def test_sync_progress_synced(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._sync_samples.extend([(100, 5000, 5000), (110, 5000, 5000)])
+
+        progress = geth.sync_progress()
+        assert progress['eta'] == 0
+        assert progress['blocksPerSecond'] == 0
+
+    def test_sync_progress_samples_bounded(self):
+        geth = Geth('geth', data=self.valid_data)
+        for i in range(100):
+            geth._record_sync_sample({'timestamp': i, 'currentBlock': i, 'highestBlock': None})
+
+        progress = geth.sync_progress()
+        assert progress['samples'] == 30
+        assert progress['highestBlock'] == 99
+        assert progress['window'] == 29
+
+    def test_schedule_sync_check(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['syncCheckJitter'] = 0
+        geth.data['syncCheckMaxInterval'] = 100
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            geth._schedule_sync_check(stable=True)
+            assert geth._sync_interval == 30
+            assert geth._next_sync_check == 1030
+            for _ in range(5):
+                geth._schedule_sync_check(stable=True)
+            assert geth._sync_interval == 100
+
+            geth._schedule_sync_check(stable=False)
+            assert geth._sync_interval == 15
+            assert geth._next_sync_check == 1015
+
+    def test_schedule_sync_check_jitter(self):
+        geth = Geth('geth', data=self.valid_data)
+        with patch('time.time', MagicMock(return_value=1000)):
+            for _ in range(20):
+                geth._schedule_sync_check(stable=False)
+                assert 1013.5 <= geth._next_sync_check <= 1016.5
+
+    def test_check_sync_not_run(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._next_sync_check = 0
+        geth.health_snapshot = MagicMock()
+
+        geth._check_sync()
+        assert not geth.health_snapshot.called
+
+    def test_check_sync_crashloop(self):
+        geth = self._running_geth()
+        geth._next_sync_check = 0
+        geth.state.set('status', 'crashloop', 'error')
+        geth.health_snapshot = MagicMock()
+
+        geth._check_sync()
+        assert not geth.health_snapshot.called
+        assert not geth._geth_running.called
+
+    def test_check_sync_backoff_on_failure(self):
+        geth = self._running_geth()
+        geth.data['syncCheckJitter'] = 0
+        geth._next_sync_check = 0
+        geth.health_snapshot = MagicMock(side_effect=requests.ConnectionError())
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            for interval in (30, 60, 120):
+                geth._next_sync_check = 0
+                with pytest.raises(requests.ConnectionError):
+                    geth._check_sync()
+                assert geth._next_sync_check == 1000 + interval
+
+            # an answer while catching up resets the interval
+            geth.health_snapshot = MagicMock(return_value={
+                'timestamp': 1000, 'syncing': True, 'currentBlock': 1, 'highestBlock': 2})
+            geth._next_sync_check = 0
+            geth._check_sync()
+        assert geth._next_sync_check == 1015
+
+    def test_run_uses_nodekey(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['nodekey'] = '/mnt/data/geth/nodekey'
+        geth.state.set('actions', 'start', 'ok')
+        geth._geth_args = MagicMock(return_value=['--rpc'])
+        container = MagicMock()
+        container.client.filesystem.exists.return_value = False
+        container.client.system.return_value.get.return_value.stdout = 'abcd\n'
+        geth._container = container
+
+        geth.run()
+
+        container.client.filesystem.exists.assert_called_once_with('/mnt/data/geth/nodekey')
+        container.client.system.assert_has_calls([
+            call('/sandbox/bin/bootnode -genkey /mnt/data/geth/nodekey'),
+            call('/sandbox/bin/geth --rpc', id='geth.%s' % geth.guid),
+            call('/sandbox/bin/bootnode -nodekey /mnt/data/geth/nodekey -writeaddress'),
+        ], any_order=True)
+        assert geth.data['enodeId'] == 'abcd'
+        geth.state.check('actions', 'run', 'ok')
+
+    def test_get_enode_address_cached(self):
+        geth = Geth('geth', data=self.valid_data)
+        container = MagicMock()
+        container.client.system.return_value.get.return_value.stdout = 'abcd\n'
+        container.default_ip.return_value.ip = '10.0.0.2'
+        geth._container = container
+
+        assert geth.get_enode_address() == 'enode://abcd@10.0.0.2:30303'
+        assert geth.get_enode_address() == 'enode://abcd@10.0.0.2:30303'
+        container.client.system.assert_called_once_with(
+            '/sandbox/bin/bootnode -nodekey /mnt/data/bootnode.key -writeaddress')
+        container.default_ip.assert_called_once()
+
+    def test_get_enode_address_container_changed(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['enodeId'] = 'abcd'
+        geth.data['enodeNodekey'] = geth.data['nodekey']
+        container = MagicMock()
+        container.default_ip.return_value.ip = '10.0.0.2'
+        geth._container = container
+        assert geth.get_enode_address() == 'enode://abcd@10.0.0.2:30303'
+
+        # a new container gets a new ip, the enode id is kept
+        geth._invalidate_container()
+        geth._node_sal.containers.get.return_value.default_ip.return_value.ip = '10.0.0.3'
+        assert geth.get_enode_address() == 'enode://abcd@10.0.0.3:30303'
+        assert not container.client.system.called
+
+    def test_get_enode_address_nodekey_changed(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['enodeId'] = 'abcd'
+        geth.data['enodeNodekey'] = geth.data['nodekey']
+        geth._container_ip_ = '10.0.0.2'
+        container = MagicMock()
+        container.client.system.return_value.get.return_value.stdout = 'ef01\n'
+        geth._container = container
+
+        geth.data['nodekey'] = '/mnt/data/geth/nodekey'
+        assert geth.get_enode_address() == 'enode://ef01@10.0.0.2:30303'
+        container.client.system.assert_called_once_with(
+            '/sandbox/bin/bootnode -nodekey /mnt/data/geth/nodekey -writeaddress')
+        assert geth.data['enodeNodekey'] == '/mnt/data/geth/nodekey'
+
+    def test_run_new_nodekey_resets_enode(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['enodeId'] = 'abcd'
+        geth.data['enodeNodekey'] = geth.data['nodekey']
+        geth.state.set('actions', 'start', 'ok')
+        geth._geth_args = MagicMock(return_value=['--rpc'])
+        container = MagicMock()
+        container.client.filesystem.exists.return_value = False
+        container.client.system.return_value.get.return_value.stdout = 'ef01\n'
+        geth._container = container
+
+        geth.run()
+        assert geth.data['enodeId'] == 'ef01'
+
+    def test_tuning_auto(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._node_resources_ = {'memory': 16384, 'cpus': 4}
+        geth._geth_services = MagicMock(return_value=1)
+
+        assert geth._tuning() == {
+            'cache': 4096,
+            'maxpeers': 40,
+            'txpoolSlots': 16384,
+            'txpoolQueue': 4096,
+        }
+
+    def test_tuning_bounds(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._node_resources_ = {'memory': 512, 'cpus': 1}
+        geth._geth_services = MagicMock(return_value=1)
+
+        assert geth._tuning() == {
+            'cache': 256,
+            'maxpeers': 25,
+            'txpoolSlots': 4096,
+            'txpoolQueue': 1024,
+        }
+
+        geth._node_resources_ = {'memory': 128 * 1024, 'cpus': 64}
+        tuning = geth._tuning()
+        assert tuning['cache'] == 8192
+        assert tuning['maxpeers'] == 100
+
+    def test_tuning_configured(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['cache'] = 1024
+        geth.data['maxpeers'] = 50
+        geth.data['txpoolSlots'] = 100
+        geth.data['txpoolQueue'] = 10
+        geth._node_sal.client.info = MagicMock()
+
+        assert geth._tuning() == {'cache': 1024, 'maxpeers': 50, 'txpoolSlots': 100, 'txpoolQueue': 10}
+        assert not geth._node_sal.client.info.mem.called
+
+    def test_tuning_shared_node(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._node_resources_ = {'memory': 16384, 'cpus': 20}
+        gethes = [MagicMock() for _ in range(4)]
+        for service in gethes:
+            service.template_uid.name = 'geth'
+        discovery = MagicMock()
+        discovery.template_uid.name = 'peer_discovery'
+        geth.api = MagicMock()
+        geth.api.services.find.return_value = gethes[:2] + [discovery]
+
+        tuning = geth._tuning()
+        # both geth services get half of the node
+        assert tuning['cache'] == 2048
+        assert tuning['maxpeers'] == 100
+        assert tuning['txpoolSlots'] == 8192
+
+        geth.api.services.find.return_value = gethes
+        tuning = geth._tuning()
+        assert tuning['cache'] == 1024
+        assert tuning['maxpeers'] == 50
+
+    def test_supervise_not_run(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._geth_running = MagicMock()
+
+        geth._supervise()
+        assert not geth._geth_running.called
+
+    def test_supervise_liveness_interval(self):
+        geth = self._running_geth()
+        with patch('time.time', MagicMock(return_value=1000)):
+            geth._supervise()
+            geth._supervise()
+        geth._geth_running.assert_called_once()
+
+        with patch('time.time', MagicMock(return_value=1060)):
+            geth._supervise()
+        assert geth._geth_running.call_count == 2
+        assert not geth._container.client.system.called
+
+    def test_supervise_restart_backoff(self):
+        geth = self._running_geth()
+        geth._geth_running.return_value = False
+        geth._crash_streak = 2
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            geth._supervise()
+        # restartBackoff doubled for every consecutive restart
+        assert geth._next_restart == 1040
+        assert not geth._container.client.system.called
+        with pytest.raises(StateCheckError):
+            geth.state.check('status', 'running', 'ok')
+
+        with patch('time.time', MagicMock(return_value=1040)):
+            geth._supervise()
+        # the pending restart doesn't look the job up again
+        geth._geth_running.assert_called_once()
+        geth._container.client.system.assert_called_once_with(
+            '/sandbox/bin/geth --rpc', id='geth.%s' % geth.guid)
+        assert geth.data['restartCount'] == 1
+        assert geth._crash_streak == 3
+        geth.state.check('status', 'running', 'ok')
+
+    def test_supervise_crashloop(self):
+        geth = self._running_geth()
+        geth._geth_running.return_value = False
+        geth._crash_streak = geth.data['restartLimit']
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            geth._supervise()
+        geth.state.check('status', 'crashloop', 'error')
+        assert not geth._container.client.system.called
+
+        # geth isn't looked up anymore until run is called again
+        with patch('time.time', MagicMock(return_value=2000)):
+            geth._supervise()
+        geth._geth_running.assert_called_once()
+
+    def test_supervise_streak_reset(self):
+        geth = self._running_geth()
+        geth._crash_streak = 3
+        geth._last_restart = 1000
+
+        with patch('time.time', MagicMock(return_value=1500)):
+            geth._supervise()
+        assert geth._crash_streak == 3
+
+        # geth stayed up for restartBackoffMax seconds
+        with patch('time.time', MagicMock(return_value=1601)):
+            geth._supervise()
+        assert geth._crash_streak == 0
+
+    def test_run_clears_crashloop(self):
+        geth = self._running_geth()
+        geth.state.set('actions', 'start', 'ok')
+        geth.state.set('status', 'crashloop', 'error')
+        geth._crash_streak = geth.data['restartLimit']
+        geth.data['enodeId'] = 'abcd'
+        geth.data['enodeNodekey'] = geth.data['nodekey']
+
+        geth.run()
+        assert geth._crash_streak == 0
+        with pytest.raises(StateCheckError):
+            geth.state.check('status', 'crashloop', 'error')
+        geth.state.check('status', 'running', 'ok')
+
+    def _storage_pools(self, geth, *names):
+        """make the node return a storage pool per name, holding the filesystem of geth."""
+        pools = {}
+        for name in names:
+            pool = MagicMock()
+            pool.get.return_value.path = '/mnt/storagepools/%s/filesystems/%s' % (name, geth.guid)
+            pools[name] = pool
+        geth._node_sal.storagepools.get = MagicMock(side_effect=lambda name: pools[name])
+        return pools
+
+    def test_volumes(self):
+        geth = Geth('geth', data=self.valid_data)
+        assert geth._volumes() == [('zos-cache', geth.guid, '/mnt/data')]
+
+        geth.data['ancientStoragePool'] = 'hdd'
+        assert geth._volumes() == [('zos-cache', geth.guid, '/mnt/data'), ('hdd', 'ancient', '/mnt/ancient')]
+
+    def test_install_storage_pools(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['ancientStoragePool'] = 'hdd'
+        pools = self._storage_pools(geth, 'zos-cache', 'hdd')
+        pools['hdd'].get.side_effect = ValueError()
+
+        geth.install()
+        assert not pools['zos-cache'].create.called
+        pools['hdd'].create.assert_called_once_with(geth.guid)
+        geth.state.check('actions', 'install', 'ok')
+
+    def test_install_shared_storage_pool(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['ancientStoragePool'] = 'zos-cache'
+        pools = self._storage_pools(geth, 'zos-cache')
+        pools['zos-cache'].get.side_effect = ValueError()
+
+        geth.install()
+        pools['zos-cache'].create.assert_called_once_with(geth.guid)
+
+    def test_uninstall_storage_pools(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['ancientStoragePool'] = 'hdd'
+        geth._container = MagicMock()
+        geth.state.set('actions', 'install', 'ok')
+        pools = self._storage_pools(geth, 'zos-cache', 'hdd')
+
+        geth.uninstall()
+        pools['zos-cache'].get.return_value.delete.assert_called_once()
+        pools['hdd'].get.return_value.delete.assert_called_once()
+        with pytest.raises(StateCheckError):
+            geth.state.check('actions', 'install', 'ok')
+
+    def test_get_container_mounts(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['ancientStoragePool'] = 'hdd'
+        geth.state.set('actions', 'install', 'ok')
+        self._storage_pools(geth, 'zos-cache', 'hdd')
+
+        geth._get_container()
+        mounts = geth._node_sal.containers.create.call_args[1]['mounts']
+        assert mounts == {
+            '/mnt/storagepools/zos-cache/filesystems/%s/%s' % (geth.guid, geth.guid): '/mnt/data',
+            '/mnt/storagepools/hdd/filesystems/%s/ancient' % geth.guid: '/mnt/ancient',
+        }
+
+    def test_geth_args_ancient(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._tuning = MagicMock(return_value={'cache': 256, 'maxpeers': 25, 'txpoolSlots': 4096, 'txpoolQueue': 1024})
+
+        assert not any(arg.startswith('--datadir.ancient') for arg in geth._geth_args())
+        geth.data['ancientStoragePool'] = 'hdd'
+        assert '--datadir.ancient=/mnt/ancient' in geth._geth_args()
+
+    def _snapshot_geth(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.state.set('actions', 'install', 'ok')
+        geth._host_volumes = MagicMock(return_value={'/mnt/data': '/fs/data', '/mnt/ancient': '/hdd/ancient'})
+        geth._snapshot_directory = MagicMock(return_value='/fs/snapshots')
+        geth.stop = MagicMock()
+        geth.start = MagicMock()
+        geth.run = MagicMock()
+        return geth
+
+    def test_export_snapshot(self):
+        geth = self._snapshot_geth()
+        geth.state.set('actions', 'start', 'ok')
+        geth.state.set('actions', 'run', 'ok')
+        geth._node_bash = MagicMock(return_value='2048\n')
+        geth._node_bash_progress = MagicMock(return_value='1024\nabcd\n')
+
+        with patch('time.time', MagicMock(return_value=1000)):
+            snapshot = geth.export_snapshot()
+
+        assert snapshot == {
+            'snapshot': '/fs/snapshots/chaindata-1000.tar.gz',
+            'size': 1024,
+            'sha256': 'abcd',
+            'dataSize': 2048,
+            'duration': 0,
+        }
+        assert geth.data['lastSnapshot'] == '/fs/snapshots/chaindata-1000.tar.gz'
+        geth._node_bash.assert_called_once_with('du -sbc /fs/data/geth /hdd/ancient | tail -n 1 | cut -f 1')
+        script = geth._node_bash_progress.call_args[0][0]
+        assert '--exclude=geth/nodekey' in script
+        assert '-C /fs/data geth -C /hdd ancient' in script
+        # the chain data is only consistent while geth is stopped
+        geth.stop.assert_called_once()
+        geth.start.assert_called_once()
+        geth.run.assert_called_once()
+
+    def test_export_snapshot_failed(self):
+        geth = self._snapshot_geth()
+        geth.state.set('actions', 'start', 'ok')
+        geth._node_bash = MagicMock(return_value='2048\n')
+        geth._node_bash_progress = MagicMock(side_effect=RuntimeError('disk full'))
+
+        with pytest.raises(RuntimeError):
+            geth.export_snapshot()
+        geth.start.assert_called_once()
+        assert not geth.run.called
+        assert geth.data['lastSnapshot'] == ''
+
+    def test_import_snapshot_running(self):
+        geth = self._snapshot_geth()
+        geth.state.set('actions', 'run', 'ok')
+        geth._node_bash = MagicMock()
+
+        with pytest.raises(RuntimeError):
+            geth.import_snapshot()
+        assert not geth._node_bash.called
+
+    def test_import_snapshot_latest(self):
+        geth = self._snapshot_geth()
+        geth._node_bash = MagicMock(side_effect=['/fs/snapshots/chaindata-1000.tar.gz\n', '2048\n', '', ''])
+        geth._node_bash_progress = MagicMock()
+
+        snapshot = geth.import_snapshot()
+        assert snapshot['snapshot'] == '/fs/snapshots/chaindata-1000.tar.gz'
+        assert snapshot['dataSize'] == 2048
+        script = geth._node_bash_progress.call_args[0][0]
+        assert 'sha256sum -c chaindata-1000.tar.gz.sha256' in script
+        assert '-C /fs/data' in script
+        scripts = [c[0][0] for c in geth._node_bash.call_args_list]
+        assert scripts[2] == 'find /hdd/ancient -mindepth 1 -delete'
+        assert scripts[3] == _IMPORT_ANCIENT_SCRIPT.format(
+            ancient='/hdd/ancient', candidates='/fs/data/ancient /fs/data/geth/chaindata/ancient')
+
+    def test_import_snapshot_without_ancient_volume(self):
+        geth = self._snapshot_geth()
+        geth._host_volumes.return_value = {'/mnt/data': '/fs/data'}
+        geth._node_bash = MagicMock(side_effect=['2048\n', ''])
+        geth._node_bash_progress = MagicMock()
+
+        snapshot = geth.import_snapshot('chaindata-1000.tar.gz')
+        assert snapshot['snapshot'] == '/fs/snapshots/chaindata-1000.tar.gz'
+        geth._node_bash.assert_called_with(_IMPORT_ANCIENT_SCRIPT.format(
+            ancient='/fs/data/geth/chaindata/ancient', candidates='/fs/data/ancient'))
+
+    def test_import_snapshot_none(self):
+        geth = self._snapshot_geth()
+        geth._node_bash = MagicMock(return_value='')
+
+        with pytest.raises(RuntimeError):
+            geth.import_snapshot()
+
+    def test_import_ancient_script(self):
+        root = tempfile.mkdtemp()
+        try:
+            # a snapshot taken with an ancient volume, imported without one
+            ancient = os.path.join(root, 'geth', 'chaindata', 'ancient')
+            os.makedirs(ancient)
+            with open(os.path.join(ancient, 'stale'), 'w') as f:
+                f.write('stale')
+            os.makedirs(os.path.join(root, 'ancient'))
+            with open(os.path.join(root, 'ancient', 'headers.cdat'), 'w') as f:
+                f.write('headers')
+
+            subprocess.check_call(['bash', '-c', _IMPORT_ANCIENT_SCRIPT.format(
+                ancient=ancient, candidates=os.path.join(root, 'ancient'))])
+            assert os.listdir(ancient) == ['headers.cdat']
+            assert not os.path.exists(os.path.join(root, 'ancient'))
+        finally:
+            shutil.rmtree(root)
+
+    def test_run_bootstrap_snapshot(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['bootstrapSnapshot'] = 'chaindata-1000.tar.gz'
+        geth.data['enodeId'] = 'abcd'
+        geth.data['enodeNodekey'] = geth.data['nodekey']
+        geth.state.set('actions', 'start', 'ok')
+        geth._host_volumes = MagicMock(return_value={'/mnt/data': '/fs/data'})
+        geth._geth_args = MagicMock(return_value=['--rpc'])
+        geth._container = MagicMock()
+        geth.import_snapshot = MagicMock()
+        geth._node_sal.client.filesystem.exists.return_value = False
+
+        geth.run()
+        geth._node_sal.client.filesystem.exists.assert_called_once_with('/fs/data/geth/chaindata')
+        geth.import_snapshot.assert_called_once_with('chaindata-1000.tar.gz')
+
+        # the volume already holds chain data
+        geth._node_sal.client.filesystem.exists.return_value = True
+        geth.import_snapshot.reset_mock()
+        geth.run()
+        assert not geth.import_snapshot.called
+
+    def test_geth_args_metrics_disabled(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._node_resources_ = {'memory': 16384, 'cpus': 4}
+        geth._geth_services = MagicMock(return_value=1)
+
+        assert '--pprof' not in geth._geth_args()
+        geth.data['metrics'] = True
+        assert '--pprof.port=6060' in geth._geth_args()
+
+    def test_metrics_disabled(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth._rpc_session_ = MagicMock()
+
+        with pytest.raises(RuntimeError):
+            geth.metrics()
+        assert not geth._rpc_session_.get.called
+
+    def test_metrics(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['metrics'] = True
+        geth.data['restartCount'] = 2
+        geth._container_ip_ = '10.0.0.2'
+        geth._rpc_session_ = MagicMock()
+        geth._rpc_session_.get.return_value.text = 'chain_head_block 16\n'
+        geth.health_snapshot = MagicMock(return_value={
+            'syncing': True, 'blockNumber': 16, 'highestBlock': 32, 'peers': 5})
+        geth._sync_samples.extend([(100, 8, 32), (110, 16, 32)])
+
+        assert geth.metrics() == """chain_head_block 16
+# HELP geth_service_head_block number of the head block
+# TYPE geth_service_head_block gauge
+geth_service_head_block 16
+# HELP geth_service_highest_block highest block known to the node while syncing
+# TYPE geth_service_highest_block gauge
+geth_service_highest_block 32
+# HELP geth_service_peers number of connected peers
+# TYPE geth_service_peers gauge
+geth_service_peers 5
+# HELP geth_service_syncing 1 if the node is syncing
+# TYPE geth_service_syncing gauge
+geth_service_syncing 1
+# HELP geth_service_sync_blocks_per_second sync rate over the last sync checks
+# TYPE geth_service_sync_blocks_per_second gauge
+geth_service_sync_blocks_per_second 0.8
+# HELP geth_service_restarts_total number of times geth was restarted
+# TYPE geth_service_restarts_total gauge
+geth_service_restarts_total 2
+"""
+        geth._rpc_session_.get.assert_called_once_with(
+            'http://10.0.0.2:6060/debug/metrics/prometheus', timeout=(5, 30))
+
+    def test_metrics_synced(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['metrics'] = True
+        geth._container_ip_ = '10.0.0.2'
+        geth._rpc_session_ = MagicMock()
+        geth._rpc_session_.get.return_value.text = ''
+        geth.health_snapshot = MagicMock(return_value={
+            'syncing': False, 'blockNumber': 64, 'highestBlock': None, 'peers': 0})
+
+        metrics = geth.metrics()
+        # without sync samples the rate is 0 and the highest block is the head block
+        assert 'geth_service_highest_block 64\n' in metrics
+        assert 'geth_service_syncing 0\n' in metrics
+        assert 'geth_service_sync_blocks_per_second 0\n' in metrics
+
+    def test_metrics_connection_error(self):
+        geth = Geth('geth', data=self.valid_data)
+        geth.data['metrics'] = True
+        geth._container_ip_ = '10.0.0.2'
+        geth._rpc_session_ = MagicMock()
+        geth._rpc_session_.get.side_effect = requests.ConnectionError()
+
+        with pytest.raises(requests.ConnectionError):
+            geth.metrics()
+        assert geth._container_ip_ is None
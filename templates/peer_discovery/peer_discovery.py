@@ -1,5 +1,9 @@
+import ipaddress
+import time
 from random import shuffle
 
+from gevent import socket
+from gevent.pool import Pool
 from jumpscale import j
 from zerorobot.template.base import TemplateBase
 from zerorobot.template.state import StateCheckError
@@ -12,6 +16,8 @@ class PeerDiscovery(TemplateBase):
     def __init__(self, name=None, guid=None, data=None):
         super().__init__(name=name, guid=guid, data=data)
         self._node_sal = j.clients.zos.get('local')
+        self._container = None
+        self._container_stats = {'lookups': 0, 'hits': 0, 'invalidations': 0}
 
     def validate(self):
         for key in ['node', 'container', 'rpcPort', 'apiPort', 'intervalScanNetwork', 'intervalAddPeer']:
@@ -27,17 +33,47 @@ class PeerDiscovery(TemplateBase):
             pass
 
         # schedule peer discovery
-        self.recurring_action(
-            'discover_peers', self.data['intervalScanNetwork'])
+        if self.data['scanMode'] == 'incremental':
+            self.recurring_action('scan_slice', self.data['intervalScanSlice'])
+        else:
+            self.recurring_action(
+                'discover_peers', self.data['intervalScanNetwork'])
 
         # schedule adding peers
         self.recurring_action('add_peer', self.data['intervalAddPeer'])
 
+        # schedule exchanging peers with the other peer_discovery services
+        if self.data['intervalExchangePeers']:
+            self.recurring_action('exchange_peers', self.data['intervalExchangePeers'])
+
         self.state.set('actions', 'install', 'ok')
 
     @property
     def _container_sal(self):
-        return self._node_sal.containers.get(self.data['container'])
+        if self._container is None:
+            self._container_stats['lookups'] += 1
+            self._container = self._node_sal.containers.get(self.data['container'])
+        else:
+            self._container_stats['hits'] += 1
+        return self._container
+
+    def _invalidate_container(self):
+        """Drop the cached container handle, the next access looks it up again."""
+        if self._container is not None:
+            self._container_stats['invalidations'] += 1
+        self._container = None
+
+    def set_container(self, container):
+        """Use another container of the tfchain daemon, e.g. after a blue/green upgrade."""
+        self.data['container'] = container
+        self._invalidate_container()
+
+    def container_cache_stats(self):
+        """Return counters of the cached container handle.
+
+        lookups are node round-trips, hits are the lookups the cache saved.
+        """
+        return dict(self._container_stats)
 
     @property
     def _client_sal(self):
@@ -49,6 +85,132 @@ class PeerDiscovery(TemplateBase):
         }
         return j.sal_zos.tfchain.client(**kwargs)
 
+    def _probe(self, peer):
+        """Open a tcp connection to the rpc port of peer.
+
+        Returns:
+            float -- seconds the connection took, None if it failed
+        """
+        addr, port = peer.rsplit(':', 1)
+        started = time.time()
+        try:
+            conn = socket.create_connection((addr, int(port)), timeout=self.data['probeTimeout'])
+        except (OSError, socket.timeout):
+            return None
+        conn.close()
+        return time.time() - started
+
+    def _probe_peers(self, peers):
+        """Probe peers concurrently and record the results in the scoreboard."""
+        rtts = Pool(max(self.data['probeConcurrency'], 1)).map(self._probe, peers)
+        for peer, rtt in zip(peers, rtts):
+            self._record_probe(peer, rtt)
+        self.logger.info('%d of %d peers reachable', len([rtt for rtt in rtts if rtt is not None]), len(peers))
+
+    def _score(self, entry, now):
+        """score of a scoreboard entry, halved every scoreHalfLife seconds."""
+        elapsed = max(now - entry['scoreTime'], 0)
+        return entry['score'] * 0.5 ** (elapsed / max(self.data['scoreHalfLife'], 1))
+
+    def _entry(self, address):
+        """scoreboard entry of the peer at address, added if the peer isn't known yet."""
+        for entry in self.data['peers']:
+            if entry['address'] == address:
+                return entry
+        entry = {
+            'address': address,
+            'successes': 0,
+            'failures': 0,
+            'consecutiveFailures': 0,
+            'lastSeen': 0,
+            'rtt': 0.0,
+            'score': 0.0,
+            'scoreTime': 0,
+            'probeSuccesses': 0,
+            'probeFailures': 0,
+            'evicted': 0,
+        }
+        self.data['peers'].append(entry)
+        return entry
+
+    def _record(self, address, success):
+        """Record that the daemon added, or failed to add, the peer at address in the scoreboard.
+
+        Only these results are scored, the daemon can reach other peers than the robot can probe.
+        A peer the daemon is connected to is taken back if it was evicted.
+        """
+        entry = self._entry(address)
+        now = int(time.time())
+        entry['score'] = self._score(entry, now) + (1 if success else -1)
+        entry['scoreTime'] = now
+        if success:
+            entry['successes'] += 1
+            entry['consecutiveFailures'] = 0
+            entry['lastSeen'] = now
+            entry['evicted'] = 0
+        else:
+            entry['failures'] += 1
+            entry['consecutiveFailures'] += 1
+
+    def _record_probe(self, address, rtt):
+        """Record a probe of the rpc port of the peer at address, rtt is None if it failed."""
+        entry = self._entry(address)
+        if rtt is None:
+            entry['probeFailures'] += 1
+            entry['rtt'] = 0.0
+        else:
+            entry['probeSuccesses'] += 1
+            entry['lastSeen'] = int(time.time())
+            entry['rtt'] = rtt
+
+    def _evict(self):
+        """Evict the peers that failed to be added maxFailures times in a row, and drop
+        the lowest scored peers above maxScoreboardPeers.
+
+        Evicted peers are kept for evictionPeriod seconds so scans and exchanges don't
+        add them back, and are removed from the discovered peers.
+        """
+        now = time.time()
+        evicted = 0
+        peers = []
+        for entry in self.data['peers']:
+            if not entry['evicted'] and self.data['maxFailures'] and \
+                    entry['consecutiveFailures'] >= self.data['maxFailures']:
+                entry['evicted'] = int(now)
+                evicted += 1
+            if not entry['evicted'] or now - entry['evicted'] < self.data['evictionPeriod']:
+                peers.append(entry)
+
+        live = [entry for entry in peers if not entry['evicted']]
+        if self.data['maxScoreboardPeers'] and len(live) > self.data['maxScoreboardPeers']:
+            live = sorted(live, key=lambda entry: self._score(entry, now), reverse=True)
+            dropped = set(entry['address'] for entry in live[self.data['maxScoreboardPeers']:])
+            peers = [entry for entry in peers if entry['address'] not in dropped]
+
+        if evicted:
+            self.logger.info('evicting %d peers from the scoreboard', evicted)
+            tombstones = set(entry['address'] for entry in peers if entry['evicted'])
+            self.data['discoveredPeers'] = [peer for peer in self.data['discoveredPeers'] if peer not in tombstones]
+        if len(peers) != len(self.data['peers']):
+            self.data['peers'] = peers
+
+    def _candidates(self, exclude=()):
+        """addresses of the scoreboard peers, highest score first and nearest first among equal scores."""
+        now = time.time()
+
+        def rank(entry):
+            # peers without a measured round-trip time come last among equal scores
+            return (-round(self._score(entry, now), 3), entry['rtt'] or float('inf'))
+
+        return [entry['address'] for entry in sorted(self.data['peers'], key=rank)
+                if not entry['evicted'] and entry['address'] not in exclude]
+
+    def scoreboard(self):
+        """Return the scoreboard of the known peers with their current score, best peers first."""
+        now = time.time()
+        peers = [dict(entry, score=self._score(entry, now)) for entry in self.data['peers']]
+        return sorted(peers, key=lambda entry: entry['score'], reverse=True)
+
     def discover_peers(self, link=None):
         """Add new local peers.
 
@@ -57,25 +219,201 @@ class PeerDiscovery(TemplateBase):
         self.logger.info('start network scanning')
         client = self._client_sal
 
-        peers = client.discover_local_peers(
-            link=link, port=self.data['rpcPort'])
+        try:
+            peers = client.discover_local_peers(
+                link=link, port=self.data['rpcPort'])
+        except Exception:
+            # the container might have been recreated, look it up again next time
+            self._invalidate_container()
+            raise
         # shuffle list of peers
         shuffle(peers)
 
+        self._merge_scan(client, peers)
+
+    def _merge_scan(self, client, peers):
+        """Probe the scanned peers, record them in the scoreboard and update the list of discovered peers."""
         # fetch list of connected peers
         connected_peers = [addr['netaddress']
                            for addr in client.gateway_stat()['peers']]
 
-        # add update list of discovered peers
-        self.data['discoveredPeers'] = []
+        # merge the scan into the scoreboard and update list of discovered peers, best peers first
+        for peer in connected_peers:
+            self._record(peer, True)
+        evicted = set(entry['address'] for entry in self.data['peers'] if entry['evicted'])
+        self._probe_peers([peer for peer in peers if peer not in connected_peers and peer not in evicted])
+        self._evict()
+        self.data['discoveredPeers'] = self._candidates(exclude=connected_peers)
+
+    def top_peers(self, count=None):
+        """Return the addresses of the best scored peers that were reached successfully.
+
+        @count: maximum number of peers, defaults to gossipMaxPeers
+        """
+        now = time.time()
+        count = min(count or self.data['gossipMaxPeers'], self.data['gossipMaxPeers'])
+        scores = {entry['address']: self._score(entry, now) for entry in self.data['peers']}
+        return [address for address in self._candidates() if scores[address] > 0][:count]
+
+    def _siblings(self):
+        """peer_discovery services of this robot and of the gossipRobots."""
+        siblings = [service for service in self.api.services.find()
+                    if service.template_uid.name == self.template_name and service is not self]
+        for robot in self.data['gossipRobots']:
+            try:
+                services = j.clients.zrobot.robots[robot].services.find()
+            except Exception as err:
+                self.logger.warning('failed to list the services of robot %s: %s', robot, err)
+                continue
+            # the robot can be this one
+            siblings.extend(service for service in services
+                            if service.template_uid.name == self.template_name and service.guid != self.guid)
+        return siblings
+
+    def exchange_peers(self):
+        """Push the top peers of this service to the other peer_discovery services.
+
+        The other services merge them with their merge_peers action. The push doesn't wait
+        for that action, so services exchanging at the same time never wait on each other.
+
+        Returns:
+            list -- addresses of the pushed peers
+        """
+        peers = self.top_peers()
+        if not peers:
+            return []
+
+        def push(service):
+            try:
+                service.schedule_action('merge_peers', args={'peers': peers})
+                return True
+            except Exception as err:
+                self.logger.warning('failed to push peers to %s: %s', service.name, err)
+                return False
+
+        pushed = Pool(max(self.data['probeConcurrency'], 1)).map(push, self._siblings())
+        self.logger.info('pushed %d peers to %d peer_discovery services', len(peers), len([ok for ok in pushed if ok]))
+        return peers
+
+    def merge_peers(self, peers):
+        """Merge peers pushed by another peer_discovery service into the scoreboard.
+
+        At most gossipMaxPeers new peers are merged. They are added with a neutral score,
+        so peers this service reached itself are tried first. Evicted peers aren't added back.
+
+        @peers: addresses of the peers
+
+        Returns:
+            list -- addresses of the merged peers
+        """
+        known = set(entry['address'] for entry in self.data['peers'])
+        new_peers = []
         for peer in peers:
-            if peer not in connected_peers:
+            if peer not in known and len(new_peers) < self.data['gossipMaxPeers']:
+                known.add(peer)
+                new_peers.append(peer)
+
+        for peer in new_peers:
+            self._entry(peer)
+            if peer not in self.data['discoveredPeers']:
                 self.data['discoveredPeers'].append(peer)
+        self._evict()
+        self.logger.info('merged %d peers from other peer_discovery services', len(new_peers))
+        return new_peers
+
+    def _subnet(self, link=None):
+        """ipv4 interface of the container on link, or on its first nic if link isn't given."""
+        for nic in self._container_sal.client.info.nic():
+            if link and nic['name'] != link:
+                continue
+            for addr in nic['addrs']:
+                interface = ipaddress.ip_interface(addr['addr'])
+                if interface.version == 4 and not interface.is_loopback and interface.network.num_addresses > 2:
+                    return interface
+        raise RuntimeError('no ipv4 network found on %s' % (link or 'the container'))
+
+    def scan_slice(self, link=None):
+        """Scan the next scanSliceSize addresses of the local subnet for peers.
+
+        The slices rotate over the subnet, the position is kept in scanCursor. The peers
+        found are merged into the scoreboard like the ones of discover_peers.
+
+        @link: network interface name
+        """
+        try:
+            interface = self._subnet(link)
+            network = interface.network
+            # skip the network and broadcast addresses
+            hosts = network.num_addresses - 2
+            start = self.data['scanCursor'] % hosts
+            size = min(max(self.data['scanSliceSize'], 1), hosts)
+            addresses = [str(network[1 + (start + i) % hosts]) for i in range(size)]
+
+            self.logger.info('scanning %d addresses of %s from %s', size, network, addresses[0])
+            cmd = 'nmap -n -Pn --open -oG - --max-rate {rate} -p {port} {addresses}'.format(
+                rate=max(self.data['scanRateLimit'], 1), port=self.data['rpcPort'], addresses=' '.join(addresses))
+            result = self._container_sal.client.system(cmd).get()
+            if result.state != 'SUCCESS':
+                raise RuntimeError('scanning the network failed: %s' % result.stderr)
+        except Exception:
+            # the container might have been recreated, look it up again next time
+            self._invalidate_container()
+            raise
+
+        self.data['scanCursor'] = (start + size) % hosts
+        peers = []
+        for line in result.stdout.splitlines():
+            # the daemon in our own container isn't a peer
+            if line.startswith('Host:') and '/open/' in line and line.split()[1] != str(interface.ip):
+                peers.append('%s:%s' % (line.split()[1], self.data['rpcPort']))
+
+        self._merge_scan(self._client_sal, peers)
 
     def add_peer(self):
-        """Add a peer from list of discovered peers."""
+        """Add peers from list of discovered peers.
+
+        Without targetPeers the next peer is added. Otherwise the peers needed to reach
+        targetPeers connected peers are added in parallel, at most maxPeersPerTick.
+        """
+        if not self.data['discoveredPeers']:
+            return
+
+        client = self._client_sal
+        count = 1
+        connected_peers = []
+        if self.data['targetPeers']:
+            try:
+                connected_peers = [addr['netaddress'] for addr in client.gateway_stat()['peers']]
+            except Exception:
+                self._invalidate_container()
+                raise
+            count = min(self.data['targetPeers'] - len(connected_peers), self.data['maxPeersPerTick'])
+            if count <= 0:
+                return
 
-        if self.data['discoveredPeers']:
+        peers = []
+        while self.data['discoveredPeers'] and len(peers) < count:
             peer = self.data['discoveredPeers'].pop(0)
+            if peer not in connected_peers:
+                peers.append(peer)
+        if not peers:
+            return
+
+        def connect(peer):
             [addr, port] = peer.split(':')
-            self._client_sal.add_peer(addr, port)
+            try:
+                client.add_peer(addr, port)
+            except Exception as err:
+                self.logger.warning('failed to add peer %s: %s', peer, err)
+                return err
+
+        results = Pool(len(peers)).map(connect, peers)
+        for peer, err in zip(peers, results):
+            self._record(peer, err is None)
+        self._evict()
+
+        errors = [err for err in results if err is not None]
+        if errors:
+            self._invalidate_container()
+            if len(errors) == len(peers):
+                raise errors[0]
@@ -25,6 +25,23 @@ class TestPeerDiscoveryTemplate(TestCase):
             'intervalScanNetwork': 3600,
             'intervalAddPeer': 300,
             'discoveredPeers': [],
+            'probeConcurrency': 32,
+            'probeTimeout': 2,
+            'targetPeers': 0,
+            'maxPeersPerTick': 8,
+            'peers': [],
+            'scoreHalfLife': 86400,
+            'maxFailures': 3,
+            'maxScoreboardPeers': 1024,
+            'scanMode': 'full',
+            'intervalScanSlice': 60,
+            'scanSliceSize': 256,
+            'scanRateLimit': 100,
+            'scanCursor': 0,
+            'intervalExchangePeers': 0,
+            'gossipRobots': [],
+            'gossipMaxPeers': 32,
+            'evictionPeriod': 86400,
         }
         config.DATA_DIR = tempfile.mkdtemp(prefix='0-templates_')
         cls.type = template_collection._load_template(
@@ -65,3 +82,223 @@ class TestPeerDiscoveryTemplate(TestCase):
 
         assert discovery.recurring_action.call_count == 2
         discovery.state.check('actions', 'install', 'ok')
+
+    def test_discover_peers_ranked(self):
+        """Test discovered peers are ordered by round-trip time."""
+        client = MagicMock()
+        client.discover_local_peers.return_value = ['10.0.0.1:23112', '10.0.0.2:23112', '10.0.0.3:23112', '10.0.0.4:23112']
+        client.gateway_stat.return_value = {'peers': [{'netaddress': '10.0.0.4:23112'}]}
+        patch('jumpscale.j.sal_zos.tfchain.client', MagicMock(return_value=client)).start()
+        rtts = {'10.0.0.1:23112': 0.3, '10.0.0.2:23112': None, '10.0.0.3:23112': 0.1}
+
+        data = self.valid_data.copy()
+        data['peers'] = []
+        discovery = self.type(name='discovery', data=data)
+        discovery._probe = MagicMock(side_effect=lambda peer: rtts[peer])
+        discovery.discover_peers()
+
+        assert discovery.data['discoveredPeers'] == ['10.0.0.3:23112', '10.0.0.1:23112', '10.0.0.2:23112']
+        assert discovery._probe.call_count == 3
+        assert len(discovery.data['peers']) == 4
+
+    def test_probe(self):
+        """Test probing a peer."""
+        discovery = self.type(name='discovery', data=self.valid_data)
+        with patch('gevent.socket.create_connection') as create_connection:
+            assert discovery._probe('10.0.0.1:23112') is not None
+            create_connection.assert_called_once_with(('10.0.0.1', 23112), timeout=2)
+            create_connection.side_effect = OSError()
+            assert discovery._probe('10.0.0.1:23112') is None
+
+    def test_add_peer(self):
+        """Test adding the next discovered peer."""
+        client = MagicMock()
+        patch('jumpscale.j.sal_zos.tfchain.client', MagicMock(return_value=client)).start()
+        data = self.valid_data.copy()
+        data['discoveredPeers'] = ['10.0.0.1:23112', '10.0.0.2:23112']
+        data['peers'] = []
+        discovery = self.type(name='discovery', data=data)
+        discovery.add_peer()
+
+        client.add_peer.assert_called_once_with('10.0.0.1', '23112')
+        assert discovery.data['discoveredPeers'] == ['10.0.0.2:23112']
+
+    def test_add_peer_target(self):
+        """Test adding the peers needed to reach the target peer count."""
+        client = MagicMock()
+        client.gateway_stat.return_value = {'peers': [{'netaddress': '10.0.0.1:23112'}]}
+        patch('jumpscale.j.sal_zos.tfchain.client', MagicMock(return_value=client)).start()
+        data = self.valid_data.copy()
+        data['targetPeers'] = 4
+        data['maxPeersPerTick'] = 2
+        data['discoveredPeers'] = ['10.0.0.1:23112', '10.0.0.2:23112', '10.0.0.3:23112', '10.0.0.4:23112']
+        data['peers'] = []
+        discovery = self.type(name='discovery', data=data)
+        discovery.add_peer()
+
+        assert client.add_peer.call_count == 2
+        client.add_peer.assert_has_calls([call('10.0.0.2', '23112'), call('10.0.0.3', '23112')], any_order=True)
+        assert discovery.data['discoveredPeers'] == ['10.0.0.4:23112']
+
+        client.gateway_stat.return_value = {'peers': [{'netaddress': addr} for addr in ['1', '2', '3', '4']]}
+        discovery.add_peer()
+        assert client.add_peer.call_count == 2
+
+    def test_scoreboard(self):
+        """Test peers are scored, decayed and evicted."""
+        data = self.valid_data.copy()
+        data['peers'] = []
+        data['maxFailures'] = 2
+        discovery = self.type(name='discovery', data=data)
+        discovery._record_probe('10.0.0.1:23112', 0.2)
+        discovery._record('10.0.0.1:23112', True)
+        discovery._record('10.0.0.2:23112', True)
+        discovery._record('10.0.0.1:23112', True)
+        discovery._record('10.0.0.3:23112', False)
+
+        assert discovery._candidates() == ['10.0.0.1:23112', '10.0.0.2:23112', '10.0.0.3:23112']
+        assert discovery._candidates(exclude=['10.0.0.1:23112']) == ['10.0.0.2:23112', '10.0.0.3:23112']
+
+        # the score halves every scoreHalfLife
+        entry = discovery.data['peers'][0]
+        entry['scoreTime'] -= data['scoreHalfLife']
+        assert discovery.scoreboard()[0]['score'] == pytest.approx(1.0, rel=0.01)
+
+        discovery._record('10.0.0.3:23112', False)
+        discovery._evict()
+        assert discovery._candidates() == ['10.0.0.1:23112', '10.0.0.2:23112']
+
+    def test_scoreboard_probes_not_scored(self):
+        """Test probes rank peers but don't score or evict them."""
+        data = self.valid_data.copy()
+        data['peers'] = []
+        data['maxFailures'] = 2
+        discovery = self.type(name='discovery', data=data)
+        discovery._record_probe('10.0.0.1:23112', None)
+        discovery._record_probe('10.0.0.1:23112', None)
+        discovery._record_probe('10.0.0.2:23112', 0.1)
+        discovery._evict()
+
+        assert discovery._candidates() == ['10.0.0.2:23112', '10.0.0.1:23112']
+        assert discovery.data['peers'][0]['probeFailures'] == 2
+        assert discovery.data['peers'][0]['score'] == 0
+
+        # a reachable peer the daemon fails to add is still evicted
+        discovery._record('10.0.0.2:23112', False)
+        discovery._record_probe('10.0.0.2:23112', 0.1)
+        discovery._record('10.0.0.2:23112', False)
+        discovery._evict()
+        assert discovery._candidates() == ['10.0.0.1:23112']
+
+    def test_evicted_peers_not_rescanned(self):
+        """Test evicted peers stay out of the scoreboard for evictionPeriod."""
+        client = MagicMock()
+        client.discover_local_peers.return_value = ['10.0.0.1:23112', '10.0.0.2:23112']
+        client.gateway_stat.return_value = {'peers': []}
+        patch('jumpscale.j.sal_zos.tfchain.client', MagicMock(return_value=client)).start()
+        data = self.valid_data.copy()
+        data['peers'] = []
+        data['discoveredPeers'] = ['10.0.0.1:23112']
+        data['maxFailures'] = 1
+        discovery = self.type(name='discovery', data=data)
+        discovery._probe = MagicMock(return_value=0.1)
+        discovery._record('10.0.0.1:23112', False)
+        discovery._evict()
+        assert discovery.data['discoveredPeers'] == []
+
+        discovery.discover_peers()
+        discovery._probe.assert_called_once_with('10.0.0.2:23112')
+        assert discovery.data['discoveredPeers'] == ['10.0.0.2:23112']
+
+        # the tombstone is dropped after evictionPeriod
+        discovery.data['peers'][0]['evicted'] -= data['evictionPeriod']
+        discovery._evict()
+        assert [entry['address'] for entry in discovery.data['peers']] == ['10.0.0.2:23112']
+
+    def test_install_incremental(self):
+        """Test install discovery service in incremental scan mode."""
+        data = self.valid_data.copy()
+        data['scanMode'] = 'incremental'
+        discovery = self.type(name='discovery', data=data)
+        discovery.recurring_action = MagicMock()
+        discovery.install()
+
+        discovery.recurring_action.assert_has_calls([call('scan_slice', 60), call('add_peer', 300)])
+
+    def test_scan_slice(self):
+        """Test scanning rotating slices of the network."""
+        client = MagicMock()
+        client.gateway_stat.return_value = {'peers': []}
+        patch('jumpscale.j.sal_zos.tfchain.client', MagicMock(return_value=client)).start()
+        data = self.valid_data.copy()
+        data['peers'] = []
+        data['scanSliceSize'] = 4
+        data['scanCursor'] = 4
+        discovery = self.type(name='discovery', data=data)
+        discovery._probe = MagicMock(return_value=0.1)
+        container = MagicMock()
+        container.client.info.nic.return_value = [
+            {'name': 'lo', 'addrs': [{'addr': '127.0.0.1/8'}]},
+            {'name': 'eth0', 'addrs': [{'addr': '10.0.0.5/29'}]},
+        ]
+        container.client.system.return_value.get.return_value = MagicMock(
+            state='SUCCESS', stdout='# Nmap\nHost: 10.0.0.5 ()\tPorts: 23112/open/tcp//unknown///\nHost: 10.0.0.6 ()\tPorts: 23112/open/tcp//unknown///\n')
+        discovery._container = container
+
+        discovery.scan_slice()
+
+        cmd = container.client.system.call_args[0][0]
+        assert cmd.endswith('-p 23112 10.0.0.5 10.0.0.6 10.0.0.1 10.0.0.2')
+        assert '--max-rate 100' in cmd
+        assert discovery.data['scanCursor'] == 2
+        assert discovery.data['discoveredPeers'] == ['10.0.0.6:23112']
+
+    def test_exchange_peers(self):
+        """Test pushing the top peers to sibling services."""
+        data = self.valid_data.copy()
+        data['peers'] = []
+        data['discoveredPeers'] = []
+        discovery = self.type(name='discovery', data=data)
+        discovery._record('10.0.0.1:23112', True)
+        discovery._record('10.0.0.2:23112', False)
+        assert discovery.top_peers() == ['10.0.0.1:23112']
+
+        sibling = MagicMock()
+        sibling.template_uid.name = 'peer_discovery'
+        other = MagicMock()
+        other.template_uid.name = 'block_creator'
+        discovery.api = MagicMock()
+        discovery.api.services.find.return_value = [discovery, sibling, other]
+
+        assert discovery.exchange_peers() == ['10.0.0.1:23112']
+        sibling.schedule_action.assert_called_once_with('merge_peers', args={'peers': ['10.0.0.1:23112']})
+        # the push doesn't wait for the sibling
+        assert not sibling.schedule_action.return_value.wait.called
+        assert not other.schedule_action.called
+
+    def test_merge_peers(self):
+        """Test merging the peers pushed by a sibling service."""
+        data = self.valid_data.copy()
+        data['peers'] = []
+        data['discoveredPeers'] = []
+        data['gossipMaxPeers'] = 2
+        data['maxFailures'] = 1
+        discovery = self.type(name='discovery', data=data)
+        discovery._record('10.0.0.1:23112', True)
+        discovery._record('10.0.0.2:23112', False)
+        discovery._evict()
+
+        merged = discovery.merge_peers(['10.0.0.1:23112', '10.0.0.2:23112', '10.0.1.1:23112', '10.0.1.2:23112', '10.0.1.3:23112'])
+
+        assert merged == ['10.0.1.1:23112', '10.0.1.2:23112']
+        assert discovery.data['discoveredPeers'] == ['10.0.1.1:23112', '10.0.1.2:23112']
+        assert len(discovery.data['peers']) == 4
+
+    def test_set_container(self):
+        """Test pointing the service to another container."""
+        discovery = self.type(name='discovery', data=self.valid_data.copy())
+        discovery._container = MagicMock()
+        discovery.set_container('container-green')
+
+        assert discovery.data['container'] == 'container-green'
+        assert discovery._container is None